@@ -1,40 +1,314 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-from datetime import datetime
-import json
+from tkinter import ttk, messagebox, filedialog, simpledialog
 import os
-from collections import defaultdict
+import time
+from datetime import datetime
+from itertools import islice
+
+import kabraji_bulk as bulk
+import kabraji_invoices as invoices
+from kabraji_engine import DAY_FORMAT, LOW_STOCK_LEVEL, ShopEngine, ShopError, reorder_level
+from kabraji_server import SERVE_ENV, SERVER_ENV, ShopClient, ShopServer, parse_address
+from kabraji_storage import IOWorker
+
+# How often finished background writes are checked for
+IO_POLL_MS = 50
+
+# Type-ahead search in the sale combos
+SEARCH_DELAY_MS = 150
+COMBO_LIMIT = 50
+NAVIGATION_KEYS = {'Up', 'Down', 'Left', 'Right', 'Return', 'Tab', 'Escape',
+                   'Shift_L', 'Shift_R', 'Control_L', 'Control_R'}
+
+# Report lines inserted into the Reports text per UI tick
+REPORT_CHUNK_LINES = 200
+
+class VirtualTreeview:
+    """Shows a large keyed collection in a ttk.Treeview without inserting every row.
+    
+    Only the visible rows plus `buffer` rows either side are materialized in
+    the tree, with each row's iid set to its key. The scrollbar is driven from
+    the full collection and rows are paged in as the view nears the edge of
+    the materialized window. Single rows can be inserted, updated or deleted
+    without touching the rest of the table.
+    """
+    
+    def __init__(self, tree, scrollbar, row_values, buffer=50):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.row_values = row_values
+        self.buffer = buffer
+        
+        self.keys = []
+        self.records = {}
+        self.first = 0  # index in self.keys of the first materialized row
+        self.count = 0  # number of materialized rows
+        self.top = 0    # index in self.keys of the first visible row
+        self._pending = False
+        
+        self.tree.configure(yscrollcommand=self._on_tree_scroll)
+        self.scrollbar.configure(command=self.yview)
+        self.tree.bind('<Configure>', lambda event: self._schedule_materialize(), add='+')
+    
+    def visible_rows(self):
+        height = self.tree.winfo_height()
+        if height <= 1:
+            return int(self.tree.cget('height'))
+        row_height = ttk.Style().lookup('Treeview', 'rowheight') or 20
+        return max(1, height // int(row_height) - 1)
+    
+    def set_rows(self, rows):
+        """Replace the whole collection with (key, record) pairs"""
+        self.records = dict(rows)
+        self.keys = list(self.records)
+        self._materialize(self.top)
+    
+    def selected_keys(self):
+        return list(self.tree.selection())
+    
+    def update_row(self, key, record):
+        self.records[key] = record
+        if self.tree.exists(key):
+            self.tree.item(key, values=self.row_values(key, record))
+    
+    def insert_row(self, key, record, index=None):
+        if key in self.records:
+            self.update_row(key, record)
+            return
+        if index is None:
+            index = len(self.keys)
+        self.keys.insert(index, key)
+        self.records[key] = record
+        if self.first <= index <= self.first + self.count:
+            self.tree.insert('', index - self.first, iid=key, values=self.row_values(key, record))
+            self.count += 1
+        elif index < self.first:
+            self.first += 1
+            self.top += 1
+        self._update_scrollbar()
+    
+    def delete_row(self, key):
+        if key not in self.records:
+            return
+        index = self.keys.index(key)
+        del self.keys[index]
+        del self.records[key]
+        if self.tree.exists(key):
+            self.tree.delete(key)
+            self.count -= 1
+        elif index < self.first:
+            self.first -= 1
+            self.top -= 1
+        self._update_scrollbar()
+        self._schedule_materialize()
+    
+    def yview(self, *args):
+        """Scrollbar command: scroll through the full collection"""
+        visible = self.visible_rows()
+        if args[0] == 'moveto':
+            top = int(float(args[1]) * len(self.keys))
+        elif args[2] == 'pages':
+            top = self.top + int(args[1]) * visible
+        else:
+            top = self.top + int(args[1])
+        self.scroll_to(top)
+    
+    def scroll_to(self, top):
+        visible = self.visible_rows()
+        top = max(0, min(top, len(self.keys) - visible))
+        if self.first <= top and top + visible <= self.first + self.count:
+            self.top = top
+            self.tree.yview_moveto((top - self.first) / self.count)
+        else:
+            self._materialize(top)
+        self._update_scrollbar()
+    
+    # Internals
+    def _materialize(self, top):
+        visible = self.visible_rows()
+        top = max(0, min(top, len(self.keys) - visible))
+        selected = self.tree.selection()
+        
+        self.tree.delete(*self.tree.get_children())
+        self.first = max(0, top - self.buffer)
+        last = min(len(self.keys), top + visible + self.buffer)
+        for key in self.keys[self.first:last]:
+            self.tree.insert('', 'end', iid=key, values=self.row_values(key, self.records[key]))
+        self.count = last - self.first
+        self.top = top
+        
+        kept = [key for key in selected if self.tree.exists(key)]
+        if kept:
+            self.tree.selection_set(kept)
+        if self.count:
+            self.tree.yview_moveto((top - self.first) / self.count)
+        self._update_scrollbar()
+    
+    def _schedule_materialize(self):
+        if not self._pending:
+            self._pending = True
+            self.tree.after_idle(self._run_materialize)
+    
+    def _run_materialize(self):
+        self._pending = False
+        self._materialize(self.top)
+    
+    def _on_tree_scroll(self, lo, hi):
+        # The tree scrolled itself (mouse wheel, keyboard); follow it and page
+        # in more rows when the view gets close to the materialized edge
+        if not self.count:
+            self._update_scrollbar()
+            return
+        self.top = self.first + int(float(lo) * self.count + 0.5)
+        bottom = self.first + int(float(hi) * self.count + 0.5)
+        near_start = self.first > 0 and self.top - self.first < self.buffer // 2
+        near_end = (self.first + self.count < len(self.keys)
+                    and self.first + self.count - bottom < self.buffer // 2)
+        if near_start or near_end:
+            self._schedule_materialize()
+        self._update_scrollbar()
+    
+    def _update_scrollbar(self):
+        total = len(self.keys)
+        if not total:
+            self.scrollbar.set(0, 1)
+            return
+        visible = self.visible_rows()
+        self.scrollbar.set(self.top / total, min(1.0, (self.top + visible) / total))
+
 
 class KabrajiShopSystem:
-    def __init__(self, root):
+    def __init__(self, root, engine=None):
         self.root = root
         self.root.title("KABRAJI - Building Dreams, One Product at a Time")
         self.root.geometry("1200x800")
         self.root.configure(bg="#1a237e")
         
-        # Data storage
-        self.products = {}
-        self.customers = {}
-        self.orders = []
-        self.sales_history = []
-        
-        self.load_data()
-        self.initialize_default_products()
+        self.started_at = time.perf_counter()
+        self.startup_times = {}
+        
+        self.search_jobs = {}
+        self.report_job = None
+        self.history_customer = None
+        self.history_page = 0
+        
+        # Disk writes run on a background worker; results come back via poll_io
+        self.io = IOWorker()
+        self.io.on_error = lambda error: messagebox.showerror("Save Failed", str(error))
+        self.exports = IOWorker(maxsize=1)
+        
+        # With KABRAJI_SERVER set this app is a billing terminal: its engine
+        # mirrors the server's data and the cart lives on the server
+        server = os.environ.get(SERVER_ENV)
+        self.terminal = ShopClient(server) if server and engine is None else None
+        
+        # All shop data and logic lives in the headless engine
+        self.engine = engine or ShopEngine(self.terminal, worker=self.io)
+        self.sales = self.terminal or self.engine
+        
+        # With KABRAJI_SERVE set this app also serves terminals from its own engine,
+        # started once the data has loaded
+        self.serve_address = os.environ.get(SERVE_ENV) if self.terminal is None else None
+        self.server = None
+        
+        # Widgets of tabs that have not been opened yet
+        self.metric_labels = {}
+        self.products_table = None
+        self.customers_table = None
+        self.orders_table = None
+        self.sale_prod_combo = None
+        self.sale_cust_combo = None
         
         # Header
         self.create_header()
         
-        # Main notebook
+        # Status line at the bottom; shows the startup timings once the data has loaded
+        self.status_label = tk.Label(root, text="Loading shop data...", anchor='w',
+                                     font=("Arial", 9), fg="#555555")
+        self.status_label.pack(fill='x', side='bottom', padx=10)
+        
+        # Main notebook; each tab is built the first time it is selected
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
         
-        # Create tabs
-        self.create_dashboard_tab()
-        self.create_products_tab()
-        self.create_customers_tab()
-        self.create_sales_tab()
-        self.create_orders_tab()
-        self.create_reports_tab()
+        self.tab_builders = {}
+        for text, builder in (("📊 Dashboard", self.create_dashboard_tab),
+                              ("📦 Products", self.create_products_tab),
+                              ("👥 Customers", self.create_customers_tab),
+                              ("💰 Sales & Billing", self.create_sales_tab),
+                              ("📋 Orders", self.create_orders_tab),
+                              ("📈 Reports", self.create_reports_tab)):
+            frame = ttk.Frame(self.notebook)
+            self.notebook.add(frame, text=text)
+            self.tab_builders[str(frame)] = (text, builder)
+        self.notebook.bind('<<NotebookTabChanged>>', self.build_selected_tab)
+        self.build_selected_tab()
+        
+        # Tables and dashboard follow engine changes row by row
+        self.engine.subscribe(self.on_data_changed)
+        
+        # Data is read and indexed on the I/O worker once the window is up
+        self.root.title(self.root.title() + " (loading...)")
+        self.engine.start(on_loaded=self.on_data_loaded)
+        
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after_idle(lambda: self.startup_times.setdefault('window', self.startup_elapsed()))
+        self.poll_io()
+    
+    def build_selected_tab(self, event=None):
+        """Build the selected tab's widgets the first time it is shown"""
+        frame = self.notebook.select()
+        entry = self.tab_builders.pop(frame, None)
+        if entry is None:
+            return
+        text, builder = entry
+        start = time.perf_counter()
+        builder(self.notebook.nametowidget(frame))
+        self.startup_times[f"{text.split(' ', 1)[1]} tab"] = time.perf_counter() - start
+    
+    def startup_elapsed(self):
+        return time.perf_counter() - self.started_at
+    
+    def on_data_loaded(self, error):
+        if error is not None:
+            # Starting empty would overwrite the data files, so stop instead
+            messagebox.showerror("Cannot Load Data",
+                                 f"{error}\n\nNothing was changed on disk. The application will close.")
+            self.root.after_idle(self.on_close)
+            return
+        
+        self.startup_times['data'] = self.startup_elapsed()
+        self.root.title(self.root.title().replace(" (loading...)", ""))
+        self.status_label.config(text=self.startup_report())
+        
+        if self.serve_address:
+            self.start_server()
+        
+        problems = self.engine.load_problems
+        if problems:
+            shown = "\n".join(problems[:10])
+            if len(problems) > 10:
+                shown += f"\n... and {len(problems) - 10} more"
+            messagebox.showwarning("Damaged Data",
+                                   f"Some saved records could not be read and were skipped:\n\n{shown}")
+    
+    def start_server(self):
+        """Serve terminals; their requests run on this thread from poll_io"""
+        try:
+            host, port = parse_address(self.serve_address)
+            self.server = ShopServer(self.engine, host, port, polled=True)
+        except (ShopError, OSError) as e:
+            messagebox.showerror("Error", f"Cannot serve terminals on {self.serve_address}: {e}")
+            return
+        self.server.start()
+        host, port = self.server.server_address[:2]
+        self.root.title(self.root.title() + f" (serving terminals on {host}:{port})")
+    
+    def startup_report(self):
+        """One line of startup timings, in seconds since the app was created"""
+        parts = [f"{name} {seconds:.3f}s" for name, seconds in self.startup_times.items()]
+        return (f"Startup ({len(self.engine.products)} products, {len(self.engine.orders)} orders): "
+                + ", ".join(parts))
         
     def create_header(self):
         """Create application header"""
@@ -47,47 +321,8 @@ class KabrajiShopSystem:
         tk.Label(header_frame, text="Building Dreams, One Product at a Time | Quality Paints, Sanitary & Building Materials", 
                 font=("Arial", 11, "italic"), bg="#1a237e", fg="#ffd700").pack()
     
-    def initialize_default_products(self):
-        """Add default products if none exist"""
-        if not self.products:
-            default_products = [
-                # Paints
-                {"name": "Asian Paints Royale", "category": "Paints", "price": 450.0, "stock": 50, "unit": "Liter"},
-                {"name": "Berger Weather Coat", "category": "Paints", "price": 420.0, "stock": 40, "unit": "Liter"},
-                {"name": "Nerolac Excel", "category": "Paints", "price": 380.0, "stock": 60, "unit": "Liter"},
-                {"name": "Dulux Premium", "category": "Paints", "price": 500.0, "stock": 30, "unit": "Liter"},
-                {"name": "Paint Primer", "category": "Paints", "price": 250.0, "stock": 45, "unit": "Liter"},
-                
-                # Sanitary
-                {"name": "Hindware Toilet Seat", "category": "Sanitary", "price": 3500.0, "stock": 20, "unit": "Piece"},
-                {"name": "Jaquar Basin Tap", "category": "Sanitary", "price": 1200.0, "stock": 35, "unit": "Piece"},
-                {"name": "Cera Wash Basin", "category": "Sanitary", "price": 2800.0, "stock": 15, "unit": "Piece"},
-                {"name": "Parryware Commode", "category": "Sanitary", "price": 4500.0, "stock": 12, "unit": "Piece"},
-                {"name": "Shower Head Premium", "category": "Sanitary", "price": 800.0, "stock": 40, "unit": "Piece"},
-                
-                # Building Materials
-                {"name": "Cement - UltraTech", "category": "Building Materials", "price": 380.0, "stock": 200, "unit": "Bag"},
-                {"name": "Cement - ACC", "category": "Building Materials", "price": 375.0, "stock": 180, "unit": "Bag"},
-                {"name": "TMT Steel Bars 8mm", "category": "Building Materials", "price": 55.0, "stock": 500, "unit": "Kg"},
-                {"name": "TMT Steel Bars 12mm", "category": "Building Materials", "price": 54.0, "stock": 600, "unit": "Kg"},
-                {"name": "Bricks - Red Clay", "category": "Building Materials", "price": 8.0, "stock": 5000, "unit": "Piece"},
-                {"name": "Sand - River", "category": "Building Materials", "price": 1500.0, "stock": 100, "unit": "Ton"},
-                {"name": "Gravel/Aggregate", "category": "Building Materials", "price": 1200.0, "stock": 80, "unit": "Ton"},
-                {"name": "PVC Pipes 1 inch", "category": "Building Materials", "price": 45.0, "stock": 150, "unit": "Meter"},
-                {"name": "PVC Pipes 2 inch", "category": "Building Materials", "price": 80.0, "stock": 120, "unit": "Meter"},
-                {"name": "Electrical Wires", "category": "Building Materials", "price": 25.0, "stock": 300, "unit": "Meter"},
-            ]
-            
-            for idx, prod in enumerate(default_products, 1):
-                prod_id = f"PROD{idx:04d}"
-                self.products[prod_id] = prod
-            
-            self.save_data()
-    
-    def create_dashboard_tab(self):
+    def create_dashboard_tab(self, dash_frame):
         """Dashboard with key metrics"""
-        dash_frame = ttk.Frame(self.notebook)
-        self.notebook.add(dash_frame, text="📊 Dashboard")
         
         # Title
         title = tk.Label(dash_frame, text="Business Overview", 
@@ -102,32 +337,33 @@ class KabrajiShopSystem:
         cards_frame = tk.Frame(metrics_frame, bg="white")
         cards_frame.pack(pady=20)
         
+        # Value labels are kept so the cards can be updated in place
+        
         # Total Products
-        self.create_metric_card(cards_frame, "Total Products", 
-                               len(self.products), "#4CAF50", 0, 0)
+        self.metric_labels['products'] = self.create_metric_card(
+            cards_frame, "Total Products", "", "#4CAF50", 0, 0)
         
         # Total Customers
-        self.create_metric_card(cards_frame, "Total Customers", 
-                               len(self.customers), "#2196F3", 0, 1)
+        self.metric_labels['customers'] = self.create_metric_card(
+            cards_frame, "Total Customers", "", "#2196F3", 0, 1)
         
         # Total Orders
-        self.create_metric_card(cards_frame, "Total Orders", 
-                               len(self.orders), "#FF9800", 0, 2)
+        self.metric_labels['orders'] = self.create_metric_card(
+            cards_frame, "Total Orders", "", "#FF9800", 0, 2)
         
         # Total Revenue
-        total_revenue = sum(sale['total'] for sale in self.sales_history)
-        self.create_metric_card(cards_frame, "Total Revenue", 
-                               f"₹{total_revenue:,.2f}", "#9C27B0", 1, 0)
+        self.metric_labels['revenue'] = self.create_metric_card(
+            cards_frame, "Total Revenue", "", "#9C27B0", 1, 0)
         
         # Low Stock Items
-        low_stock = sum(1 for p in self.products.values() if p['stock'] < 10)
-        self.create_metric_card(cards_frame, "Low Stock Items", 
-                               low_stock, "#f44336", 1, 1)
+        self.metric_labels['low_stock'] = self.create_metric_card(
+            cards_frame, "Low Stock Items", "", "#f44336", 1, 1)
         
         # Pending Orders
-        pending = sum(1 for o in self.orders if o['status'] == 'Pending')
-        self.create_metric_card(cards_frame, "Pending Orders", 
-                               pending, "#FF5722", 1, 2)
+        self.metric_labels['pending'] = self.create_metric_card(
+            cards_frame, "Pending Orders", "", "#FF5722", 1, 2)
+        
+        self.update_dashboard()
         
         # Refresh button
         refresh_btn = tk.Button(metrics_frame, text="🔄 Refresh Dashboard", 
@@ -144,19 +380,26 @@ class KabrajiShopSystem:
         
         tk.Label(card, text=title, font=("Arial", 12, "bold"), 
                 bg=color, fg="white").pack(pady=10)
-        tk.Label(card, text=str(value), font=("Arial", 20, "bold"), 
-                bg=color, fg="white").pack(pady=5)
+        value_label = tk.Label(card, text=str(value), font=("Arial", 20, "bold"), 
+                              bg=color, fg="white")
+        value_label.pack(pady=5)
+        return value_label
+    
+    def update_dashboard(self):
+        """Update the metric cards in place from the engine's running totals"""
+        metrics = self.engine.dashboard_metrics()
+        metrics['revenue'] = f"₹{metrics['revenue']:,.2f}"
+        for key, label in self.metric_labels.items():
+            label.config(text=str(metrics[key]))
     
     def refresh_dashboard(self):
         """Refresh dashboard metrics"""
         self.notebook.select(0)
-        self.create_dashboard_tab()
+        self.update_dashboard()
         messagebox.showinfo("Success", "Dashboard refreshed!")
     
-    def create_products_tab(self):
+    def create_products_tab(self, prod_frame):
         """Products inventory management"""
-        prod_frame = ttk.Frame(self.notebook)
-        self.notebook.add(prod_frame, text="📦 Products")
         
         # Title
         title = tk.Label(prod_frame, text="Product Inventory Management", 
@@ -202,6 +445,12 @@ class KabrajiShopSystem:
                                            width=23, font=("Arial", 10))
         self.prod_unit_combo.grid(row=2, column=3, padx=5, pady=5)
         
+        tk.Label(fields_frame, text="Reorder Level:", font=("Arial", 10), bg="white").grid(row=3, column=0, padx=5, pady=5, sticky='w')
+        self.prod_reorder_entry = tk.Entry(fields_frame, width=20, font=("Arial", 10))
+        self.prod_reorder_entry.grid(row=3, column=1, padx=5, pady=5)
+        tk.Label(fields_frame, text=f"(blank = {LOW_STOCK_LEVEL})", font=("Arial", 9), fg="gray",
+                 bg="white").grid(row=3, column=2, padx=5, pady=5, sticky='w')
+        
         # Buttons
         btn_frame = tk.Frame(input_frame, bg="white")
         btn_frame.pack(pady=10)
@@ -214,6 +463,12 @@ class KabrajiShopSystem:
                  bg="#f44336", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
         tk.Button(btn_frame, text="Clear Fields", command=self.clear_product_fields,
                  bg="#607D8B", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Receive Stock...", command=self.receive_stock,
+                 bg="#009688", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Import...", command=lambda: self.import_collection('products'),
+                 bg="#795548", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Export...", command=lambda: self.export_collection('products'),
+                 bg="#795548", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
         
         # Products table
         table_frame = tk.Frame(prod_frame, bg="white")
@@ -229,13 +484,11 @@ class KabrajiShopSystem:
         tree_scroll_x.pack(side='bottom', fill='x')
         
         self.products_tree = ttk.Treeview(table_frame, 
-                                         columns=("ID", "Name", "Category", "Price", "Stock", "Unit"),
+                                         columns=("ID", "Name", "Category", "Price", "Stock", "Unit", "Reorder"),
                                          show='headings',
-                                         yscrollcommand=tree_scroll_y.set,
                                          xscrollcommand=tree_scroll_x.set,
                                          height=15)
         
-        tree_scroll_y.config(command=self.products_tree.yview)
         tree_scroll_x.config(command=self.products_tree.xview)
         
         # Configure columns
@@ -245,6 +498,7 @@ class KabrajiShopSystem:
         self.products_tree.heading("Price", text="Price (₹)")
         self.products_tree.heading("Stock", text="Stock")
         self.products_tree.heading("Unit", text="Unit")
+        self.products_tree.heading("Reorder", text="Reorder At")
         
         self.products_tree.column("ID", width=100)
         self.products_tree.column("Name", width=200)
@@ -252,16 +506,17 @@ class KabrajiShopSystem:
         self.products_tree.column("Price", width=100)
         self.products_tree.column("Stock", width=100)
         self.products_tree.column("Unit", width=80)
+        self.products_tree.column("Reorder", width=90)
         
         self.products_tree.pack(fill='both', expand=True)
         self.products_tree.bind('<ButtonRelease-1>', self.select_product)
         
+        # Only the rows around the visible window are materialized
+        self.products_table = VirtualTreeview(self.products_tree, tree_scroll_y, self.product_row)
         self.refresh_products_table()
     
-    def create_customers_tab(self):
+    def create_customers_tab(self, cust_frame):
         """Customer database management"""
-        cust_frame = ttk.Frame(self.notebook)
-        self.notebook.add(cust_frame, text="👥 Customers")
         
         # Title
         title = tk.Label(cust_frame, text="Customer Database", 
@@ -304,6 +559,10 @@ class KabrajiShopSystem:
                  bg="#4CAF50", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
         tk.Button(btn_frame, text="Delete Customer", command=self.delete_customer,
                  bg="#f44336", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Import...", command=lambda: self.import_collection('customers'),
+                 bg="#795548", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Export...", command=lambda: self.export_collection('customers'),
+                 bg="#795548", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
         
         # Customers table
         table_frame = tk.Frame(cust_frame, bg="white")
@@ -317,10 +576,7 @@ class KabrajiShopSystem:
         self.customers_tree = ttk.Treeview(table_frame,
                                           columns=("ID", "Name", "Phone", "Email", "Address"),
                                           show='headings',
-                                          yscrollcommand=tree_scroll.set,
-                                          height=15)
-        
-        tree_scroll.config(command=self.customers_tree.yview)
+                                          height=10)
         
         self.customers_tree.heading("ID", text="Customer ID")
         self.customers_tree.heading("Name", text="Name")
@@ -336,12 +592,39 @@ class KabrajiShopSystem:
         
         self.customers_tree.pack(fill='both', expand=True)
         
+        self.customers_table = VirtualTreeview(self.customers_tree, tree_scroll, self.customer_row)
+        self.customers_tree.bind('<<TreeviewSelect>>', self.select_customer)
         self.refresh_customers_table()
+        
+        # Purchase history of the selected customer
+        history_frame = tk.LabelFrame(cust_frame, text="Purchase History", 
+                                     font=("Arial", 12, "bold"), bg="white", padx=10, pady=5)
+        history_frame.pack(fill='x', padx=20, pady=10)
+        
+        self.history_summary_label = tk.Label(history_frame, text="Select a customer to see their orders",
+                                              font=("Arial", 10), bg="white", justify='left', anchor='w')
+        self.history_summary_label.pack(fill='x', pady=5)
+        
+        self.history_tree = ttk.Treeview(history_frame,
+                                        columns=("Order ID", "Date", "Items", "Total", "Status"),
+                                        show='headings',
+                                        height=6)
+        for col in ("Order ID", "Date", "Items", "Total", "Status"):
+            self.history_tree.heading(col, text=col)
+            self.history_tree.column(col, width=150)
+        self.history_tree.pack(fill='x')
+        
+        pager = tk.Frame(history_frame, bg="white")
+        pager.pack(pady=5)
+        tk.Button(pager, text="◀ Newer", command=lambda: self.change_history_page(-1),
+                 font=("Arial", 9)).pack(side='left', padx=5)
+        self.history_page_label = tk.Label(pager, text="", font=("Arial", 9), bg="white")
+        self.history_page_label.pack(side='left', padx=5)
+        tk.Button(pager, text="Older ▶", command=lambda: self.change_history_page(1),
+                 font=("Arial", 9)).pack(side='left', padx=5)
     
-    def create_sales_tab(self):
+    def create_sales_tab(self, sales_frame):
         """Sales and billing system"""
-        sales_frame = ttk.Frame(self.notebook)
-        self.notebook.add(sales_frame, text="💰 Sales & Billing")
         
         # Title
         title = tk.Label(sales_frame, text="Create Invoice", 
@@ -366,6 +649,8 @@ class KabrajiShopSystem:
         self.sale_cust_combo = ttk.Combobox(cust_frame, textvariable=self.sale_cust_var,
                                            width=30, font=("Arial", 10))
         self.sale_cust_combo.pack(side='left', padx=5, pady=5)
+        self.sale_cust_combo.bind('<KeyRelease>',
+                                  lambda e: self.schedule_search(e, 'customer', self.refresh_customer_combo))
         self.refresh_customer_combo()
         
         # Add items
@@ -378,6 +663,8 @@ class KabrajiShopSystem:
         self.sale_prod_combo = ttk.Combobox(item_frame, textvariable=self.sale_prod_var,
                                            width=30, font=("Arial", 10))
         self.sale_prod_combo.grid(row=0, column=1, padx=5, pady=5)
+        self.sale_prod_combo.bind('<KeyRelease>',
+                                  lambda e: self.schedule_search(e, 'product', self.refresh_product_combo))
         self.refresh_product_combo()
         
         tk.Label(item_frame, text="Quantity:", font=("Arial", 10), bg="white").grid(row=1, column=0, padx=5, pady=5, sticky='w')
@@ -437,7 +724,7 @@ class KabrajiShopSystem:
                                       font=("Arial", 12), bg="white")
         self.discount_label.pack(anchor='w', pady=5)
         
-        self.tax_label = tk.Label(summary_frame, text="GST (18%): ₹0.00", 
+        self.tax_label = tk.Label(summary_frame, text="GST: ₹0.00", 
                                  font=("Arial", 12), bg="white")
         self.tax_label.pack(anchor='w', pady=5)
         
@@ -452,13 +739,9 @@ class KabrajiShopSystem:
         
         tk.Button(right_frame, text="🗑️ Clear Cart", command=self.clear_cart,
                  bg="#FF9800", fg="white", font=("Arial", 11, "bold"), padx=20, pady=8).pack(pady=5)
-        
-        self.cart_items = []
     
-    def create_orders_tab(self):
+    def create_orders_tab(self, order_frame):
         """Order processing system"""
-        order_frame = ttk.Frame(self.notebook)
-        self.notebook.add(order_frame, text="📋 Orders")
         
         # Title
         title = tk.Label(order_frame, text="Order Management", 
@@ -477,11 +760,8 @@ class KabrajiShopSystem:
         self.orders_tree = ttk.Treeview(table_frame,
                                        columns=("Order ID", "Customer", "Date", "Items", "Total", "Status"),
                                        show='headings',
-                                       yscrollcommand=tree_scroll.set,
                                        height=20)
         
-        tree_scroll.config(command=self.orders_tree.yview)
-        
         self.orders_tree.heading("Order ID", text="Order ID")
         self.orders_tree.heading("Customer", text="Customer")
         self.orders_tree.heading("Date", text="Date")
@@ -497,6 +777,7 @@ class KabrajiShopSystem:
         self.orders_tree.column("Status", width=120)
         
         self.orders_tree.pack(fill='both', expand=True)
+        self.orders_table = VirtualTreeview(self.orders_tree, tree_scroll, self.order_row)
         
         # Status update buttons
         btn_frame = tk.Frame(table_frame, bg="white")
@@ -508,13 +789,15 @@ class KabrajiShopSystem:
                  bg="#FF9800", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
         tk.Button(btn_frame, text="Cancel Order", command=lambda: self.update_order_status("Cancelled"),
                  bg="#f44336", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Return Items...", command=self.return_items,
+                 bg="#9C27B0", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
+        tk.Button(btn_frame, text="Export...", command=lambda: self.export_collection('orders'),
+                 bg="#795548", fg="white", font=("Arial", 10, "bold"), padx=15).pack(side='left', padx=5)
         
         self.refresh_orders_table()
     
-    def create_reports_tab(self):
+    def create_reports_tab(self, report_frame):
         """Sales tracking and reporting"""
-        report_frame = ttk.Frame(self.notebook)
-        self.notebook.add(report_frame, text="📈 Reports")
         
         # Title
         title = tk.Label(report_frame, text="Sales Reports & Analytics", 
@@ -528,16 +811,18 @@ class KabrajiShopSystem:
         
         tk.Label(filter_frame, text="Date From:", font=("Arial", 10), bg="white").grid(row=0, column=0, padx=5, pady=5)
         self.report_from_entry = tk.Entry(filter_frame, width=15, font=("Arial", 10))
-        self.report_from_entry.insert(0, datetime.now().strftime("%d/%m/%Y"))
+        self.report_from_entry.insert(0, datetime.now().strftime(DAY_FORMAT))
         self.report_from_entry.grid(row=0, column=1, padx=5, pady=5)
         
         tk.Label(filter_frame, text="Date To:", font=("Arial", 10), bg="white").grid(row=0, column=2, padx=5, pady=5)
         self.report_to_entry = tk.Entry(filter_frame, width=15, font=("Arial", 10))
-        self.report_to_entry.insert(0, datetime.now().strftime("%d/%m/%Y"))
+        self.report_to_entry.insert(0, datetime.now().strftime(DAY_FORMAT))
         self.report_to_entry.grid(row=0, column=3, padx=5, pady=5)
         
         tk.Button(filter_frame, text="Generate Report", command=self.generate_report,
                  bg="#2196F3", fg="white", font=("Arial", 10, "bold")).grid(row=0, column=4, padx=10, pady=5)
+        tk.Button(filter_frame, text="Stock on Date", command=self.stock_on_date,
+                 bg="#009688", fg="white", font=("Arial", 10, "bold")).grid(row=0, column=5, padx=10, pady=5)
         
         # Report display
         display_frame = tk.Frame(report_frame, bg="white")
@@ -551,9 +836,13 @@ class KabrajiShopSystem:
         self.report_text.pack(fill='both', expand=True)
         scroll.config(command=self.report_text.yview)
         
-        # Export button
-        tk.Button(report_frame, text="📥 Export Report", command=self.export_report,
-                 bg="#4CAF50", fg="white", font=("Arial", 11, "bold"), padx=20, pady=8).pack(pady=10)
+        # Export buttons
+        export_frame = tk.Frame(report_frame)
+        export_frame.pack(pady=10)
+        tk.Button(export_frame, text="📥 Export Report", command=self.export_report,
+                 bg="#4CAF50", fg="white", font=("Arial", 11, "bold"), padx=20, pady=8).pack(side='left', padx=5)
+        tk.Button(export_frame, text="🧾 Export Invoices", command=self.export_invoices,
+                 bg="#FF9800", fg="white", font=("Arial", 11, "bold"), padx=20, pady=8).pack(side='left', padx=5)
     
     # Product functions
     def add_product(self):
@@ -563,102 +852,97 @@ class KabrajiShopSystem:
         price = self.prod_price_entry.get().strip()
         stock = self.prod_stock_entry.get().strip()
         unit = self.prod_unit_var.get()
-        
-        if not all([prod_id, name, category, price, stock, unit]):
-            messagebox.showerror("Error", "Please fill all fields!")
-            return
+        reorder_level = self.prod_reorder_entry.get().strip()
         
         try:
-            price = float(price)
-            stock = int(stock)
-        except ValueError:
-            messagebox.showerror("Error", "Invalid price or stock value!")
+            self.engine.add_product(prod_id, name, category, price, stock, unit, reorder_level)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
             return
         
-        if prod_id in self.products:
-            messagebox.showerror("Error", "Product ID already exists!")
-            return
-        
-        self.products[prod_id] = {
-            'name': name,
-            'category': category,
-            'price': price,
-            'stock': stock,
-            'unit': unit
-        }
-        
-        self.save_data()
-        self.refresh_products_table()
         self.refresh_product_combo()
         self.clear_product_fields()
         messagebox.showinfo("Success", "Product added successfully!")
     
     def update_product(self):
         prod_id = self.prod_id_entry.get().strip()
-        
-        if prod_id not in self.products:
-            messagebox.showerror("Error", "Product ID not found!")
-            return
-        
         name = self.prod_name_entry.get().strip()
         category = self.prod_cat_var.get()
         price = self.prod_price_entry.get().strip()
         stock = self.prod_stock_entry.get().strip()
         unit = self.prod_unit_var.get()
-        
-        if not all([name, category, price, stock, unit]):
-            messagebox.showerror("Error", "Please fill all fields!")
-            return
+        reorder_level = self.prod_reorder_entry.get().strip()
         
         try:
-            price = float(price)
-            stock = int(stock)
-        except ValueError:
-            messagebox.showerror("Error", "Invalid price or stock value!")
+            self.engine.update_product(prod_id, name, category, price, stock, unit, reorder_level)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
             return
         
-        self.products[prod_id].update({
-            'name': name,
-            'category': category,
-            'price': price,
-            'stock': stock,
-            'unit': unit
-        })
-        
-        self.save_data()
-        self.refresh_products_table()
         self.refresh_product_combo()
         messagebox.showinfo("Success", "Product updated successfully!")
     
     def delete_product(self):
         prod_id = self.prod_id_entry.get().strip()
         
-        if prod_id not in self.products:
+        if prod_id not in self.engine.products:
             messagebox.showerror("Error", "Product ID not found!")
             return
         
         if messagebox.askyesno("Confirm", f"Delete product {prod_id}?"):
-            del self.products[prod_id]
-            self.save_data()
-            self.refresh_products_table()
+            try:
+                self.engine.delete_product(prod_id)
+            except ShopError as e:
+                messagebox.showerror("Error", str(e))
+                return
             self.refresh_product_combo()
             self.clear_product_fields()
             messagebox.showinfo("Success", "Product deleted successfully!")
     
+    def receive_stock(self):
+        prod_id = self.prod_id_entry.get().strip()
+        
+        if prod_id not in self.engine.products:
+            messagebox.showerror("Error", "Please select a product first!")
+            return
+        
+        prod = self.engine.products[prod_id]
+        qty = simpledialog.askfloat("Receive Stock", f"Quantity of {prod.name} received ({prod.unit}):",
+                                    parent=self.root, minvalue=0)
+        if not qty:
+            return
+        ref = simpledialog.askstring("Receive Stock", "Supplier or bill number (optional):",
+                                     parent=self.root) or ''
+        
+        try:
+            self.engine.receive_stock(prod_id, qty, ref.strip())
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        
+        self.prod_stock_entry.delete(0, 'end')
+        self.prod_stock_entry.insert(0, prod.stock)
+        self.refresh_product_combo()
+        messagebox.showinfo("Success", f"Stock of {prod.name} is now {prod.stock} {prod.unit}")
+    
     def select_product(self, event):
-        selected = self.products_tree.selection()
-        if selected:
-            values = self.products_tree.item(selected[0])['values']
+        selected = self.products_table.selected_keys()
+        if selected and selected[0] in self.engine.products:
+            prod_id = selected[0]
+            prod = self.engine.products[prod_id]
             self.prod_id_entry.delete(0, 'end')
-            self.prod_id_entry.insert(0, values[0])
+            self.prod_id_entry.insert(0, prod_id)
             self.prod_name_entry.delete(0, 'end')
-            self.prod_name_entry.insert(0, values[1])
-            self.prod_cat_var.set(values[2])
+            self.prod_name_entry.insert(0, prod.name)
+            self.prod_cat_var.set(prod.category)
             self.prod_price_entry.delete(0, 'end')
-            self.prod_price_entry.insert(0, values[3])
+            self.prod_price_entry.insert(0, prod.price)
             self.prod_stock_entry.delete(0, 'end')
-            self.prod_stock_entry.insert(0, values[4])
-            self.prod_unit_var.set(values[5])
+            self.prod_stock_entry.insert(0, prod.stock)
+            self.prod_unit_var.set(prod.unit)
+            self.prod_reorder_entry.delete(0, 'end')
+            if prod.reorder_level is not None:
+                self.prod_reorder_entry.insert(0, prod.reorder_level)
     
     def clear_product_fields(self):
         self.prod_id_entry.delete(0, 'end')
@@ -667,19 +951,23 @@ class KabrajiShopSystem:
         self.prod_price_entry.delete(0, 'end')
         self.prod_stock_entry.delete(0, 'end')
         self.prod_unit_var.set('')
+        self.prod_reorder_entry.delete(0, 'end')
     
     def refresh_products_table(self):
-        for item in self.products_tree.get_children():
-            self.products_tree.delete(item)
-        
-        for prod_id, prod in self.products.items():
-            self.products_tree.insert('', 'end', values=(
-                prod_id, prod['name'], prod['category'], 
-                f"₹{prod['price']:.2f}", prod['stock'], prod['unit']
-            ))
+        self.products_table.set_rows(self.engine.products.items())
+    
+    def product_row(self, prod_id, prod):
+        return (prod_id, prod.name, prod.category,
+                f"₹{prod.price:.2f}", prod.stock, prod.unit, reorder_level(prod))
     
     def refresh_product_combo(self):
-        products_list = [f"{pid} - {p['name']}" for pid, p in self.products.items()]
+        """Fill the product combo with the matches for what has been typed"""
+        if self.sale_prod_combo is None:
+            return
+        # A picked "ID - name" entry searches by its ID
+        query = self.sale_prod_var.get().split(' - ')[0]
+        prod_ids = self.engine.search_products(query, COMBO_LIMIT)
+        products_list = [f"{pid} - {self.engine.products[pid].name}" for pid in prod_ids]
         self.sale_prod_combo['values'] = products_list
     
     # Customer functions
@@ -690,23 +978,12 @@ class KabrajiShopSystem:
         email = self.cust_email_entry.get().strip()
         address = self.cust_address_entry.get().strip()
         
-        if not all([cust_id, name, phone]):
-            messagebox.showerror("Error", "Please fill required fields (ID, Name, Phone)!")
-            return
-        
-        if cust_id in self.customers:
-            messagebox.showerror("Error", "Customer ID already exists!")
+        try:
+            self.engine.add_customer(cust_id, name, phone, email, address)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
             return
         
-        self.customers[cust_id] = {
-            'name': name,
-            'phone': phone,
-            'email': email,
-            'address': address
-        }
-        
-        self.save_data()
-        self.refresh_customers_table()
         self.refresh_customer_combo()
         
         self.cust_id_entry.delete(0, 'end')
@@ -718,34 +995,80 @@ class KabrajiShopSystem:
         messagebox.showinfo("Success", "Customer added successfully!")
     
     def delete_customer(self):
-        selected = self.customers_tree.selection()
+        selected = self.customers_table.selected_keys()
         if not selected:
             messagebox.showerror("Error", "Please select a customer!")
             return
         
-        cust_id = self.customers_tree.item(selected[0])['values'][0]
+        cust_id = selected[0]
         
         if messagebox.askyesno("Confirm", f"Delete customer {cust_id}?"):
-            del self.customers[cust_id]
-            self.save_data()
-            self.refresh_customers_table()
+            try:
+                self.engine.delete_customer(cust_id)
+            except ShopError as e:
+                messagebox.showerror("Error", str(e))
+                return
             self.refresh_customer_combo()
             messagebox.showinfo("Success", "Customer deleted successfully!")
     
     def refresh_customers_table(self):
-        for item in self.customers_tree.get_children():
-            self.customers_tree.delete(item)
-        
-        for cust_id, cust in self.customers.items():
-            self.customers_tree.insert('', 'end', values=(
-                cust_id, cust['name'], cust['phone'], 
-                cust['email'], cust['address']
-            ))
+        self.customers_table.set_rows(self.engine.customers.items())
+    
+    def customer_row(self, cust_id, cust):
+        return (cust_id, cust.name, cust.phone,
+                cust.email, cust.address)
     
     def refresh_customer_combo(self):
-        customers_list = [f"{cid} - {c['name']}" for cid, c in self.customers.items()]
+        """Fill the customer combo with the matches for what has been typed"""
+        if self.sale_cust_combo is None:
+            return
+        query = self.sale_cust_var.get().split(' - ')[0]
+        cust_ids = self.engine.search_customers(query, COMBO_LIMIT)
+        customers_list = [f"{cid} - {self.engine.customers[cid].name}" for cid in cust_ids]
         self.sale_cust_combo['values'] = customers_list
     
+    def schedule_search(self, event, name, callback):
+        """Debounce typing: run `callback` once the user pauses"""
+        if event.keysym in NAVIGATION_KEYS:
+            return
+        job = self.search_jobs.pop(name, None)
+        if job is not None:
+            self.root.after_cancel(job)
+        self.search_jobs[name] = self.root.after(SEARCH_DELAY_MS, callback)
+    
+    def select_customer(self, event):
+        selected = self.customers_table.selected_keys()
+        if selected:
+            self.show_customer_history(selected[0])
+    
+    def change_history_page(self, step):
+        if self.history_customer is not None:
+            self.show_customer_history(self.history_customer, self.history_page + step)
+    
+    def show_customer_history(self, cust_id, page=0):
+        """Show one page of a customer's orders (newest first) with their lifetime summary"""
+        page = max(0, page)
+        orders, pages = self.engine.customer_orders(cust_id, page)
+        if page >= pages:
+            page = pages - 1
+            orders, pages = self.engine.customer_orders(cust_id, page)
+        self.history_customer = cust_id
+        self.history_page = page
+        
+        for item in self.history_tree.get_children():
+            self.history_tree.delete(item)
+        for order in orders:
+            self.history_tree.insert('', 'end', iid=order.order_id, values=(
+                order.order_id, order.date, len(order.items), f"₹{order.net_total:.2f}", order.status))
+        self.history_page_label.config(text=f"Page {page + 1} of {pages}")
+        
+        summary = self.engine.customer_summary(cust_id)
+        last_visit = summary['last_visit'].strftime(DAY_FORMAT) if summary['last_visit'] else "Never"
+        top_items = ", ".join(f"{name} ({qty:g})" for name, qty, revenue in summary['top_items']) or "None"
+        self.history_summary_label.config(
+            text=f"Lifetime spend: ₹{summary['spend']:,.2f}   Orders: {summary['orders']}   "
+                 f"Last visit: {last_visit}\nTop items: {top_items}")
+    
     # Sales functions
     def add_to_cart(self):
         prod_str = self.sale_prod_var.get()
@@ -756,36 +1079,15 @@ class KabrajiShopSystem:
             messagebox.showerror("Error", "Please select product and enter quantity!")
             return
         
-        try:
-            qty = float(qty_str)
-            discount = float(discount_str)
-        except ValueError:
-            messagebox.showerror("Error", "Invalid quantity or discount!")
-            return
-        
         prod_id = prod_str.split(' - ')[0]
-        product = self.products[prod_id]
-        
-        if qty > product['stock']:
-            messagebox.showerror("Error", f"Insufficient stock! Available: {product['stock']}")
+        try:
+            item = self.sales.add_to_cart(prod_id, qty_str, discount_str)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
             return
         
-        price = product['price']
-        subtotal = price * qty
-        discount_amount = subtotal * (discount / 100)
-        total = subtotal - discount_amount
-        
-        self.cart_items.append({
-            'prod_id': prod_id,
-            'name': product['name'],
-            'qty': qty,
-            'price': price,
-            'discount': discount,
-            'total': total
-        })
-        
         self.cart_tree.insert('', 'end', values=(
-            product['name'], qty, f"₹{price:.2f}", f"{discount}%", f"₹{total:.2f}"
+            item.name, item.qty, f"₹{item.price:.2f}", f"{item.discount}%", f"₹{item.total:.2f}"
         ))
         
         self.update_invoice_summary()
@@ -800,89 +1102,73 @@ class KabrajiShopSystem:
             return
         
         index = self.cart_tree.index(selected[0])
-        self.cart_items.pop(index)
+        try:
+            self.sales.remove_from_cart(index)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
         self.cart_tree.delete(selected[0])
         self.update_invoice_summary()
     
     def update_invoice_summary(self):
-        subtotal = sum(item['qty'] * item['price'] for item in self.cart_items)
-        total_discount = sum(item['qty'] * item['price'] * (item['discount'] / 100) for item in self.cart_items)
-        after_discount = subtotal - total_discount
-        tax = after_discount * 0.18
-        total = after_discount + tax
+        summary = self.sales.cart_summary()
         
-        self.subtotal_label.config(text=f"Subtotal: ₹{subtotal:.2f}")
-        self.discount_label.config(text=f"Total Discount: ₹{total_discount:.2f}")
-        self.tax_label.config(text=f"GST (18%): ₹{tax:.2f}")
-        self.total_label.config(text=f"TOTAL: ₹{total:.2f}")
+        self.subtotal_label.config(text=f"Subtotal: ₹{summary['subtotal']:.2f}")
+        self.discount_label.config(text=f"Total Discount: ₹{summary['discount']:.2f}")
+        self.tax_label.config(text=f"GST: ₹{summary['tax']:.2f}")
+        self.total_label.config(text=f"TOTAL: ₹{summary['total']:.2f}")
     
     def clear_cart(self):
         if messagebox.askyesno("Confirm", "Clear all items from cart?"):
-            self.cart_items = []
+            try:
+                self.sales.clear_cart()
+            except ShopError as e:
+                messagebox.showerror("Error", str(e))
+                return
             for item in self.cart_tree.get_children():
                 self.cart_tree.delete(item)
             self.update_invoice_summary()
     
     def generate_invoice(self):
-        if not self.cart_items:
-            messagebox.showerror("Error", "Cart is empty!")
+        cust_str = self.sale_cust_var.get()
+        cust_id = cust_str.split(' - ')[0] if cust_str else ''
+        
+        try:
+            self.sales.checkout(cust_id, on_committed=self.on_order_committed)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
             return
         
-        cust_str = self.sale_cust_var.get()
-        if not cust_str:
-            messagebox.showerror("Error", "Please select a customer!")
+        # Clear cart; the invoice is shown once the order is safely on disk
+        for item in self.cart_tree.get_children():
+            self.cart_tree.delete(item)
+        self.update_invoice_summary()
+    
+    def on_order_committed(self, order, error):
+        """Durability barrier: the sale only counts once its commit is confirmed"""
+        if error is not None:
+            # The engine has already taken the order back out and restocked its items
+            messagebox.showerror("Error", f"Order {order.order_id} could not be saved and was not placed: {error}")
             return
         
-        cust_id = cust_str.split(' - ')[0]
-        customer = self.customers[cust_id]
-        
-        # Calculate totals
-        subtotal = sum(item['qty'] * item['price'] for item in self.cart_items)
-        total_discount = sum(item['qty'] * item['price'] * (item['discount'] / 100) for item in self.cart_items)
-        after_discount = subtotal - total_discount
-        tax = after_discount * 0.18
-        total = after_discount + tax
-        
-        # Generate order ID
-        order_id = f"ORD{len(self.orders) + 1:05d}"
-        
-        # Create order
-        order = {
-            'order_id': order_id,
-            'customer_id': cust_id,
-            'customer_name': customer['name'],
-            'date': datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-            'items': self.cart_items.copy(),
-            'subtotal': subtotal,
-            'discount': total_discount,
-            'tax': tax,
-            'total': total,
-            'status': 'Pending'
-        }
-        
-        self.orders.append(order)
-        self.sales_history.append({
-            'date': datetime.now().strftime("%d/%m/%Y"),
-            'order_id': order_id,
-            'customer': customer['name'],
-            'total': total
-        })
-        
-        # Update stock
-        for item in self.cart_items:
-            self.products[item['prod_id']]['stock'] -= item['qty']
-        
-        self.save_data()
-        self.refresh_products_table()
-        self.refresh_orders_table()
+        if self.terminal is not None:
+            # Pick up the stock left after this and other terminals' sales
+            try:
+                self.engine.reload_catalog()
+            except ShopError:
+                pass
         
-        # Generate invoice text
-        invoice_text = self.create_invoice_text(order, customer)
+        self.io.submit(self.engine.save_invoice, order,
+                       callback=lambda job: self.show_invoice(order, job))
+    
+    def show_invoice(self, order, job):
+        if job.error is not None:
+            messagebox.showerror("Error", f"Invoice file could not be written: {job.error}")
+            return
         
-        # Save invoice
-        filename = f"invoice_{order_id}.txt"
-        with open(filename, 'w') as f:
-            f.write(invoice_text)
+        order_id = order.order_id
+        filename = job.result
+        invoice_text = self.engine.create_invoice_text(order, invoices.customer_for(order, self.engine.customers))
         
         # Show invoice
         invoice_window = tk.Toplevel(self.root)
@@ -894,184 +1180,278 @@ class KabrajiShopSystem:
         text_widget.insert('1.0', invoice_text)
         text_widget.config(state='disabled')
         
-        tk.Button(invoice_window, text="Print/Save Invoice", 
+        tk.Button(invoice_window, text="Print/Save Invoice",
                  command=lambda: messagebox.showinfo("Saved", f"Invoice saved as {filename}"),
                  bg="#4CAF50", fg="white", font=("Arial", 11, "bold"), padx=20, pady=10).pack(pady=10)
         
-        # Clear cart
-        self.cart_items = []
-        for item in self.cart_tree.get_children():
-            self.cart_tree.delete(item)
-        self.update_invoice_summary()
-        
         messagebox.showinfo("Success", f"Invoice {order_id} generated successfully!")
     
-    def create_invoice_text(self, order, customer):
-        invoice = "=" * 70 + "\n"
-        invoice += " " * 20 + "🏗️ KABRAJI\n"
-        invoice += " " * 10 + "Building Dreams, One Product at a Time\n"
-        invoice += " " * 8 + "Quality Paints, Sanitary & Building Materials\n"
-        invoice += "=" * 70 + "\n\n"
-        invoice += f"INVOICE NO: {order['order_id']}\n"
-        invoice += f"DATE: {order['date']}\n"
-        invoice += "-" * 70 + "\n\n"
-        invoice += "CUSTOMER DETAILS:\n"
-        invoice += f"Name: {customer['name']}\n"
-        invoice += f"Phone: {customer['phone']}\n"
-        invoice += f"Email: {customer['email']}\n"
-        invoice += f"Address: {customer['address']}\n"
-        invoice += "\n" + "=" * 70 + "\n"
-        invoice += f"{'ITEM':<30} {'QTY':<8} {'PRICE':<12} {'DISC%':<8} {'TOTAL':<12}\n"
-        invoice += "=" * 70 + "\n"
-        
-        for item in order['items']:
-            invoice += f"{item['name']:<30} {item['qty']:<8.2f} ₹{item['price']:<10.2f} {item['discount']:<7.1f}% ₹{item['total']:<10.2f}\n"
-        
-        invoice += "=" * 70 + "\n"
-        invoice += f"{'':<50} Subtotal: ₹{order['subtotal']:>12.2f}\n"
-        invoice += f"{'':<50} Discount: ₹{order['discount']:>12.2f}\n"
-        invoice += f"{'':<50} GST (18%): ₹{order['tax']:>12.2f}\n"
-        invoice += "-" * 70 + "\n"
-        invoice += f"{'':<50} TOTAL: ₹{order['total']:>12.2f}\n"
-        invoice += "=" * 70 + "\n\n"
-        invoice += "Thank you for your business!\n"
-        invoice += "For queries: contact@kabraji.com | Phone: +91-XXXXXXXXXX\n"
-        invoice += "=" * 70 + "\n"
-        
-        return invoice
-    
     # Order functions
     def refresh_orders_table(self):
-        for item in self.orders_tree.get_children():
-            self.orders_tree.delete(item)
-        
-        for order in self.orders:
-            self.orders_tree.insert('', 'end', values=(
-                order['order_id'],
-                order['customer_name'],
-                order['date'],
-                len(order['items']),
-                f"₹{order['total']:.2f}",
-                order['status']
-            ))
+        self.orders_table.set_rows((order.order_id, order) for order in self.engine.orders)
+    
+    def order_row(self, order_id, order):
+        return (order_id,
+                order.customer_name,
+                order.date,
+                len(order.items),
+                f"₹{order.net_total:.2f}" + (" (returns)" if order.returns else ""),
+                order.status)
     
     def update_order_status(self, status):
-        selected = self.orders_tree.selection()
+        selected = self.orders_table.selected_keys()
         if not selected:
             messagebox.showerror("Error", "Please select an order!")
             return
         
-        order_id = self.orders_tree.item(selected[0])['values'][0]
+        order_id = selected[0]
         
-        for order in self.orders:
-            if order['order_id'] == order_id:
-                order['status'] = status
-                break
+        try:
+            self.engine.update_order_status(order_id, status)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
         
-        self.save_data()
-        self.refresh_orders_table()
         messagebox.showinfo("Success", f"Order status updated to {status}!")
     
-    # Report functions
-    def generate_report(self):
-        self.report_text.delete('1.0', 'end')
-        
-        report = "=" * 80 + "\n"
-        report += " " * 25 + "KABRAJI SALES REPORT\n"
-        report += "=" * 80 + "\n\n"
-        report += f"Generated on: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n\n"
-        
-        # Total sales
-        total_revenue = sum(sale['total'] for sale in self.sales_history)
-        report += f"TOTAL REVENUE: ₹{total_revenue:,.2f}\n"
-        report += f"TOTAL ORDERS: {len(self.orders)}\n"
-        report += f"TOTAL CUSTOMERS: {len(self.customers)}\n\n"
-        
-        # Sales by category
-        report += "-" * 80 + "\n"
-        report += "SALES BY CATEGORY:\n"
-        report += "-" * 80 + "\n"
-        
-        category_sales = defaultdict(float)
-        for order in self.orders:
-            for item in order['items']:
-                prod = self.products[item['prod_id']]
-                category_sales[prod['category']] += item['total']
-        
-        for category, amount in category_sales.items():
-            report += f"{category:<30} ₹{amount:>15,.2f}\n"
+    def return_items(self):
+        selected = self.orders_table.selected_keys()
+        if not selected:
+            messagebox.showerror("Error", "Please select an order!")
+            return
         
-        report += "\n"
+        order = self.engine.get_order(selected[0])
+        if order.status == 'Cancelled':
+            messagebox.showerror("Error", "Items of a cancelled order cannot be returned!")
+            return
         
-        # Top products
-        report += "-" * 80 + "\n"
-        report += "TOP 10 SELLING PRODUCTS:\n"
-        report += "-" * 80 + "\n"
+        window = tk.Toplevel(self.root)
+        window.title(f"Return Items - {order.order_id}")
+        window.transient(self.root)
+        
+        tk.Label(window, text="Quantity returned per item:", font=("Arial", 11, "bold")).grid(
+            row=0, column=0, columnspan=3, padx=10, pady=10, sticky='w')
+        entries = {}
+        for line, (item, qty, _) in enumerate(order.net_items()):
+            tk.Label(window, text=item.name, font=("Arial", 10)).grid(row=line + 1, column=0, padx=10, sticky='w')
+            tk.Label(window, text=f"of {qty:g}", font=("Arial", 10), fg="gray").grid(row=line + 1, column=2, padx=10)
+            if qty > 0:
+                entries[line] = tk.Entry(window, width=8, font=("Arial", 10))
+                entries[line].grid(row=line + 1, column=1, padx=5, pady=2)
+        
+        def confirm():
+            quantities = {line: entry.get().strip() for line, entry in entries.items()}
+            try:
+                ret = self.engine.return_items(order.order_id, quantities)
+            except ShopError as e:
+                messagebox.showerror("Error", str(e), parent=window)
+                return
+            window.destroy()
+            messagebox.showinfo("Success", f"Refund of ₹{ret['total']:.2f} recorded for {order.order_id}!")
+        
+        tk.Button(window, text="Record Return", command=confirm,
+                 bg="#9C27B0", fg="white", font=("Arial", 10, "bold"), padx=15).grid(
+            row=len(order.items) + 1, column=0, columnspan=3, pady=10)
+    
+    # Report functions
+    def generate_report(self):
+        try:
+            date_from = self.parse_report_date(self.report_from_entry.get())
+            date_to = self.parse_report_date(self.report_to_entry.get())
+            lines = self.engine.report_lines(date_from, date_to)
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
         
-        product_sales = defaultdict(lambda: {'qty': 0, 'revenue': 0})
-        for order in self.orders:
-            for item in order['items']:
-                product_sales[item['name']]['qty'] += item['qty']
-                product_sales[item['name']]['revenue'] += item['total']
+        # Replace any report still streaming in
+        if self.report_job is not None:
+            self.root.after_cancel(self.report_job)
+        self.report_text.delete('1.0', 'end')
+        self.stream_report(lines)
+    
+    def stream_report(self, lines):
+        """Insert the next chunk of report lines, then yield to the event loop"""
+        chunk = ''.join(islice(lines, REPORT_CHUNK_LINES))
+        if not chunk:
+            self.report_job = None
+            return
+        self.report_text.insert('end', chunk)
+        self.report_job = self.root.after(1, self.stream_report, lines)
+    
+    def stock_on_date(self):
+        """Show every product's stock at the end of the To date, read from the stock ledger"""
+        try:
+            day = self.parse_report_date(self.report_to_entry.get()) or datetime.now().date()
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
         
-        sorted_products = sorted(product_sales.items(), key=lambda x: x[1]['revenue'], reverse=True)[:10]
+        levels = self.engine.stock_as_of(day)
+        lines = ["=" * 70 + "\n",
+                 f"STOCK ON {day.strftime(DAY_FORMAT)} (end of day)\n",
+                 "=" * 70 + "\n",
+                 f"{'ID':<10} {'PRODUCT':<30} {'THEN':>12} {'NOW':>12}\n",
+                 "-" * 70 + "\n"]
+        for prod_id in sorted(levels):
+            prod = self.engine.products.get(prod_id)
+            name = prod.name if prod else "(deleted)"
+            now = f"{prod.stock:.2f}" if prod else "-"
+            lines.append(f"{prod_id:<10} {name[:30]:<30} {levels[prod_id]:>12.2f} {now:>12}\n")
+        
+        if self.report_job is not None:
+            self.root.after_cancel(self.report_job)
+        self.report_text.delete('1.0', 'end')
+        self.stream_report(iter(lines))
+    
+    def parse_report_date(self, text):
+        """Parse a DD/MM/YYYY filter entry; blank means no limit"""
+        text = text.strip()
+        if not text:
+            return None
+        try:
+            return datetime.strptime(text, DAY_FORMAT).date()
+        except ValueError:
+            raise ShopError(f"Invalid date '{text}'! Use DD/MM/YYYY.")
+    
+    def export_report(self):
+        try:
+            date_from = self.parse_report_date(self.report_from_entry.get())
+            date_to = self.parse_report_date(self.report_to_entry.get())
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
         
-        for i, (prod_name, data) in enumerate(sorted_products, 1):
-            report += f"{i}. {prod_name:<40} Qty: {data['qty']:>8.2f}  Revenue: ₹{data['revenue']:>12,.2f}\n"
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".txt",
+            filetypes=[("Text files", "*.txt"), ("All files", "*.*")],
+            initialfile=f"kabraji_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        )
         
-        report += "\n"
+        if filename:
+            try:
+                self.engine.export_report(filename, date_from, date_to)
+            except ShopError as e:
+                messagebox.showerror("Error", str(e))
+                return
+            messagebox.showinfo("Success", f"Report exported to {filename}!")
+    
+    def export_invoices(self):
+        """Batch export invoices for the report date range without blocking the UI"""
+        try:
+            date_from = self.parse_report_date(self.report_from_entry.get())
+            date_to = self.parse_report_date(self.report_to_entry.get())
+        except ShopError as e:
+            messagebox.showerror("Error", str(e))
+            return
         
-        # Low stock alert
-        report += "-" * 80 + "\n"
-        report += "LOW STOCK ALERT (Stock < 10):\n"
-        report += "-" * 80 + "\n"
+        filename = filedialog.asksaveasfilename(
+            defaultextension=".zip",
+            filetypes=[("Zip archives", "*.zip"), ("All files", "*.*")],
+            initialfile=f"kabraji_invoices_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        )
         
-        low_stock_items = [(pid, p) for pid, p in self.products.items() if p['stock'] < 10]
+        if filename:
+            # Copied here so the worker never walks orders the UI is changing
+            orders, customers = self.engine.invoice_batch(date_from, date_to)
+            # Own worker, so a long export never holds up order saves
+            self.exports.submit(invoices.export_invoices, orders, customers, filename,
+                                callback=lambda job: self.invoices_exported(filename, job))
+    
+    def invoices_exported(self, filename, job):
+        if job.error is not None:
+            messagebox.showerror("Error", f"Invoice export failed: {job.error}")
+            return
         
-        if low_stock_items:
-            for prod_id, prod in low_stock_items:
-                report += f"{prod_id} - {prod['name']:<40} Stock: {prod['stock']} {prod['unit']}\n"
-        else:
-            report += "No low stock items!\n"
+        stats = job.result
+        messagebox.showinfo("Success", f"Exported {stats['invoices']} invoices to {filename} "
+                                       f"in {stats['seconds']:.1f}s ({stats['per_second']:.0f} invoices/s)")
+    
+    # Bulk import/export
+    def import_collection(self, collection):
+        """Upsert products or customers from a CSV or JSONL file"""
+        filename = filedialog.askopenfilename(
+            filetypes=[("CSV or JSONL files", "*.csv *.jsonl"), ("All files", "*.*")]
+        )
+        if not filename:
+            return
         
-        report += "\n" + "=" * 80 + "\n"
+        try:
+            stats = bulk.import_file(self.engine, collection, filename)
+        except (ValueError, OSError) as e:
+            messagebox.showerror("Error", f"Import failed: {e}")
+            return
         
-        self.report_text.insert('1.0', report)
+        message = (f"{stats['added']} added, {stats['updated']} updated, {len(stats['problems'])} skipped "
+                   f"in {stats['seconds']:.1f}s ({stats['per_second']:.0f} rows/s)")
+        if stats['problems']:
+            message += "\n\n" + "\n".join(stats['problems'][:10])
+            if len(stats['problems']) > 10:
+                message += f"\n... and {len(stats['problems']) - 10} more"
+        messagebox.showinfo("Import", message)
     
-    def export_report(self):
+    def export_collection(self, collection):
+        """Write a collection to a CSV or JSONL file without blocking the UI"""
         filename = filedialog.asksaveasfilename(
-            defaultextension=".txt",
-            filetypes=[("Text files", "*.txt"), ("All files", "*.*")],
-            initialfile=f"kabraji_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+            defaultextension=".csv",
+            filetypes=[("CSV files", "*.csv"), ("JSONL files", "*.jsonl")],
+            initialfile=f"kabraji_{collection}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
         )
+        if not filename:
+            return
         
-        if filename:
-            with open(filename, 'w') as f:
-                f.write(self.report_text.get('1.0', 'end'))
-            messagebox.showinfo("Success", f"Report exported to {filename}!")
+        # Taken here so the worker never walks a collection the UI is changing
+        items = bulk.collection_items(self.engine, collection)
+        self.exports.submit(bulk.export_file, items, collection, filename,
+                            callback=lambda job: self.collection_exported(filename, job))
     
-    # Data persistence
-    def save_data(self):
-        data = {
-            'products': self.products,
-            'customers': self.customers,
-            'orders': self.orders,
-            'sales_history': self.sales_history
-        }
-        with open('kabraji_data.json', 'w') as f:
-            json.dump(data, f, indent=2)
-    
-    def load_data(self):
-        if os.path.exists('kabraji_data.json'):
-            try:
-                with open('kabraji_data.json', 'r') as f:
-                    data = json.load(f)
-                    self.products = data.get('products', {})
-                    self.customers = data.get('customers', {})
-                    self.orders = data.get('orders', [])
-                    self.sales_history = data.get('sales_history', [])
-            except:
-                pass
+    def collection_exported(self, filename, job):
+        if job.error is not None:
+            messagebox.showerror("Error", f"Export failed: {job.error}")
+            return
+        
+        stats = job.result
+        messagebox.showinfo("Success", f"Exported {stats['rows']} rows to {filename} "
+                                       f"in {stats['seconds']:.1f}s ({stats['per_second']:.0f} rows/s)")
+    
+    def on_data_changed(self, collection, action, key, record):
+        """Engine observer: apply one row-level change to the matching table"""
+        table = {
+            'products': self.products_table,
+            'customers': self.customers_table,
+            'orders': self.orders_table,
+        }.get(collection)
+        if table is not None:
+            if action == 'added':
+                table.insert_row(key, record)
+            elif action == 'updated':
+                table.update_row(key, record)
+            elif action == 'deleted':
+                table.delete_row(key)
+            elif action == 'reset':
+                table.set_rows(record)
+        
+        # Keep an open purchase history in step with its customer's orders
+        if collection == 'orders' and self.history_customer is not None:
+            if action in ('reset', 'deleted') or record.customer_id == self.history_customer:
+                self.show_customer_history(self.history_customer, self.history_page)
+        self.update_dashboard()
+    
+    def poll_io(self):
+        """Hand finished background writes and terminals' requests to the UI thread"""
+        self.io.poll()
+        self.exports.poll()
+        if self.server is not None:
+            self.server.poll()
+        self.root.after(IO_POLL_MS, self.poll_io)
+    
+    def on_close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.engine.close()
+        self.io.stop()
+        self.exports.stop()
+        self.root.destroy()
 
 if __name__ == "__main__":
     root = tk.Tk()
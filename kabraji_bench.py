@@ -0,0 +1,263 @@
+"""Benchmarks for the KABRAJI hot paths on synthetic data.
+
+Usage:
+    python kabraji_bench.py                       # default sizes
+    python kabraji_bench.py --sizes 100000x1000000 --output bench.jsonl
+
+Each size is PRODUCTSxORDERS. Results are printed as one JSON object per
+line (benchmark, products, customers, orders, best/mean seconds) so runs
+can be compared by scripts.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import kabraji_money as money
+import kabraji_storage as storage
+from kabraji_engine import DEFAULT_PRODUCTS, ShopEngine
+
+DEFAULT_SIZES = "1000x10000,10000x100000"
+
+UNITS_BY_CATEGORY = {
+    "Paints": ["Liter"],
+    "Sanitary": ["Piece"],
+    "Building Materials": ["Bag", "Kg", "Piece", "Ton", "Meter"],
+}
+STATUSES = ["Pending", "Completed", "Completed", "Completed", "Cancelled"]
+
+
+# Synthetic data
+def generate_products(count, rng):
+    """Catalog shaped like the default products, with PRODnnnn ids"""
+    products = {}
+    for idx in range(1, count + 1):
+        base = rng.choice(DEFAULT_PRODUCTS)
+        products[f"PROD{idx:04d}"] = {
+            'name': f"{base['name']} #{idx}",
+            'category': base['category'],
+            'price': round(base['price'] * rng.uniform(0.5, 1.5), 2),
+            'stock': rng.randint(0, 1000),
+            'unit': rng.choice(UNITS_BY_CATEGORY[base['category']]),
+        }
+    return products
+
+
+def generate_customers(count, rng):
+    customers = {}
+    for idx in range(1, count + 1):
+        customers[f"CUST{idx:05d}"] = {
+            'name': f"Customer {idx}",
+            'phone': f"9{rng.randint(100000000, 999999999)}",
+            'email': f"customer{idx}@example.com",
+            'address': f"{rng.randint(1, 999)} Market Road",
+        }
+    return customers
+
+
+def generate_orders(count, products, customers, rng, days=730):
+    """Orders and sales history shaped like ShopEngine.checkout output"""
+    prod_ids = list(products)
+    cust_ids = list(customers)
+    start = datetime.now() - timedelta(days=days)
+    step = days * 86400 / max(count, 1)
+    orders = []
+    sales_history = []
+    for idx in range(1, count + 1):
+        when = start + timedelta(seconds=idx * step)
+        cust_id = rng.choice(cust_ids)
+        items = []
+        totals = money.CartTotals()
+        for prod_id in rng.sample(prod_ids, min(len(prod_ids), rng.randint(1, 5))):
+            product = products[prod_id]
+            qty = float(rng.randint(1, 20))
+            discount = float(rng.choice([0, 0, 0, 5, 10]))
+            rate = money.gst_rate(product['category'])
+            gross, off, tax = money.line_amounts(qty, product['price'], discount, rate)
+            items.append({
+                'prod_id': prod_id,
+                'name': product['name'],
+                'qty': qty,
+                'price': product['price'],
+                'discount': discount,
+                'total': money.to_rupees(gross - off),
+                'gst_rate': rate,
+                'tax': money.to_rupees(tax)
+            })
+            totals.add((gross, off, tax))
+        order_id = f"ORD{idx:05d}"
+        orders.append({
+            'order_id': order_id,
+            'customer_id': cust_id,
+            'customer_name': customers[cust_id]['name'],
+            'date': when.strftime("%d/%m/%Y %H:%M:%S"),
+            'items': items,
+            **totals.summary(),
+            'status': rng.choice(STATUSES)
+        })
+        sales_history.append({
+            'date': when.strftime("%d/%m/%Y"),
+            'order_id': order_id,
+            'customer': customers[cust_id]['name'],
+            'total': money.to_rupees(totals.total)
+        })
+    return orders, sales_history
+
+
+def generate_state(n_products, n_orders, n_customers=None, seed=42):
+    rng = random.Random(seed)
+    n_customers = n_customers or max(10, n_orders // 20)
+    products = generate_products(n_products, rng)
+    customers = generate_customers(n_customers, rng)
+    orders, sales_history = generate_orders(n_orders, products, customers, rng)
+    return {'products': products, 'customers': customers,
+            'orders': orders, 'sales_history': sales_history}
+
+
+# Benchmarks
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+
+def make_engine(workdir, backend):
+    if backend == 'sqlite':
+        backend_storage = storage.SQLiteStorage(os.path.join(workdir, storage.DB_FILE))
+    else:
+        backend_storage = storage.JournalStorage(
+            data_file=os.path.join(workdir, storage.DATA_FILE),
+            journal_file=os.path.join(workdir, storage.JOURNAL_FILE))
+    return ShopEngine(backend_storage)
+
+
+def bench_size(n_products, n_orders, repeat, backend, tk_root=None):
+    state = generate_state(n_products, n_orders)
+    counts = {key: len(state[key]) for key in ('products', 'customers', 'orders')}
+    workdir = tempfile.mkdtemp(prefix='kabraji_bench_')
+    results = {}
+    try:
+        engine = make_engine(workdir, backend)
+        engine.replace_data(state)
+
+        results['save_data'] = timed(engine.save_data, repeat)
+
+        def load():
+            fresh = make_engine(workdir, backend)
+            fresh.load_data()
+            fresh.close()
+        results['load_data'] = timed(load, repeat)
+
+        results['generate_report'] = timed(engine.generate_report, repeat)
+
+        last_day = engine.date_index.days[-1]
+        results['generate_report_one_day'] = timed(
+            lambda: engine.generate_report(last_day, last_day), repeat)
+        results['dashboard_metrics'] = timed(engine.dashboard_metrics, repeat)
+
+        cust_id = next(iter(engine.customers))
+        # Real quantities, so the stock, low-stock and ledger updates are timed too
+        prod_ids = sorted(engine.products, key=lambda prod_id: engine.products[prod_id].stock)[-2:]
+
+        def checkout():
+            engine.add_to_cart(prod_ids[0], 1)
+            engine.add_to_cart(prod_ids[1], 1)
+            engine.checkout(cust_id)
+        results['checkout'] = timed(checkout, repeat)
+
+        results['refresh_orders_table'] = bench_orders_table(engine, tk_root, repeat)
+        engine.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for name, timing in results.items():
+        if timing is None:
+            continue
+        yield {
+            'benchmark': name,
+            'backend': backend,
+            'products': counts['products'],
+            'customers': counts['customers'],
+            'orders': counts['orders'],
+            'repeat': repeat,
+            'best_s': round(timing[0], 6),
+            'mean_s': round(timing[1], 6),
+        }
+
+
+def bench_orders_table(engine, tk_root, repeat):
+    """Time the Orders tab refresh against a real Treeview when a display exists"""
+    if tk_root is None:
+        return None
+    import tkinter as tk
+    from tkinter import ttk
+    from kabraji import KabrajiShopSystem, VirtualTreeview
+
+    tree = ttk.Treeview(tk_root, columns=("Order ID", "Customer", "Date", "Items", "Total", "Status"),
+                        show='headings', height=20)
+    scrollbar = tk.Scrollbar(tk_root)
+    host = KabrajiShopSystem.__new__(KabrajiShopSystem)
+    host.engine = engine
+    host.orders_tree = tree
+    host.orders_table = VirtualTreeview(tree, scrollbar, host.order_row)
+    timing = timed(host.refresh_orders_table, repeat)
+    tree.destroy()
+    scrollbar.destroy()
+    return timing
+
+
+def open_tk_root():
+    try:
+        import tkinter as tk
+        root = tk.Tk()
+        root.withdraw()
+        return root
+    except Exception:
+        return None
+
+
+def parse_sizes(text):
+    sizes = []
+    for part in text.split(','):
+        n_products, n_orders = part.lower().split('x')
+        sizes.append((int(n_products), int(n_orders)))
+    return sizes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark KABRAJI hot paths on synthetic data")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="comma separated PRODUCTSxORDERS list (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, best is reported")
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--no-ui', action='store_true', help="skip Treeview benchmarks")
+    parser.add_argument('--output', help="also append JSON lines to this file")
+    args = parser.parse_args(argv)
+
+    tk_root = None if args.no_ui else open_tk_root()
+    out = open(args.output, 'a') if args.output else None
+    try:
+        for n_products, n_orders in parse_sizes(args.sizes):
+            for result in bench_size(n_products, n_orders, args.repeat, args.backend, tk_root):
+                line = json.dumps(result)
+                print(line)
+                sys.stdout.flush()
+                if out:
+                    out.write(line + '\n')
+    finally:
+        if out:
+            out.close()
+        if tk_root is not None:
+            tk_root.destroy()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Bulk import and export of shop data as CSV or JSONL.
+
+Usage:
+    python kabraji_bulk.py import products supplier_prices.csv
+    python kabraji_bulk.py export orders orders.jsonl
+
+The format follows the file extension. CSV files have a header row naming
+the columns; JSONL files have one JSON object per line. Files are read and
+written a row at a time, so large files never have to fit in memory.
+Imports upsert products or customers: existing ids are updated (blank
+columns keep their current value) and new ids are added.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+from kabraji_engine import ShopError
+
+IMPORT_COLLECTIONS = ('products', 'customers')
+EXPORT_COLLECTIONS = ('products', 'customers', 'orders', 'sales_history')
+
+# Columns per collection; keyed collections start with their id column
+COLUMNS = {
+    'products': ('prod_id', 'name', 'category', 'price', 'stock', 'unit', 'reorder_level'),
+    'customers': ('cust_id', 'name', 'phone', 'email', 'address'),
+    # Orders go to CSV one row per item, repeating the order's own columns
+    'orders': ('order_id', 'customer_id', 'customer_name', 'date', 'status', 'subtotal',
+               'discount', 'tax', 'total', 'prod_id', 'name', 'category', 'qty', 'price',
+               'item_discount', 'item_total'),
+    'sales_history': ('date', 'order_id', 'customer', 'total', 'kind'),
+}
+
+
+def file_format(path):
+    """'csv' or 'jsonl', from the file extension"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in ('.csv', '.jsonl'):
+        raise ShopError("Please choose a .csv or .jsonl file!")
+    return ext[1:]
+
+
+def read_rows(path, problems):
+    """Yield (row_no, fields) for each row of a CSV or JSONL file.
+
+    JSONL lines that are not valid JSON objects are skipped and described
+    in problems.
+    """
+    if file_format(path) == 'csv':
+        # utf-8-sig drops the byte order mark spreadsheet programs write
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for row_no, row in enumerate(csv.DictReader(f), 2):
+                yield row_no, row
+        return
+
+    with open(path, encoding='utf-8') as f:
+        for row_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                problems.append(f"Row {row_no}: not valid JSON ({e})")
+                continue
+            if not isinstance(row, dict):
+                problems.append(f"Row {row_no}: not a JSON object")
+                continue
+            yield row_no, row
+
+
+def import_file(engine, collection, path):
+    """Upsert a collection from a file in one commit.
+
+    Returns the engine's counts and problems plus the rows read, elapsed
+    seconds and rows per second.
+    """
+    if collection not in IMPORT_COLLECTIONS:
+        raise ShopError(f"Cannot import {collection}!")
+    start = time.perf_counter()
+    problems = []
+    result = engine.import_records(collection, read_rows(path, problems))
+    elapsed = time.perf_counter() - start
+
+    result['problems'] = problems + result['problems']
+    result['rows'] += len(problems)
+    result['seconds'] = elapsed
+    result['per_second'] = result['rows'] / elapsed if elapsed else 0.0
+    return result
+
+
+def collection_items(engine, collection):
+    """A collection's contents, taken in one step so they can be exported on another thread"""
+    if collection in ('products', 'customers'):
+        return list(getattr(engine, collection).items())
+    if collection == 'orders':
+        return list(engine.orders)
+    return list(engine.sales_history)
+
+
+def _records(collection, items):
+    if collection in ('products', 'customers'):
+        key_col = COLUMNS[collection][0]
+        for key, model in items:
+            record = {key_col: key}
+            record.update(model.to_record())
+            yield record
+    elif collection == 'orders':
+        for order in items:
+            yield order.to_record()
+    else:
+        yield from items
+
+
+def _csv_rows(collection, records):
+    if collection != 'orders':
+        yield from records
+        return
+    for order in records:
+        items = order.pop('items')
+        for item in items:
+            row = dict(order)
+            row.update(prod_id=item['prod_id'], name=item['name'], category=item.get('category'),
+                       qty=item['qty'], price=item['price'], item_discount=item['discount'],
+                       item_total=item['total'])
+            yield row
+
+
+def export_file(items, collection, path):
+    """Write collection_items() to a CSV or JSONL file; returns rows, seconds and rows/s"""
+    if collection not in EXPORT_COLLECTIONS:
+        raise ShopError(f"Cannot export {collection}!")
+    fmt = file_format(path)
+    start = time.perf_counter()
+    count = 0
+    records = _records(collection, items)
+
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            # Fields a model keeps in `extra` have no column and are left out
+            writer = csv.DictWriter(f, COLUMNS[collection], extrasaction='ignore')
+            writer.writeheader()
+            for row in _csv_rows(collection, records):
+                writer.writerow(row)
+                count += 1
+        else:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+
+    elapsed = time.perf_counter() - start
+    return {'rows': count, 'seconds': elapsed, 'per_second': count / elapsed if elapsed else 0.0}
+
+
+def main(argv=None):
+    from kabraji_engine import ShopEngine
+
+    parser = argparse.ArgumentParser(description="Bulk import or export KABRAJI data")
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('collection', choices=EXPORT_COLLECTIONS)
+    parser.add_argument('file', help="a .csv or .jsonl file")
+    args = parser.parse_args(argv)
+
+    engine = ShopEngine()
+    engine.load_data()
+    try:
+        if args.action == 'import':
+            stats = import_file(engine, args.collection, args.file)
+            print(f"Imported {args.collection}: {stats['added']} added, {stats['updated']} updated, "
+                  f"{len(stats['problems'])} skipped in {stats['seconds']:.2f}s "
+                  f"({stats['per_second']:.0f} rows/s)")
+            for problem in stats['problems']:
+                print("  " + problem)
+        else:
+            stats = export_file(collection_items(engine, args.collection), args.collection, args.file)
+            print(f"Exported {stats['rows']} {args.collection} rows in {stats['seconds']:.2f}s "
+                  f"({stats['per_second']:.0f} rows/s)")
+    except ShopError as e:
+        parser.exit(1, f"Error: {e}\n")
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1935 @@
+import bisect
+import gc
+import heapq
+import math
+from array import array
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+from itertools import compress, islice
+
+import kabraji_invoices as invoices
+import kabraji_models as models
+import kabraji_money as money
+import kabraji_storage as storage
+
+DATE_FORMAT = "%d/%m/%Y %H:%M:%S"
+DAY_FORMAT = "%d/%m/%Y"
+
+# Products with stock below their reorder level count as low stock; this is
+# the level of products that do not set their own
+LOW_STOCK_LEVEL = 10
+
+# Reorder suggestions use sales over this many days and order enough for this many more
+REORDER_WINDOW_DAYS = 30
+REORDER_COVER_DAYS = 14
+
+# Kinds of stock movement recorded in the ledger
+STOCK_MOVE_KINDS = ('sale', 'adjustment', 'cancellation', 'return', 'receipt')
+
+# A product's balance is checkpointed every this many of its movements
+LEDGER_CHECKPOINT_EVERY = 64
+
+# Share of a collection an import may change before its search index is
+# rebuilt instead of updated row by row (each row costs about a thousandth
+# of a rebuild at 100k records)
+SEARCH_REBUILD_SHARE = 0.02
+
+# Orders per page in a customer's purchase history
+HISTORY_PAGE_SIZE = 20
+
+# Cart used when no terminal is named (the app's own cart)
+LOCAL_TERMINAL = 'local'
+
+DEFAULT_PRODUCTS = [
+    # Paints
+    {"name": "Asian Paints Royale", "category": "Paints", "price": 450.0, "stock": 50, "unit": "Liter"},
+    {"name": "Berger Weather Coat", "category": "Paints", "price": 420.0, "stock": 40, "unit": "Liter"},
+    {"name": "Nerolac Excel", "category": "Paints", "price": 380.0, "stock": 60, "unit": "Liter"},
+    {"name": "Dulux Premium", "category": "Paints", "price": 500.0, "stock": 30, "unit": "Liter"},
+    {"name": "Paint Primer", "category": "Paints", "price": 250.0, "stock": 45, "unit": "Liter"},
+
+    # Sanitary
+    {"name": "Hindware Toilet Seat", "category": "Sanitary", "price": 3500.0, "stock": 20, "unit": "Piece"},
+    {"name": "Jaquar Basin Tap", "category": "Sanitary", "price": 1200.0, "stock": 35, "unit": "Piece"},
+    {"name": "Cera Wash Basin", "category": "Sanitary", "price": 2800.0, "stock": 15, "unit": "Piece"},
+    {"name": "Parryware Commode", "category": "Sanitary", "price": 4500.0, "stock": 12, "unit": "Piece"},
+    {"name": "Shower Head Premium", "category": "Sanitary", "price": 800.0, "stock": 40, "unit": "Piece"},
+
+    # Building Materials
+    {"name": "Cement - UltraTech", "category": "Building Materials", "price": 380.0, "stock": 200, "unit": "Bag"},
+    {"name": "Cement - ACC", "category": "Building Materials", "price": 375.0, "stock": 180, "unit": "Bag"},
+    {"name": "TMT Steel Bars 8mm", "category": "Building Materials", "price": 55.0, "stock": 500, "unit": "Kg"},
+    {"name": "TMT Steel Bars 12mm", "category": "Building Materials", "price": 54.0, "stock": 600, "unit": "Kg"},
+    {"name": "Bricks - Red Clay", "category": "Building Materials", "price": 8.0, "stock": 5000, "unit": "Piece"},
+    {"name": "Sand - River", "category": "Building Materials", "price": 1500.0, "stock": 100, "unit": "Ton"},
+    {"name": "Gravel/Aggregate", "category": "Building Materials", "price": 1200.0, "stock": 80, "unit": "Ton"},
+    {"name": "PVC Pipes 1 inch", "category": "Building Materials", "price": 45.0, "stock": 150, "unit": "Meter"},
+    {"name": "PVC Pipes 2 inch", "category": "Building Materials", "price": 80.0, "stock": 120, "unit": "Meter"},
+    {"name": "Electrical Wires", "category": "Building Materials", "price": 25.0, "stock": 300, "unit": "Meter"},
+]
+
+
+class ShopError(ValueError):
+    """Raised when a shop operation is rejected; the message is user-facing"""
+
+
+@contextmanager
+def gc_paused():
+    """Suspend cyclic garbage collection while a large data set is built.
+
+    Loading allocates millions of long-lived objects and the collector would
+    otherwise rescan them over and over. Nothing built is cyclic garbage, so
+    reference counting still frees everything that needs freeing.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _load_models(model, records, coll, problems):
+    """Models for a mapping of key -> record; damaged records are skipped and described in problems"""
+    loaded = {}
+    for key, record in records.items():
+        try:
+            loaded[key] = model.from_record(record)
+        except KeyError as e:
+            label = record.get('order_id', key)
+            problems.append(f"{coll} record {label}: missing field {e}")
+        except (TypeError, AttributeError):
+            problems.append(f"{coll} record {key}: not a valid record")
+    return loaded
+
+
+class ShopMetrics:
+    """Running dashboard totals, kept up to date as data changes.
+
+    Built once from the loaded data, then adjusted by the engine on every
+    sales history entry (sales, and the reversing entries of cancellations
+    and returns) so reads never rescan history. Order counts by status come
+    from the OrderRepository's status index, low stock from the LowStockIndex.
+    """
+
+    def __init__(self):
+        self.revenue_paise = 0
+
+    @property
+    def revenue(self):
+        return money.to_rupees(self.revenue_paise)
+
+    def rebuild(self, sales_history):
+        to_paise = money.to_paise
+        self.revenue_paise = sum(to_paise(sale['total']) for sale in sales_history)
+
+    def sale_recorded(self, sale):
+        self.revenue_paise += money.to_paise(sale['total'])
+
+    def sale_removed(self, sale):
+        self.revenue_paise -= money.to_paise(sale['total'])
+
+
+def reorder_level(product):
+    """Stock level below which a product should be reordered"""
+    return LOW_STOCK_LEVEL if product.reorder_level is None else product.reorder_level
+
+
+class LowStockIndex:
+    """Products whose stock is below their reorder level, with the shortfall.
+
+    The engine re-checks a product on every stock or level change, so the
+    alert count and the low-stock list are read without scanning the catalog.
+    """
+
+    def __init__(self):
+        self.shortfall = {}  # prod_id -> reorder level minus stock
+
+    def rebuild(self, products):
+        self.shortfall = {}
+        for prod_id, product in products.items():
+            self.update(prod_id, product)
+
+    def update(self, prod_id, product):
+        """Re-check one product; product is None once it has been deleted"""
+        if product is not None and product.stock < reorder_level(product):
+            self.shortfall[prod_id] = reorder_level(product) - product.stock
+        else:
+            self.shortfall.pop(prod_id, None)
+
+    def __len__(self):
+        return len(self.shortfall)
+
+    def __contains__(self, prod_id):
+        return prod_id in self.shortfall
+
+    def most_urgent(self, limit=None):
+        """Low product ids, largest shortfall first"""
+        if limit is None:
+            return sorted(self.shortfall, key=self.shortfall.get, reverse=True)
+        return heapq.nlargest(limit, self.shortfall, key=self.shortfall.get)
+
+
+class _ProductMoves:
+    __slots__ = ('timestamps', 'qtys', 'rows', 'checkpoints', 'balance')
+
+    def __init__(self, opening):
+        self.timestamps = array('d')
+        self.qtys = array('d')
+        self.rows = array('I')  # positions in the engine's stock_moves list
+        self.checkpoints = array('d')  # balance before every LEDGER_CHECKPOINT_EVERY-th move
+        self.balance = opening
+
+
+class StockLedger:
+    """Per-product index over the append-only stock movement ledger.
+
+    Each product's movements are kept in time order as timestamp and
+    quantity columns, with its balance checkpointed every
+    LEDGER_CHECKPOINT_EVERY movements. Stock at a past moment is the nearest
+    checkpoint plus the few movements after it. A product's stock before
+    its first recorded movement is its opening stock, worked back from its
+    current stock, so data saved before the ledger existed still answers.
+    """
+
+    def __init__(self):
+        self.products = {}  # prod_id -> _ProductMoves
+
+    def rebuild(self, moves, products):
+        self.products = {}
+        grouped = defaultdict(list)
+        for row, move in enumerate(moves):
+            ts = parse_order_date(move['date'])
+            if ts is not None:
+                grouped[move['prod_id']].append((ts.timestamp(), move['qty'], row))
+
+        for prod_id, entries in grouped.items():
+            product = products.get(prod_id)
+            current = product.stock if product is not None else 0
+            entries.sort(key=lambda entry: entry[0])
+            self.products[prod_id] = _ProductMoves(current - sum(qty for _, qty, _ in entries))
+            for stamp, qty, row in entries:
+                self._append(prod_id, stamp, qty, row)
+
+    def add(self, prod_id, when, qty, row, stock_after):
+        """Record a movement made at datetime `when` that left the product at stock_after"""
+        if prod_id not in self.products:
+            self.products[prod_id] = _ProductMoves(stock_after - qty)
+        self._append(prod_id, when.timestamp(), qty, row)
+
+    def _append(self, prod_id, stamp, qty, row):
+        moves = self.products[prod_id]
+        if len(moves.qtys) % LEDGER_CHECKPOINT_EVERY == 0:
+            moves.checkpoints.append(moves.balance)
+        moves.timestamps.append(stamp)
+        moves.qtys.append(qty)
+        moves.rows.append(row)
+        moves.balance += qty
+
+    def stock_at(self, prod_id, when, current):
+        """A product's stock at datetime `when`; `current` is used when it has never moved"""
+        moves = self.products.get(prod_id)
+        if moves is None:
+            return current
+        count = bisect.bisect_right(moves.timestamps, when.timestamp())
+        if count == len(moves.qtys):
+            return moves.balance
+        checkpoint = count // LEDGER_CHECKPOINT_EVERY
+        start = checkpoint * LEDGER_CHECKPOINT_EVERY
+        return moves.checkpoints[checkpoint] + sum(moves.qtys[start:count])
+
+    def rows(self, prod_id):
+        """Positions of a product's movements in the ledger, oldest first"""
+        moves = self.products.get(prod_id)
+        return list(moves.rows) if moves is not None else []
+
+
+class OrderRepository:
+    """Orders in the order they were placed, indexed by id, customer and status.
+
+    Lookups by id and status changes are constant time, and the orders of
+    one customer or in one status are read straight from their index.
+    Iterating the repository yields every order, oldest first.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.orders = []
+        self.by_id = {}
+        self.by_customer = defaultdict(list)
+        self.by_status = defaultdict(dict)
+
+    def rebuild(self, orders):
+        self.clear()
+        for order in orders:
+            self.add(order)
+
+    def __iter__(self):
+        return iter(self.orders)
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, order_id):
+        return order_id in self.by_id
+
+    def get(self, order_id):
+        return self.by_id.get(order_id)
+
+    def add(self, order):
+        self.orders.append(order)
+        self.by_id[order.order_id] = order
+        self.by_customer[order.customer_id].append(order)
+        self.by_status[order.status][order.order_id] = order
+
+    def remove(self, order):
+        """Drop an order again, e.g. one whose commit failed"""
+        self.orders.remove(order)
+        del self.by_id[order.order_id]
+        self.by_customer[order.customer_id].remove(order)
+        self.by_status[order.status].pop(order.order_id, None)
+
+    def set_status(self, order, status):
+        self.by_status[order.status].pop(order.order_id, None)
+        order.status = status
+        self.by_status[status][order.order_id] = order
+
+    def for_customer(self, cust_id):
+        return list(self.by_customer.get(cust_id, ()))
+
+    def with_status(self, status):
+        return list(self.by_status.get(status, {}).values())
+
+    def count(self, status):
+        return len(self.by_status.get(status, ()))
+
+    def highest_number(self):
+        """Largest numeric suffix among ORDnnnnn ids, for seeding the sequence"""
+        return max((int(order_id[3:]) for order_id in self.by_id if order_id[3:].isdigit()), default=0)
+
+
+class CustomerHistory:
+    """Per-customer lifetime spend, order count, last visit and item totals.
+
+    Updated as orders are placed, partly returned, cancelled or restored, so
+    a customer's summary never rescans the order list. Cancelled orders do
+    not count towards spend or items, but still count as a visit.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def rebuild(self, orders):
+        self.stats = {}
+        for order in orders:
+            self.add(order)
+
+    def _stats(self, cust_id):
+        stats = self.stats.get(cust_id)
+        if stats is None:
+            # Spend and item revenue are kept in paise
+            stats = self.stats[cust_id] = {'spend': 0, 'orders': 0, 'last_visit': None,
+                                           'items': defaultdict(lambda: [0.0, 0])}
+        return stats
+
+    def add(self, order):
+        stats = self._stats(order.customer_id)
+        ts = parse_order_date(order.date)
+        if ts is not None and (stats['last_visit'] is None or ts > stats['last_visit']):
+            stats['last_visit'] = ts
+        if order.status != 'Cancelled':
+            self._count(stats, order, 1)
+
+    def remove(self, order, remaining):
+        """Take an order off its customer's totals; remaining are their other orders"""
+        stats = self._stats(order.customer_id)
+        if order.status != 'Cancelled':
+            self._count(stats, order, -1)
+        visits = [ts for ts in map(parse_order_date, (o.date for o in remaining)) if ts is not None]
+        stats['last_visit'] = max(visits, default=None)
+
+    def _count(self, stats, order, sign):
+        stats['spend'] += sign * money.to_paise(order.net_total)
+        stats['orders'] += sign
+        for item, qty, total in order.net_items():
+            totals = stats['items'][item.name]
+            totals[0] += sign * qty
+            totals[1] += sign * money.to_paise(total)
+
+    def items_returned(self, order, ret):
+        """Take a partial return of a (not cancelled) order off its customer's totals"""
+        stats = self._stats(order.customer_id)
+        stats['spend'] -= money.to_paise(ret['total'])
+        for line in ret['items']:
+            totals = stats['items'][order.items[line['line']].name]
+            totals[0] -= line['qty']
+            totals[1] -= money.to_paise(line['amount'])
+
+    def status_changed(self, order, old_status, new_status):
+        if old_status != 'Cancelled' and new_status == 'Cancelled':
+            self._count(self._stats(order.customer_id), order, -1)
+        elif old_status == 'Cancelled' and new_status != 'Cancelled':
+            self._count(self._stats(order.customer_id), order, 1)
+
+    def summary(self, cust_id, top=5):
+        """Spend, order count, last visit and the top items by revenue"""
+        stats = self.stats.get(cust_id)
+        if stats is None:
+            return {'spend': 0.0, 'orders': 0, 'last_visit': None, 'top_items': []}
+        top_items = heapq.nlargest(top, ((name, qty, money.to_rupees(revenue)) for name, (qty, revenue)
+                                         in stats['items'].items() if revenue > 0),
+                                   key=lambda x: x[2])
+        return {'spend': money.to_rupees(stats['spend']), 'orders': stats['orders'],
+                'last_visit': stats['last_visit'], 'top_items': top_items}
+
+
+def parse_order_date(date_str):
+    """Parse an order's stored date string; None if it is malformed"""
+    try:
+        # Fixed-width DATE_FORMAT sliced directly; strptime dominates index rebuilds
+        if (len(date_str) == 19 and date_str[2] == date_str[5] == '/' and date_str[10] == ' '
+                and date_str[13] == date_str[16] == ':'):
+            return datetime(int(date_str[6:10]), int(date_str[3:5]), int(date_str[0:2]),
+                            int(date_str[11:13]), int(date_str[14:16]), int(date_str[17:19]))
+        return datetime.strptime(date_str, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class OrderDateIndex:
+    """Orders bucketed by day, with the days kept sorted for bisecting.
+
+    Each bucket holds parallel lists of timestamps and orders in time order,
+    so a date-range query touches only the days (and orders) in the range.
+    """
+
+    def __init__(self):
+        self.days = []
+        self.buckets = {}
+
+    def rebuild(self, orders):
+        self.days = []
+        self.buckets = {}
+        for order in orders:
+            self.add(order)
+
+    def add(self, order):
+        ts = parse_order_date(order.date)
+        if ts is None:
+            return
+        day = ts.date()
+        bucket = self.buckets.get(day)
+        if bucket is None:
+            bisect.insort(self.days, day)
+            bucket = self.buckets[day] = ([], [])
+        stamps, orders = bucket
+        pos = bisect.bisect_right(stamps, ts)
+        stamps.insert(pos, ts)
+        orders.insert(pos, order)
+
+    def remove(self, order):
+        ts = parse_order_date(order.date)
+        bucket = self.buckets.get(ts.date()) if ts is not None else None
+        if bucket is None or order not in bucket[1]:
+            return
+        stamps, orders = bucket
+        pos = orders.index(order)
+        del stamps[pos], orders[pos]
+        if not orders:
+            del self.buckets[ts.date()]
+            self.days.remove(ts.date())
+
+    def between(self, start, end):
+        """Yield orders with start <= timestamp <= end, oldest first"""
+        lo = bisect.bisect_left(self.days, start.date())
+        hi = bisect.bisect_right(self.days, end.date())
+        for day in self.days[lo:hi]:
+            stamps, orders = self.buckets[day]
+            first = bisect.bisect_left(stamps, start) if day == start.date() else 0
+            last = bisect.bisect_right(stamps, end) if day == end.date() else len(stamps)
+            yield from orders[first:last]
+
+    def on_day(self, day):
+        bucket = self.buckets.get(day)
+        return list(bucket[1]) if bucket else []
+
+
+class LineItemStore:
+    """Order line items held column-wise in parallel typed arrays.
+
+    Product (id, name) pairs and categories are interned to small ints, so a
+    line item costs one slot in each column instead of a dict. Rows are
+    appended an order at a time, net of any returns, and flagged inactive
+    while the order is cancelled; aggregations are single passes over the
+    columns. Line totals are held in paise so they add up exactly.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.product_keys = []
+        self.product_index = {}
+        self.category_names = []
+        self.category_index = {}
+        self.product = array('I')
+        self.category = array('I')
+        self.qty = array('d')
+        self.price = array('d')
+        self.discount = array('d')
+        self.total = array('q')
+        self.timestamp = array('d')
+        self.day = array('I')
+        self.active = array('b')
+        self.order_rows = {}
+        self.in_time_order = True
+
+    def __len__(self):
+        return len(self.product)
+
+    def rebuild(self, orders, products):
+        self.clear()
+        for order in orders:
+            self.add(order, products)
+
+    def _intern(self, names, index, key):
+        idx = index.get(key)
+        if idx is None:
+            idx = index[key] = len(names)
+            names.append(key)
+        return idx
+
+    def add(self, order, products):
+        """Append an order's items; orders with an unreadable date are skipped"""
+        ts = parse_order_date(order.date)
+        if ts is None:
+            return
+        stamp = ts.timestamp()
+        if self.timestamp and stamp < self.timestamp[-1]:
+            self.in_time_order = False
+        day = ts.toordinal()
+        active = order.status != 'Cancelled'
+        start = len(self.product)
+        to_paise = money.to_paise
+        for item, qty, total in order.net_items():
+            category = item.category
+            if category is None:
+                prod = products.get(item.prod_id)
+                category = prod.category if prod else "Uncategorized"
+            self.product.append(self._intern(self.product_keys, self.product_index,
+                                             (item.prod_id, item.name)))
+            self.category.append(self._intern(self.category_names, self.category_index, category))
+            self.qty.append(qty)
+            self.price.append(item.price)
+            self.discount.append(item.discount)
+            self.total.append(to_paise(total))
+            self.timestamp.append(stamp)
+            self.day.append(day)
+            self.active.append(active)
+        self.order_rows[order.order_id] = (start, len(self.product))
+
+    def set_active(self, order_id, active):
+        """Include or exclude an order's rows, e.g. when it is cancelled; returns its row range"""
+        rows = self.order_rows.get(order_id)
+        if rows is not None:
+            for row in range(*rows):
+                self.active[row] = active
+        return rows
+
+    def items_returned(self, order_id, ret):
+        """Take a partial return off the quantity and total of an order's rows"""
+        rows = self.order_rows.get(order_id)
+        if rows is not None:
+            for line in ret['items']:
+                self.qty[rows[0] + line['line']] -= line['qty']
+                self.total[rows[0] + line['line']] -= money.to_paise(line['amount'])
+        return rows
+
+    def rows_between(self, start=None, end=None):
+        """Row range covering timestamps start..end (datetimes, inclusive)"""
+        if start is None and end is None:
+            return 0, len(self.product)
+        if not self.in_time_order:
+            return None
+        lo = bisect.bisect_left(self.timestamp, start.timestamp()) if start else 0
+        hi = bisect.bisect_right(self.timestamp, end.timestamp()) if end else len(self.product)
+        return lo, hi
+
+    def aggregate(self, start=None, end=None):
+        """Category revenue and per-product [qty, revenue] over active rows in a time range.
+
+        Returns two lists indexed by interned category / product id, with
+        revenue in paise.
+        """
+        categories = [0] * len(self.category_names)
+        products = [[0.0, 0] for _ in self.product_keys]
+        rows = self.rows_between(start, end)
+        if rows is None:
+            # Out-of-order history: filter on the timestamp column instead
+            lo, hi = 0, len(self.product)
+            lower = start.timestamp() if start else float('-inf')
+            upper = end.timestamp() if end else float('inf')
+            keep = [a and lower <= t <= upper for a, t in zip(self.active, self.timestamp)]
+        else:
+            lo, hi = rows
+            keep = self.active[lo:hi]
+        for prod, cat, qty, total in compress(zip(self.product[lo:hi], self.category[lo:hi],
+                                                  self.qty[lo:hi], self.total[lo:hi]), keep):
+            categories[cat] += total
+            totals = products[prod]
+            totals[0] += qty
+            totals[1] += total
+        return categories, products
+
+    def totals(self, date_from, date_to):
+        """Category and product totals for the days date_from..date_to, keyed by name"""
+        categories, products = self.aggregate(datetime.combine(date_from, time.min),
+                                              datetime.combine(date_to, time.max))
+        return named_totals(self, enumerate(categories), enumerate(products))
+
+
+def named_totals(items, categories, products):
+    """Category revenue and per-product qty/revenue keyed by name, in rupees.
+
+    Takes (interned category, paise) and (interned product, [qty, paise])
+    pairs; products sold under one name in several ids are merged.
+    """
+    category_names = items.category_names
+    product_keys = items.product_keys
+    by_category = defaultdict(int)
+    by_product = defaultdict(lambda: {'qty': 0, 'revenue': 0})
+    for cat, amount in categories:
+        by_category[category_names[cat]] += amount
+    for prod, (qty, revenue) in products:
+        totals = by_product[product_keys[prod][1]]
+        totals['qty'] += qty
+        totals['revenue'] += revenue
+
+    # Drop entries that netted out to nothing after cancellations and returns
+    by_category = {k: money.to_rupees(v) for k, v in by_category.items() if v}
+    by_product = {k: {'qty': v['qty'], 'revenue': money.to_rupees(v['revenue'])}
+                  for k, v in by_product.items() if abs(v['qty']) > 1e-9 or v['revenue']}
+    return by_category, by_product
+
+
+def _empty_bucket():
+    # Category and product revenue in paise
+    return {'categories': defaultdict(int), 'qty': defaultdict(float), 'revenue': defaultdict(int)}
+
+
+class SalesRollup:
+    """Materialized per-day and per-month sales by category and product.
+
+    Buckets are keyed by the line item store's interned ids and built from
+    its columns in one pass. Committed orders are added as they are sold and
+    subtracted again when cancelled or returned, so the all-time report
+    merges a handful of month buckets instead of walking every line item.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.daily = {}
+        self.monthly = {}
+
+    def rebuild(self):
+        self.daily = {}
+        self.monthly = {}
+        self._add_rows(0, len(self.items))
+
+    def _add_rows(self, lo, hi, sign=1):
+        """Total rows lo..hi per day in one pass over the columns, then merge into the buckets"""
+        items = self.items
+        days = {}
+        last_day = None
+        for day, prod, cat, qty, total, active in zip(items.day[lo:hi], items.product[lo:hi],
+                                                      items.category[lo:hi], items.qty[lo:hi],
+                                                      items.total[lo:hi], items.active[lo:hi]):
+            if not active and sign > 0:
+                continue
+            if day != last_day:
+                bucket = days.get(day)
+                if bucket is None:
+                    bucket = days[day] = _empty_bucket()
+                categories, qtys, revenues = bucket['categories'], bucket['qty'], bucket['revenue']
+                last_day = day
+            categories[cat] += total
+            qtys[prod] += qty
+            revenues[prod] += total
+
+        for day, bucket in days.items():
+            day = datetime.fromordinal(day).date()
+            for target in (self.daily.setdefault(day, _empty_bucket()),
+                           self.monthly.setdefault((day.year, day.month), _empty_bucket())):
+                for column, values in bucket.items():
+                    target_column = target[column]
+                    for key, amount in values.items():
+                        target_column[key] += sign * amount
+
+    def order_added(self, order_id):
+        rows = self.items.order_rows.get(order_id)
+        if rows is not None:
+            self._add_rows(*rows)
+
+    def order_removed(self, order_id):
+        """Take an order back out of the totals; its rows stay in the item store, inactive"""
+        if self.items.set_active(order_id, False) is not None:
+            self._add_rows(*self.items.order_rows.pop(order_id), sign=-1)
+
+    def status_changed(self, order_id, old_status, new_status):
+        """Move an order in or out of the totals; also flips its rows in the item store"""
+        if old_status != 'Cancelled' and new_status == 'Cancelled':
+            rows = self.items.set_active(order_id, False)
+            if rows is not None:
+                self._add_rows(*rows, sign=-1)
+        elif old_status == 'Cancelled' and new_status != 'Cancelled':
+            rows = self.items.set_active(order_id, True)
+            if rows is not None:
+                self._add_rows(*rows)
+
+    def items_returned(self, order_id, ret):
+        """Re-total an order's rows around a partial return; also updates the item store"""
+        rows = self.items.order_rows.get(order_id)
+        if rows is None:
+            return
+        self._add_rows(*rows, sign=-1)
+        self.items.items_returned(order_id, ret)
+        self._add_rows(*rows)
+
+    def product_qty(self, date_from, date_to):
+        """Quantity sold per product id over a few days, from the daily buckets"""
+        product_keys = self.items.product_keys
+        sold = defaultdict(float)
+        day = date_from
+        while day <= date_to:
+            bucket = self.daily.get(day)
+            if bucket is not None:
+                for prod, qty in bucket['qty'].items():
+                    sold[product_keys[prod][0]] += qty
+            day += timedelta(days=1)
+        return sold
+
+    def totals(self):
+        """All-time category and product totals, merged from the month buckets"""
+        categories = defaultdict(int)
+        products = defaultdict(lambda: [0, 0])
+        for bucket in self.monthly.values():
+            for cat, amount in bucket['categories'].items():
+                categories[cat] += amount
+            for prod, qty in bucket['qty'].items():
+                products[prod][0] += qty
+            for prod, revenue in bucket['revenue'].items():
+                products[prod][1] += revenue
+        return named_totals(self.items, categories.items(), products.items())
+
+
+class SearchIndex:
+    """Type-ahead index over a few text fields of each record.
+
+    Short queries (under 3 characters) match word prefixes through a sorted
+    token list; longer ones intersect trigram posting sets and then confirm
+    the substring. Records are added and removed incrementally.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.texts = {}
+        self.tokens = []
+        self.trigrams = defaultdict(set)
+
+    def _text(self, key, record):
+        return ' '.join([str(key)] + [str(getattr(record, f, '')) for f in self.fields]).lower()
+
+    def rebuild(self, records):
+        self.texts = {}
+        self.tokens = []
+        self.trigrams = defaultdict(set)
+        for key, record in records.items():
+            text = self._text(key, record)
+            self.texts[key] = text
+            for gram in self._grams(text):
+                self.trigrams[gram].add(key)
+            self.tokens.extend((token, key) for token in set(text.split()))
+        self.tokens.sort()
+
+    def add(self, key, record):
+        if key in self.texts:
+            self.remove(key)
+        text = self._text(key, record)
+        self.texts[key] = text
+        for gram in self._grams(text):
+            self.trigrams[gram].add(key)
+        for token in set(text.split()):
+            bisect.insort(self.tokens, (token, key))
+
+    def remove(self, key):
+        text = self.texts.pop(key, None)
+        if text is None:
+            return
+        for gram in self._grams(text):
+            keys = self.trigrams[gram]
+            keys.discard(key)
+            if not keys:
+                del self.trigrams[gram]
+        for token in set(text.split()):
+            pos = bisect.bisect_left(self.tokens, (token, key))
+            if pos < len(self.tokens) and self.tokens[pos] == (token, key):
+                del self.tokens[pos]
+
+    def search(self, query, limit=50):
+        """Keys whose text contains every word of `query`, word-prefix matches first"""
+        words = query.strip().lower().split()
+        if not words:
+            return list(islice(self.texts, limit))
+
+        results = []
+        seen = set()
+        # Single words walk the token list; several words go straight to trigrams
+        pos = bisect.bisect_left(self.tokens, (words[0],)) if len(words) == 1 else len(self.tokens)
+        while pos < len(self.tokens) and len(results) < limit:
+            token, key = self.tokens[pos]
+            if not token.startswith(words[0]):
+                break
+            if key not in seen and all(w in self.texts[key] for w in words):
+                seen.add(key)
+                results.append(key)
+            pos += 1
+
+        grams = set().union(*(self._grams(w) for w in words))
+        if len(results) < limit and grams:
+            postings = sorted((self.trigrams.get(g, set()) for g in grams), key=len)
+            for key in set.intersection(*postings):
+                if key not in seen and all(w in self.texts[key] for w in words):
+                    results.append(key)
+                    if len(results) >= limit:
+                        break
+        return results
+
+    @staticmethod
+    def _grams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class ShopEngine:
+    """Headless shop logic: inventory, customers, cart, orders and reports.
+
+    Has no Tk dependency, so it can be scripted, benchmarked or run on a
+    server. The Tk application in kabraji.py is a thin client on top of it.
+    """
+
+    def __init__(self, storage_backend=None, worker=None):
+        self.storage = storage_backend or storage.open_storage()
+        if worker is not None:
+            # Writes go to the background worker instead of blocking the caller
+            self.storage = storage.AsyncStorage(self.storage, worker)
+
+        # Data storage
+        self.products = {}
+        self.customers = {}
+        self.orders = OrderRepository()
+        self.order_seq = 0  # last order number issued; persisted in 'sequences'
+        self.sales_history = []
+        self.stock_moves = []  # append-only ledger of every stock change
+        self.stock_ledger = StockLedger()
+        self.carts = {}  # terminal -> list of CartItem
+        self.cart_totals = {}  # terminal -> money.CartTotals of its cart
+        self.reserved = defaultdict(float)  # prod_id -> qty held in carts
+        self.metrics = ShopMetrics()
+        self.low_stock = LowStockIndex()
+        self.customer_history = CustomerHistory()
+        self.date_index = OrderDateIndex()
+        self.line_items = LineItemStore()
+        self.rollup = SalesRollup(self.line_items)
+        self.product_search = SearchIndex(('name', 'category'))
+        self.customer_search = SearchIndex(('name', 'phone'))
+        self.listeners = []
+        self.loaded = True
+        self.catalog_problems = []
+        self.order_problems = []
+
+    def start(self, on_loaded=None):
+        """Load persisted data and seed the default catalog on first run.
+
+        With a background worker and an on_loaded(error) callback, nothing
+        is read on the calling thread. The worker reads the products and
+        customers and builds their indexes, and the catalog is installed (and
+        listeners notified) from the worker's poll(). The orders and the
+        indexes built from them follow the same way, then on_loaded(None) is
+        called. Until then changes are refused with ShopError. If the data
+        cannot be read, on_loaded gets the exception and nothing more is
+        installed or saved.
+        """
+        if on_loaded is None or not isinstance(self.storage, storage.AsyncStorage):
+            self._install_state(self._read_catalog())
+            self._finish_start(self._read_orders(self.products, self.order_seq), on_loaded)
+            return
+
+        self.loaded = False
+        self.storage.worker.submit(
+            self._read_catalog, callback=lambda job: self._catalog_read(job.result, on_loaded, job.error))
+
+    def _catalog_read(self, catalog, on_loaded, error=None):
+        if error is not None:
+            on_loaded(error)
+            return
+        # Products and customers show while the orders are still being read
+        self._install_state(catalog)
+        self.storage.worker.submit(
+            self._read_orders, self.products, self.order_seq,
+            callback=lambda job: self._finish_start(job.result, on_loaded, job.error))
+
+    def _finish_start(self, state, on_loaded, error=None):
+        if error is not None:
+            on_loaded(error)
+            return
+        self._install_state(state)
+        self.loaded = True
+        self.initialize_default_products()
+        if on_loaded is not None:
+            on_loaded(None)
+
+    def close(self):
+        self.storage.close()
+
+    def subscribe(self, listener):
+        """Register listener(collection, action, key, record) for data changes.
+
+        action is 'added', 'updated' or 'deleted' for a single record (record
+        is None when deleted; an order is only deleted when its commit
+        failed), or 'reset' with record an iterable of
+        (key, record) pairs when a whole collection is replaced.
+        """
+        self.listeners.append(listener)
+
+    def _commit(self, ops, on_done=None, undo=None):
+        """Persist one commit; on_done(error) runs once it is durable.
+
+        If the write fails, undo() first takes the commit's changes back out
+        of memory, so memory never holds what the files do not.
+        """
+        if isinstance(self.storage, storage.AsyncStorage):
+            if on_done is None and undo is None:
+                # Failures go to the worker's on_error
+                return self.storage.commit(ops)
+
+            def finished(job):
+                if job.error is not None and undo is not None:
+                    undo()
+                if on_done:
+                    on_done(job.error)
+                elif job.error is not None and self.storage.worker.on_error is not None:
+                    self.storage.worker.on_error(job.error)
+            return self.storage.commit(ops, callback=finished)
+        try:
+            self.storage.commit(ops)
+        except Exception:
+            if undo is not None:
+                undo()
+            raise
+        if on_done:
+            on_done(None)
+
+    @property
+    def read_only(self):
+        """True for a terminal's mirror of the data on a shop server"""
+        return getattr(self.storage, 'read_only', False)
+
+    def _check_loaded(self):
+        if not self.loaded:
+            raise ShopError("Shop data is still loading, please try again in a moment!")
+        if self.read_only:
+            raise ShopError("This terminal cannot change shop data, please use the shop server!")
+
+    def _notify(self, collection, action, key=None, record=None):
+        for listener in self.listeners:
+            listener(collection, action, key, record)
+
+    def initialize_default_products(self):
+        """Add default products if none exist"""
+        if not self.products and not self.read_only:
+            for idx, prod in enumerate(DEFAULT_PRODUCTS, 1):
+                prod_id = f"PROD{idx:04d}"
+                self.products[prod_id] = models.Product.from_record(prod)
+            self.low_stock.rebuild(self.products)
+            self.product_search.rebuild(self.products)
+
+            self.save_data()
+
+    # Product functions
+    def add_product(self, prod_id, name, category, price, stock, unit, reorder_level=None):
+        self._check_loaded()
+        if not all([prod_id, name, category, price, stock, unit]):
+            raise ShopError("Please fill all fields!")
+
+        price, stock = self._parse_price_stock(price, stock)
+        reorder_level = self._parse_reorder_level(reorder_level)
+
+        if prod_id in self.products:
+            raise ShopError("Product ID already exists!")
+
+        self.products[prod_id] = models.Product(name, category, price, stock, unit, reorder_level)
+        self.low_stock.update(prod_id, self.products[prod_id])
+        self.product_search.add(prod_id, self.products[prod_id])
+
+        ops = [storage.put('products', prod_id, self.products[prod_id].to_record())]
+        if stock:
+            ops.append(self._record_move(prod_id, stock, 'receipt', "opening stock"))
+        self._commit(ops)
+        self._notify('products', 'added', prod_id, self.products[prod_id])
+        return self.products[prod_id]
+
+    def update_product(self, prod_id, name, category, price, stock, unit, reorder_level=None):
+        """Replace a product's fields; a blank reorder_level means the default level"""
+        self._check_loaded()
+        if prod_id not in self.products:
+            raise ShopError("Product ID not found!")
+
+        if not all([name, category, price, stock, unit]):
+            raise ShopError("Please fill all fields!")
+
+        price, stock = self._parse_price_stock(price, stock)
+        reorder_level = self._parse_reorder_level(reorder_level)
+
+        product = self.products[prod_id]
+        change = stock - product.stock
+        product.name = name
+        product.category = category
+        product.price = price
+        product.stock = stock
+        product.unit = unit
+        product.reorder_level = reorder_level
+        self.low_stock.update(prod_id, product)
+        self.product_search.add(prod_id, product)
+
+        ops = [storage.put('products', prod_id, product.to_record())]
+        if change:
+            # An edited stock figure is a manual adjustment, never a silent overwrite
+            ops.append(self._record_move(prod_id, change, 'adjustment', "edited"))
+        self._commit(ops)
+        self._notify('products', 'updated', prod_id, self.products[prod_id])
+        return self.products[prod_id]
+
+    def delete_product(self, prod_id):
+        self._check_loaded()
+        if prod_id not in self.products:
+            raise ShopError("Product ID not found!")
+
+        product = self.products.pop(prod_id)
+        self.low_stock.update(prod_id, None)
+        self.product_search.remove(prod_id)
+        ops = [storage.delete('products', prod_id)]
+        if product.stock:
+            ops.append(self._record_move(prod_id, -product.stock, 'adjustment', "deleted", stock_after=0))
+        self._commit(ops)
+        self._notify('products', 'deleted', prod_id)
+
+    def _parse_price_stock(self, price, stock):
+        try:
+            return float(price), int(stock)
+        except ValueError:
+            raise ShopError("Invalid price or stock value!")
+
+    def _parse_reorder_level(self, reorder_level):
+        if reorder_level is None or reorder_level == '':
+            return None
+        try:
+            reorder_level = int(reorder_level)
+        except ValueError:
+            raise ShopError("Invalid reorder level!")
+        if reorder_level < 0:
+            raise ShopError("Reorder level cannot be negative!")
+        return reorder_level
+
+    def receive_stock(self, prod_id, qty, ref=''):
+        """Book a delivery of `qty` into stock"""
+        self._check_loaded()
+        if prod_id not in self.products:
+            raise ShopError("Product ID not found!")
+        try:
+            qty = float(qty)
+        except (TypeError, ValueError):
+            raise ShopError("Invalid quantity!")
+        if qty <= 0:
+            raise ShopError("Quantity received must be more than zero!")
+
+        product = self.products[prod_id]
+        product.stock += qty
+        self.low_stock.update(prod_id, product)
+        self._commit([storage.update('products', prod_id, stock=product.stock),
+                      self._record_move(prod_id, qty, 'receipt', ref)])
+        self._notify('products', 'updated', prod_id, product)
+        return product
+
+    def _record_move(self, prod_id, qty, kind, ref='', when=None, stock_after=None):
+        """Append a stock movement to the ledger; returns its journal operation.
+
+        Call after the product's stock has been changed; stock_after is only
+        needed once the product is gone.
+        """
+        # Whole seconds, as stored, so the live index matches one rebuilt on load
+        when = (when or datetime.now()).replace(microsecond=0)
+        move = {'date': when.strftime(DATE_FORMAT), 'prod_id': prod_id, 'qty': qty, 'kind': kind, 'ref': ref}
+        if stock_after is None:
+            stock_after = self.products[prod_id].stock
+        self.stock_ledger.add(prod_id, when, qty, len(self.stock_moves), stock_after)
+        self.stock_moves.append(move)
+        return storage.append('stock_moves', move)
+
+    def stock_as_of(self, when, prod_id=None):
+        """Stock of one product, or {prod_id: stock} of all, at a datetime or the end of a date.
+
+        Read from the ledger's checkpoints; products deleted since are
+        included while they still had stock at that moment.
+        """
+        if not isinstance(when, datetime):
+            when = datetime.combine(when, time.max)
+        if prod_id is not None:
+            product = self.products.get(prod_id)
+            return self.stock_ledger.stock_at(prod_id, when, product.stock if product else 0)
+
+        levels = {}
+        for pid in self.products.keys() | self.stock_ledger.products.keys():
+            product = self.products.get(pid)
+            stock = self.stock_ledger.stock_at(pid, when, product.stock if product else 0)
+            if product is not None or stock:
+                levels[pid] = stock
+        return levels
+
+    def stock_movements(self, prod_id):
+        """A product's ledger entries, oldest first, each with the balance it left"""
+        rows = self.stock_ledger.rows(prod_id)
+        if not rows:
+            return []
+        balance = self.stock_ledger.products[prod_id].checkpoints[0]
+        movements = []
+        for row in rows:
+            move = dict(self.stock_moves[row])
+            balance += move['qty']
+            move['balance'] = balance
+            movements.append(move)
+        return movements
+
+    def search_products(self, query, limit=50):
+        """Product ids whose id, name or category matches `query`"""
+        return self.product_search.search(query, limit)
+
+    # Bulk import
+    def import_records(self, collection, rows):
+        """Upsert products or customers from (row_no, fields) rows.
+
+        New ids need every required field; for existing ids blank fields keep
+        their current value. Rows that fail validation are skipped and listed
+        in the result's 'problems'. All changes are persisted as one commit
+        and listeners get a single 'reset' for the collection at the end.
+        """
+        self._check_loaded()
+        if collection == 'products':
+            upsert, search = self._upsert_product, self.product_search
+        elif collection == 'customers':
+            upsert, search = self._upsert_customer, self.customer_search
+        else:
+            raise ShopError(f"Cannot import {collection}!")
+
+        records = getattr(self, collection)
+        result = {'rows': 0, 'added': 0, 'updated': 0, 'problems': []}
+        changed = {}
+        move_ops = []
+        try:
+            with gc_paused():
+                for row_no, fields in rows:
+                    result['rows'] += 1
+                    try:
+                        key, added = upsert(fields, move_ops)
+                    except ShopError as e:
+                        result['problems'].append(f"Row {row_no}: {e}")
+                        continue
+                    if key not in changed:
+                        result['added' if added else 'updated'] += 1
+                    changed[key] = True
+        finally:
+            # Rows applied before a read error are persisted too, so memory and storage agree
+            if changed:
+                if len(changed) > SEARCH_REBUILD_SHARE * len(records):
+                    search.rebuild(records)
+                else:
+                    for key in changed:
+                        search.add(key, records[key])
+                self._commit([storage.put(collection, key, records[key].to_record()) for key in changed]
+                             + move_ops)
+                self._notify(collection, 'reset', record=records.items())
+        return result
+
+    def _import_fields(self, fields, names, current, required):
+        """A row's values, blanks filled from the current record, and the names the row gave"""
+        values = {}
+        given = set()
+        for name in names:
+            value = fields.get(name)
+            if isinstance(value, str):
+                value = value.strip()
+            if value is None or value == '':
+                if current is not None:
+                    value = getattr(current, name)
+                elif name in required:
+                    raise ShopError(f"Missing {name}!")
+                else:
+                    value = ''
+            else:
+                given.add(name)
+            values[name] = value
+        return values, given
+
+    def _parse_import_number(self, value, name):
+        # CSV text and JSONL numbers go through the same conversion
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise ShopError(f"Invalid {name}!")
+        if not math.isfinite(number):
+            raise ShopError(f"Invalid {name}!")
+        return int(number) if number.is_integer() else number
+
+    def _upsert_product(self, fields, move_ops):
+        prod_id = str(fields.get('prod_id') or '').strip()
+        if not prod_id:
+            raise ShopError("Missing prod_id!")
+        product = self.products.get(prod_id)
+        required = ('name', 'category', 'price', 'stock', 'unit')
+        values, given = self._import_fields(fields, required + ('reorder_level',), product, required)
+        # Values kept from the current product are used as they are
+        if 'price' in given:
+            values['price'] = float(self._parse_import_number(values['price'], 'price'))
+        if 'stock' in given:
+            values['stock'] = self._parse_import_number(values['stock'], 'stock')
+        if values['price'] < 0 or values['stock'] < 0:
+            raise ShopError("Price and stock cannot be negative!")
+        if 'reorder_level' in given:
+            values['reorder_level'] = self._parse_reorder_level(values['reorder_level'])
+        elif product is None:
+            values['reorder_level'] = None
+
+        if product is None:
+            product = self.products[prod_id] = models.Product(**values)
+            added, change = True, product.stock
+        else:
+            change = values['stock'] - product.stock
+            for name, value in values.items():
+                setattr(product, name, value)
+            added = False
+        self.low_stock.update(prod_id, product)
+        if change:
+            move_ops.append(self._record_move(prod_id, change, 'receipt' if added else 'adjustment', "import"))
+        return prod_id, added
+
+    def _upsert_customer(self, fields, move_ops):
+        cust_id = str(fields.get('cust_id') or '').strip()
+        if not cust_id:
+            raise ShopError("Missing cust_id!")
+        customer = self.customers.get(cust_id)
+        values, _ = self._import_fields(fields, ('name', 'phone', 'email', 'address'), customer,
+                                        ('name', 'phone'))
+        values['phone'] = str(values['phone'])
+
+        if customer is None:
+            self.customers[cust_id] = models.Customer(**values)
+            return cust_id, True
+        for name, value in values.items():
+            setattr(customer, name, value)
+        return cust_id, False
+
+    # Customer functions
+    def add_customer(self, cust_id, name, phone, email='', address=''):
+        self._check_loaded()
+        if not all([cust_id, name, phone]):
+            raise ShopError("Please fill required fields (ID, Name, Phone)!")
+
+        if cust_id in self.customers:
+            raise ShopError("Customer ID already exists!")
+
+        self.customers[cust_id] = models.Customer(name, phone, email, address)
+        self.customer_search.add(cust_id, self.customers[cust_id])
+
+        self._commit([storage.put('customers', cust_id, self.customers[cust_id].to_record())])
+        self._notify('customers', 'added', cust_id, self.customers[cust_id])
+        return self.customers[cust_id]
+
+    def delete_customer(self, cust_id):
+        self._check_loaded()
+        if cust_id not in self.customers:
+            raise ShopError("Customer ID not found!")
+
+        del self.customers[cust_id]
+        self.customer_search.remove(cust_id)
+        self._commit([storage.delete('customers', cust_id)])
+        self._notify('customers', 'deleted', cust_id)
+
+    def search_customers(self, query, limit=50):
+        """Customer ids whose id, name or phone matches `query`"""
+        return self.customer_search.search(query, limit)
+
+    # Cart functions
+    @property
+    def cart_items(self):
+        return self.carts.get(LOCAL_TERMINAL, [])
+
+    def available(self, prod_id):
+        """Stock not yet held in any terminal's cart"""
+        return self.products[prod_id].stock - self.reserved.get(prod_id, 0)
+
+    def add_to_cart(self, prod_id, qty, discount=0, terminal=LOCAL_TERMINAL):
+        """Add an item to a terminal's cart, reserving its stock until checkout"""
+        self._check_loaded()
+        try:
+            qty = float(qty)
+            discount = float(discount)
+        except (TypeError, ValueError):
+            raise ShopError("Invalid quantity or discount!")
+        # A negative quantity would hand reserved stock back to other terminals
+        if not math.isfinite(qty) or qty <= 0:
+            raise ShopError("Quantity must be more than zero!")
+
+        if prod_id not in self.products:
+            raise ShopError("Product ID not found!")
+        product = self.products[prod_id]
+
+        available = self.available(prod_id)
+        if qty > available:
+            raise ShopError(f"Insufficient stock! Available: {available:g}")
+
+        if not math.isfinite(discount) or discount < 0 or discount > 100:
+            raise ShopError("Discount must be between 0 and 100%!")
+
+        rate = money.gst_rate(product.category)
+        amounts = money.line_amounts(qty, product.price, discount, rate)
+        gross, off, tax = amounts
+        item = models.CartItem(prod_id, product.name, product.category, qty, product.price, discount,
+                               money.to_rupees(gross - off), rate, money.to_rupees(tax))
+        self.carts.setdefault(terminal, []).append(item)
+        self.cart_totals.setdefault(terminal, money.CartTotals()).add(amounts)
+        self.reserved[prod_id] += qty
+        return item
+
+    def remove_from_cart(self, index, terminal=LOCAL_TERMINAL):
+        try:
+            item = self.carts.get(terminal, []).pop(index)
+        except IndexError:
+            raise ShopError("Cart item not found!")
+        self.cart_totals[terminal].add(money.item_amounts(item), -1)
+        self._release(item)
+        return item
+
+    def clear_cart(self, terminal=LOCAL_TERMINAL):
+        self.cart_totals.pop(terminal, None)
+        for item in self.carts.pop(terminal, []):
+            self._release(item)
+
+    def _release(self, item):
+        self.reserved[item.prod_id] -= item.qty
+        if self.reserved[item.prod_id] <= 0:
+            del self.reserved[item.prod_id]
+
+    def cart_summary(self, terminal=LOCAL_TERMINAL):
+        """Subtotal, discount, GST and total for a terminal's cart, from its running totals"""
+        totals = self.cart_totals.get(terminal)
+        return (totals or money.CartTotals()).summary()
+
+    def checkout(self, cust_id, on_committed=None, terminal=LOCAL_TERMINAL):
+        """Turn a terminal's cart into an order and return it.
+
+        The cart's stock was reserved as items were added; it is checked once
+        more and the order, sale and stock changes are committed together.
+        With a background worker the order is only durable once
+        on_committed(order, error) has been called with error None.
+        """
+        self._check_loaded()
+        cart = self.carts.get(terminal)
+        if not cart:
+            raise ShopError("Cart is empty!")
+
+        if not cust_id:
+            raise ShopError("Please select a customer!")
+        if cust_id not in self.customers:
+            raise ShopError("Customer ID not found!")
+        customer = self.customers[cust_id]
+
+        # Reserved stock can still vanish if a product was deleted or its stock edited down
+        needed = defaultdict(float)
+        for item in cart:
+            needed[item.prod_id] += item.qty
+        for prod_id, qty in needed.items():
+            if prod_id not in self.products:
+                raise ShopError(f"Product {prod_id} is no longer available!")
+            if qty > self.products[prod_id].stock:
+                raise ShopError(f"Insufficient stock for {self.products[prod_id].name}! "
+                                f"Available: {self.products[prod_id].stock}")
+
+        summary = self.cart_summary(terminal)
+
+        # Next number from the persisted sequence, so ids never repeat
+        self.order_seq += 1
+        order_id = f"ORD{self.order_seq:05d}"
+
+        now = datetime.now()
+        order = models.Order(order_id, cust_id, customer.name, now.strftime(DATE_FORMAT),
+                             cart.copy(), summary['subtotal'], summary['discount'],
+                             summary['tax'], summary['total'], 'Pending')
+
+        self.orders.add(order)
+        self.customer_history.add(order)
+        self.date_index.add(order)
+        self.line_items.add(order, self.products)
+        self.rollup.order_added(order_id)
+        ops = [storage.append('orders', order.to_record()),
+               self._record_sale(order, order.total, now),
+               storage.put('sequences', 'orders', self.order_seq)]
+        sale = self.sales_history[-1]
+
+        # Update stock
+        first_move = len(self.stock_moves)
+        ops += self._move_stock({prod_id: -qty for prod_id, qty in needed.items()}, 'sale', order_id, now)
+        moves = self.stock_moves[first_move:]
+
+        self._notify('orders', 'added', order_id, order)
+        self._notify_stock(order)
+
+        # Order, sale and stock changes are journaled as one commit
+        self._commit(ops, on_committed and (lambda error: on_committed(order, error)),
+                     undo=lambda: self._undo_checkout(order, sale, moves, needed))
+
+        self.clear_cart(terminal)
+        return order
+
+    def _undo_checkout(self, order, sale, moves, needed):
+        """Take an order whose commit failed back out of memory, stock included"""
+        self.orders.remove(order)
+        self.customer_history.remove(order, self.orders.for_customer(order.customer_id))
+        self.date_index.remove(order)
+        self.rollup.order_removed(order.order_id)
+        self.sales_history.remove(sale)
+        self.metrics.sale_removed(sale)
+
+        ops = []
+        for prod_id, qty in needed.items():
+            product = self.products.get(prod_id)
+            if product is not None:
+                product.stock += qty
+                self.low_stock.update(prod_id, product)
+                ops.append(storage.update('products', prod_id, stock=product.stock))
+        dropped = set(map(id, moves))
+        self.stock_moves[:] = [move for move in self.stock_moves if id(move) not in dropped]
+        self.stock_ledger.rebuild(self.stock_moves, self.products)
+        if isinstance(self.storage, storage.AsyncStorage):
+            # Commits queued behind the failed one may have stored stock levels that counted it
+            self._commit(ops)
+
+        self._notify('orders', 'deleted', order.order_id)
+        self._notify_stock(order)
+
+    def save_invoice(self, order):
+        """Write the invoice text file for an order and return its name"""
+        invoice_text = self.create_invoice_text(order, invoices.customer_for(order, self.customers))
+        filename = invoices.invoice_filename(order)
+        with open(filename, 'w') as f:
+            f.write(invoice_text)
+        return filename
+
+    def create_invoice_text(self, order, customer):
+        return invoices.render_invoice(order, customer)
+
+    def invoice_batch(self, date_from=None, date_to=None):
+        """Copies of the orders in a date range (all if None) and of their customers.
+
+        Taken on the thread that changes the engine, so the invoices can be
+        rendered on another while orders and customers keep changing.
+        """
+        if date_from is None and date_to is None:
+            orders = list(self.orders)
+        else:
+            # An open end of the range runs to the first order / today
+            if date_to is None:
+                date_to = datetime.now().date()
+            if date_from is None:
+                date_from = self.date_index.days[0] if self.date_index.days else date_to
+            orders = self.orders_between(date_from, date_to)
+        with gc_paused():
+            orders = [order.copy() for order in orders]
+            customers = {cust_id: self.customers[cust_id].copy()
+                         for cust_id in {order.customer_id for order in orders} if cust_id in self.customers}
+        return orders, customers
+
+    def export_invoices(self, target, date_from=None, date_to=None, archive=True, workers=None):
+        """Batch render stored invoices (optionally for a date range) to a zip or directory"""
+        orders, customers = self.invoice_batch(date_from, date_to)
+        return invoices.export_invoices(orders, customers, target, archive=archive, workers=workers)
+
+    # Order functions
+    def update_order_status(self, order_id, status):
+        """Set an order's status.
+
+        Cancelling an order puts its stock back and reverses its sale in the
+        sales history; moving a cancelled order to another status takes the
+        stock and the sale again. The order, sales history, stock and ledger
+        are committed together, and the running totals adjusted in place.
+        """
+        self._check_loaded()
+        order = self.orders.get(order_id)
+        if order is None:
+            raise ShopError("Order not found!")
+
+        cancelling = order.status != 'Cancelled' and status == 'Cancelled'
+        reopening = order.status == 'Cancelled' and status != 'Cancelled' and order.restocked
+        fields = {'status': status}
+        if cancelling or reopening:
+            fields['restocked'] = cancelling
+        ops = [storage.update('orders', order_id, **fields)]
+        if cancelling or reopening:
+            # What is left of the order after any returns
+            changes = defaultdict(float)
+            for item, qty, _ in order.net_items():
+                changes[item.prod_id] += qty if cancelling else -qty
+            if reopening:
+                for prod_id, qty in changes.items():
+                    if prod_id not in self.products:
+                        raise ShopError(f"Product {prod_id} is no longer available!")
+                    if -qty > self.available(prod_id):
+                        raise ShopError(f"Insufficient stock for {self.products[prod_id].name}! "
+                                        f"Available: {self.available(prod_id):g}")
+
+            now = datetime.now()
+            if cancelling:
+                ops.append(self._record_sale(order, -order.net_total, now, 'cancellation'))
+                ops += self._move_stock(changes, 'cancellation', order_id, now)
+            else:
+                ops.append(self._record_sale(order, order.net_total, now, 'reopened'))
+                ops += self._move_stock(changes, 'sale', order_id, now)
+
+        self.rollup.status_changed(order_id, order.status, status)
+        self.customer_history.status_changed(order, order.status, status)
+        self.orders.set_status(order, status)
+        if cancelling or reopening:
+            order.restocked = cancelling
+
+        self._commit(ops)
+        self._notify('orders', 'updated', order_id, order)
+        if cancelling or reopening:
+            self._notify_stock(order)
+        return order
+
+    def return_items(self, order_id, quantities):
+        """Take back part of an order and return the refund record.
+
+        `quantities` maps item line numbers (from 0) to the quantity returned.
+        Each line refunds its share of the discounted amount plus the GST
+        charged on it. Stock, a reversing sales history entry and the order's
+        returns are committed together, and the running totals adjusted in
+        place.
+        """
+        self._check_loaded()
+        order = self.orders.get(order_id)
+        if order is None:
+            raise ShopError("Order not found!")
+        if order.status == 'Cancelled':
+            raise ShopError("Items of a cancelled order cannot be returned!")
+
+        net = order.net_items()
+        refunded_tax = defaultdict(int)
+        for ret in order.returns:
+            for line in ret['items']:
+                refunded_tax[line['line']] += money.to_paise(line.get('tax', 0))
+        taxable = money.to_paise(order.subtotal - order.discount)
+
+        lines = []
+        left = 0.0
+        for line, (item, remaining, remaining_total) in enumerate(net):
+            try:
+                qty = float(quantities.get(line) or 0)
+            except (TypeError, ValueError):
+                raise ShopError("Invalid quantity!")
+            if not math.isfinite(qty):
+                raise ShopError("Invalid quantity!")
+            if qty < 0 or qty > remaining:
+                raise ShopError(f"Only {remaining:g} {item.name} can be returned!")
+            left += remaining - qty
+            if not qty:
+                continue
+            # The last of a line refunds exactly what is left of it
+            if qty == remaining:
+                amount = money.to_paise(remaining_total)
+            else:
+                amount = money.share(money.to_paise(item.total), qty, item.qty)
+            if item.tax is None:
+                # Sold at the old flat rate: GST in proportion to the order's
+                tax = money.share(money.to_paise(order.tax), amount, taxable) if taxable else 0
+            elif qty == remaining:
+                tax = money.to_paise(item.tax) - refunded_tax[line]
+            else:
+                tax = money.share(money.to_paise(item.tax), qty, item.qty)
+            lines.append({'line': line, 'qty': qty, 'amount': money.to_rupees(amount),
+                          'tax': money.to_rupees(tax)})
+        if set(quantities) - set(range(len(net))):
+            raise ShopError("Order item not found!")
+        if not lines:
+            raise ShopError("Nothing to return!")
+
+        amount = sum(money.to_paise(line['amount']) for line in lines)
+        if left:
+            total = amount + sum(money.to_paise(line['tax']) for line in lines)
+        else:
+            # Returning everything that is left refunds the rest of the order
+            total = money.to_paise(order.net_total)
+        now = datetime.now()
+        ret = {'date': now.strftime(DATE_FORMAT), 'items': lines,
+               'tax': money.to_rupees(total - amount), 'total': money.to_rupees(total)}
+
+        self.rollup.items_returned(order_id, ret)
+        self.customer_history.items_returned(order, ret)
+        order.returns.append(ret)
+
+        changes = defaultdict(float)
+        for line in lines:
+            changes[order.items[line['line']].prod_id] += line['qty']
+        ops = [storage.update('orders', order_id, returns=list(order.returns)),
+               self._record_sale(order, -ret['total'], now, 'return')]
+        ops += self._move_stock(changes, 'return', order_id, now)
+        self._commit(ops)
+
+        self._notify('orders', 'updated', order_id, order)
+        self._notify_stock(order)
+        return ret
+
+    def _record_sale(self, order, total, when, kind=None):
+        """Append a sales history entry (negative for refunds); returns its journal operation"""
+        sale = {
+            'date': when.strftime(DAY_FORMAT),
+            'order_id': order.order_id,
+            'customer': order.customer_name,
+            'total': total
+        }
+        if kind is not None:
+            sale['kind'] = kind
+        self.sales_history.append(sale)
+        self.metrics.sale_recorded(sale)
+        return storage.append('sales_history', sale)
+
+    def _move_stock(self, changes, kind, ref, when):
+        """Apply {prod_id: qty} stock changes for an order; returns the journal operations.
+
+        Products deleted since the order was placed are skipped.
+        """
+        ops = []
+        for prod_id, qty in changes.items():
+            product = self.products.get(prod_id)
+            if product is None or not qty:
+                continue
+            product.stock += qty
+            self.low_stock.update(prod_id, product)
+            ops.append(self._record_move(prod_id, qty, kind, ref, when))
+            ops.append(storage.update('products', prod_id, stock=product.stock))
+        return ops
+
+    def _notify_stock(self, order):
+        for prod_id in {item.prod_id for item in order.items}:
+            if prod_id in self.products:
+                self._notify('products', 'updated', prod_id, self.products[prod_id])
+
+    def get_order(self, order_id):
+        return self.orders.get(order_id)
+
+    def orders_with_status(self, status):
+        """Orders currently in `status` (e.g. 'Pending'), in the order they entered it"""
+        return self.orders.with_status(status)
+
+    def customer_orders(self, cust_id, page=0, page_size=HISTORY_PAGE_SIZE):
+        """One page of a customer's orders, newest first, and the number of pages"""
+        orders = self.orders.by_customer.get(cust_id, [])
+        pages = max(1, -(-len(orders) // page_size))
+        end = len(orders) - page * page_size
+        return orders[max(0, end - page_size):max(0, end)][::-1], pages
+
+    def customer_summary(self, cust_id, top=5):
+        """Lifetime spend, order count, last visit and top items for a customer"""
+        return self.customer_history.summary(cust_id, top)
+
+    # Report functions
+    def dashboard_metrics(self):
+        """Key figures shown on the dashboard cards, read from running totals"""
+        return {
+            'products': len(self.products),
+            'customers': len(self.customers),
+            'orders': len(self.orders),
+            'revenue': self.metrics.revenue,
+            'low_stock': len(self.low_stock),
+            'pending': self.orders.count('Pending'),
+        }
+
+    def low_stock_products(self, limit=None):
+        """(prod_id, product) pairs below their reorder level, largest shortfall first"""
+        return [(prod_id, self.products[prod_id]) for prod_id in self.low_stock.most_urgent(limit)]
+
+    def reorder_suggestions(self, days=REORDER_WINDOW_DAYS, cover_days=REORDER_COVER_DAYS):
+        """Products to reorder, most urgent first.
+
+        Sales velocity is the average quantity sold per day over the last
+        `days` days, read from the daily sales rollup. Candidates are the
+        low-stock products plus those selling fast enough to drop below their
+        level within `cover_days`; the suggested quantity brings stock back
+        to the reorder level plus `cover_days` of sales.
+        """
+        today = datetime.now().date()
+        sold = self.rollup.product_qty(today - timedelta(days=days - 1), today)
+        candidates = set(self.low_stock.shortfall)
+        for prod_id, qty in sold.items():
+            product = self.products.get(prod_id)
+            if product is not None and product.stock - qty / days * cover_days < reorder_level(product):
+                candidates.add(prod_id)
+
+        suggestions = []
+        for prod_id in candidates:
+            product = self.products[prod_id]
+            level = reorder_level(product)
+            per_day = max(sold.get(prod_id, 0.0), 0.0) / days
+            quantity = math.ceil(level + per_day * cover_days - product.stock)
+            if quantity <= 0:
+                continue
+            suggestions.append({
+                'prod_id': prod_id,
+                'name': product.name,
+                'unit': product.unit,
+                'stock': product.stock,
+                'reorder_level': level,
+                'per_day': per_day,
+                'days_left': product.stock / per_day if per_day else None,
+                'quantity': quantity
+            })
+        # Products that sell run out soonest first, then unsold ones by shortfall
+        suggestions.sort(key=lambda s: (s['days_left'] is None,
+                                        s['days_left'] if s['days_left'] is not None
+                                        else s['stock'] - s['reorder_level']))
+        return suggestions
+
+    def orders_between(self, date_from, date_to):
+        """Orders placed on or between two dates (inclusive), via the date index"""
+        start = datetime.combine(date_from, time.min)
+        end = datetime.combine(date_to, time.max)
+        return list(self.date_index.between(start, end))
+
+    def generate_report(self, date_from=None, date_to=None):
+        """Sales report for the given dates, or for all history if none are given"""
+        return ''.join(self.report_lines(date_from, date_to))
+
+    def export_report(self, filename, date_from=None, date_to=None):
+        """Write the report straight to a file, one line at a time"""
+        with open(filename, 'w') as f:
+            f.writelines(self.report_lines(date_from, date_to))
+
+    def report_lines(self, date_from=None, date_to=None):
+        """Validate the range and total it up front, then return a generator of report lines"""
+        if date_from is None and date_to is None:
+            order_count = len(self.orders)
+            total_revenue = self.metrics.revenue
+            period = "All time"
+            category_sales, product_sales = self.rollup.totals()
+        else:
+            # An open end of the range runs to the first order / today
+            if date_to is None:
+                date_to = datetime.now().date()
+            if date_from is None:
+                date_from = self.date_index.days[0] if self.date_index.days else date_to
+            if date_from > date_to:
+                raise ShopError("'Date From' must not be after 'Date To'!")
+            orders = self.orders_between(date_from, date_to)
+            order_count = len(orders)
+            total_revenue = money.to_rupees(sum(money.to_paise(order.net_total) for order in orders
+                                                if order.status != 'Cancelled'))
+            period = f"{date_from.strftime(DAY_FORMAT)} to {date_to.strftime(DAY_FORMAT)}"
+            # One pass over the line item columns in the range
+            category_sales, product_sales = self.line_items.totals(date_from, date_to)
+
+        return self._report_lines(period, total_revenue, order_count, category_sales, product_sales)
+
+    def _report_lines(self, period, total_revenue, order_count, category_sales, product_sales):
+        yield "=" * 80 + "\n"
+        yield " " * 25 + "KABRAJI SALES REPORT\n"
+        yield "=" * 80 + "\n\n"
+        yield f"Generated on: {datetime.now().strftime(DATE_FORMAT)}\n"
+        yield f"Period: {period}\n\n"
+
+        # Total sales
+        yield f"TOTAL REVENUE: ₹{total_revenue:,.2f}\n"
+        yield f"TOTAL ORDERS: {order_count}\n"
+        yield f"TOTAL CUSTOMERS: {len(self.customers)}\n\n"
+
+        # Sales by category
+        yield "-" * 80 + "\n"
+        yield "SALES BY CATEGORY (excluding cancelled orders):\n"
+        yield "-" * 80 + "\n"
+
+        for category, amount in category_sales.items():
+            yield f"{category:<30} ₹{amount:>15,.2f}\n"
+
+        yield "\n"
+
+        # Top products
+        yield "-" * 80 + "\n"
+        yield "TOP 10 SELLING PRODUCTS:\n"
+        yield "-" * 80 + "\n"
+
+        top_products = heapq.nlargest(10, product_sales.items(), key=lambda x: x[1]['revenue'])
+
+        for i, (prod_name, data) in enumerate(top_products, 1):
+            yield f"{i}. {prod_name:<40} Qty: {data['qty']:>8.2f}  Revenue: ₹{data['revenue']:>12,.2f}\n"
+
+        yield "\n"
+
+        # Low stock alert
+        yield "-" * 80 + "\n"
+        yield "LOW STOCK ALERT (Stock below reorder level):\n"
+        yield "-" * 80 + "\n"
+
+        # Collected in one step so a product edited mid-stream cannot break the iteration
+        low_stock_items = self.low_stock_products()
+
+        if low_stock_items:
+            for prod_id, prod in low_stock_items:
+                yield (f"{prod_id} - {prod.name:<40} Stock: {prod.stock} {prod.unit} "
+                       f"(reorder at {reorder_level(prod)})\n")
+        else:
+            yield "No low stock items!\n"
+
+        yield "\n"
+
+        # Reorder suggestions
+        yield "-" * 80 + "\n"
+        yield (f"REORDER SUGGESTIONS (sales over the last {REORDER_WINDOW_DAYS} days, "
+               f"{REORDER_COVER_DAYS} days of cover):\n")
+        yield "-" * 80 + "\n"
+
+        suggestions = self.reorder_suggestions()
+        if suggestions:
+            for s in suggestions:
+                days_left = f"{s['days_left']:.0f}" if s['days_left'] is not None else "-"
+                yield (f"{s['prod_id']} - {s['name']:<40} Order: {s['quantity']} {s['unit']}  "
+                       f"Stock: {s['stock']}  Sold/day: {s['per_day']:.2f}  Days left: {days_left}\n")
+        else:
+            yield "Nothing to reorder!\n"
+
+        yield "\n" + "=" * 80 + "\n"
+
+    # Data persistence
+    def save_data(self):
+        """Write a full snapshot of the current state"""
+        data = {
+            'products': models.records(self.products),
+            'customers': models.records(self.customers),
+            'orders': [order.to_record() for order in self.orders],
+            'sales_history': self.sales_history,
+            'stock_moves': self.stock_moves,
+            'sequences': {'orders': self.order_seq}
+        }
+        self.storage.write_snapshot(data)
+
+    def load_data(self):
+        """Load the last snapshot and replay the journal on top of it"""
+        self._install_state(self._read_catalog())
+        self._install_state(self._read_orders(self.products, self.order_seq))
+
+    def replace_data(self, data):
+        """Swap in a full set of records and rebuild everything derived from it"""
+        with gc_paused():
+            catalog = self._build_catalog(data)
+            state = self._build_orders(data, catalog['products'], catalog['order_seq'])
+        self._install_state(catalog)
+        self._install_state(state)
+
+    def reload_catalog(self):
+        """Re-read products and customers, e.g. a terminal's mirror after sales on the server"""
+        self._install_state(self._read_catalog())
+
+    @property
+    def load_problems(self):
+        """Descriptions of the damaged records skipped by the last load"""
+        # Both halves of a load report the same copies of the damaged files
+        return list(dict.fromkeys(self.catalog_problems + self.order_problems))
+
+    def _read_catalog(self):
+        # Like _read_orders, safe to run on the worker thread
+        with gc_paused():
+            data = self.storage.load_catalog()
+            return self._build_catalog(data, self.storage.problems)
+
+    def _read_orders(self, products, order_seq):
+        # Safe to run on the worker thread: only reads storage and builds new objects
+        with gc_paused():
+            data = self.storage.load_orders()
+            return self._build_orders(data, products, order_seq, self.storage.problems)
+
+    def _build_catalog(self, data, problems=()):
+        """Products, customers and their search indexes, without touching the engine"""
+        problems = list(problems)
+        products = _load_models(models.Product, data['products'], 'products', problems)
+        customers = _load_models(models.Customer, data['customers'], 'customers', problems)
+        if problems:
+            self._keep_copy(problems)
+        state = {
+            'products': products,
+            'customers': customers,
+            'order_seq': data.get('sequences', {}).get('orders', 0),
+            'product_search': SearchIndex(('name', 'category')),
+            'customer_search': SearchIndex(('name', 'phone')),
+            'low_stock': LowStockIndex(),
+            'catalog_problems': problems,
+        }
+        state['low_stock'].rebuild(products)
+        state['product_search'].rebuild(products)
+        state['customer_search'].rebuild(customers)
+        return state
+
+    def _build_orders(self, data, products, order_seq, problems=()):
+        """Orders, sales history and every index derived from them, without touching the engine"""
+        problems = list(problems)
+        orders = OrderRepository()
+        orders.rebuild(_load_models(models.Order, dict(enumerate(data['orders'], 1)),
+                                    'orders', problems).values())
+        if problems:
+            self._keep_copy(problems)
+        state = {
+            'orders': orders,
+            'sales_history': data['sales_history'],
+            # Data saved before the ledger existed has no movements yet
+            'stock_moves': data.get('stock_moves', []),
+            'stock_ledger': StockLedger(),
+            # Data saved before the sequence existed continues from its highest id
+            'order_seq': max(order_seq, orders.highest_number()),
+            'metrics': ShopMetrics(),
+            'date_index': OrderDateIndex(),
+            'customer_history': CustomerHistory(),
+            'line_items': LineItemStore(),
+            'order_problems': problems,
+        }
+        state['metrics'].rebuild(data['sales_history'])
+        state['date_index'].rebuild(orders)
+        state['customer_history'].rebuild(orders)
+        state['line_items'].rebuild(orders, products)
+        state['stock_ledger'].rebuild(state['stock_moves'], products)
+        state['rollup'] = SalesRollup(state['line_items'])
+        state['rollup'].rebuild()
+        return state
+
+    def _keep_copy(self, problems):
+        # Damaged records are dropped by the next snapshot, so keep the originals
+        keep_copy = getattr(self.storage, 'keep_copy', None)
+        if keep_copy is not None:
+            problems.append("Copies of the data files as loaded: " + ", ".join(keep_copy()))
+
+    def _install_state(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+        if 'products' in state:
+            self._notify('products', 'reset', record=self.products.items())
+            self._notify('customers', 'reset', record=self.customers.items())
+        if 'orders' in state:
+            self._notify('orders', 'reset', record=((o.order_id, o) for o in self.orders))
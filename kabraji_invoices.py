@@ -0,0 +1,178 @@
+"""Invoice rendering and batch export.
+
+Usage:
+    python kabraji_invoices.py --zip invoices.zip
+    python kabraji_invoices.py --from 01/03/2026 --to 31/03/2026 --dir invoices/
+
+Invoices are rendered from a precompiled template, in a process pool, and
+streamed into one zip archive or into per-order files.
+"""
+import argparse
+import multiprocessing
+import os
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from kabraji_models import Customer
+
+RULE = "=" * 70 + "\n"
+THIN_RULE = "-" * 70 + "\n"
+
+# Precompiled invoice template: header, one line per item, footer
+INVOICE_HEADER = (
+    RULE
+    + " " * 20 + "🏗️ KABRAJI\n"
+    + " " * 10 + "Building Dreams, One Product at a Time\n"
+    + " " * 8 + "Quality Paints, Sanitary & Building Materials\n"
+    + RULE + "\n"
+    + "INVOICE NO: {order_id}\n"
+    + "DATE: {date}\n"
+    + THIN_RULE + "\n"
+    + "CUSTOMER DETAILS:\n"
+    + "Name: {name}\n"
+    + "Phone: {phone}\n"
+    + "Email: {email}\n"
+    + "Address: {address}\n"
+    + "\n" + RULE
+    + f"{'ITEM':<30} {'QTY':<8} {'PRICE':<12} {'DISC%':<8} {'TOTAL':<12}\n"
+    + RULE
+)
+INVOICE_LINE = ("{0.name:<30} {0.qty:<8.2f} ₹{0.price:<10.2f} {0.discount:<7.1f}% "
+                "₹{0.total:<10.2f}\n")
+INVOICE_FOOTER = (
+    RULE
+    + f"{'':<50} Subtotal: ₹{{0.subtotal:>12.2f}}\n"
+    + f"{'':<50} Discount: ₹{{0.discount:>12.2f}}\n"
+    + f"{'':<50} GST: ₹{{0.tax:>12.2f}}\n"
+    + THIN_RULE
+    + f"{'':<50} TOTAL: ₹{{0.total:>12.2f}}\n"
+    + RULE + "\n"
+    + "Thank you for your business!\n"
+    + "For queries: contact@kabraji.com | Phone: +91-XXXXXXXXXX\n"
+    + RULE
+)
+
+# Orders per task sent to a worker process
+CHUNK_SIZE = 200
+
+
+def render_invoice(order, customer):
+    """Invoice text for one order"""
+    parts = [INVOICE_HEADER.format(order_id=order.order_id, date=order.date,
+                                   name=customer.name, phone=customer.phone,
+                                   email=customer.email, address=customer.address)]
+    parts.extend(INVOICE_LINE.format(item) for item in order.items)
+    parts.append(INVOICE_FOOTER.format(order))
+    return ''.join(parts)
+
+
+def invoice_filename(order):
+    return f"invoice_{order.order_id}.txt"
+
+
+def customer_for(order, customers):
+    customer = customers.get(order.customer_id)
+    if customer is None:
+        # The order's customer has since been deleted
+        customer = Customer(order.customer_name, phone='')
+    return customer
+
+
+def _render_chunk(pairs):
+    return [(invoice_filename(order), render_invoice(order, customer)) for order, customer in pairs]
+
+
+def _write_chunk(pairs, directory):
+    for filename, text in _render_chunk(pairs):
+        with open(os.path.join(directory, filename), 'w') as f:
+            f.write(text)
+    return len(pairs)
+
+
+def _chunks(orders, customers, size):
+    chunk = []
+    for order in orders:
+        chunk.append((order, customer_for(order, customers)))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def export_invoices(orders, customers, target, archive=True, workers=None, chunk_size=CHUNK_SIZE):
+    """Render invoices for `orders` into a zip archive or a directory.
+
+    Work is streamed to a process pool a few chunks at a time, so memory
+    stays bounded however many orders are exported. Returns a dict with
+    the invoice count, elapsed seconds and invoices per second.
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+    count = 0
+
+    if not archive:
+        os.makedirs(target, exist_ok=True)
+    zip_file = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) if archive else None
+
+    # spawn keeps worker processes independent of any GUI or threads in the parent
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            in_flight = deque()
+
+            def drain_one():
+                result = in_flight.popleft().result()
+                if zip_file is None:
+                    return result
+                for filename, text in result:
+                    zip_file.writestr(filename, text)
+                return len(result)
+
+            for chunk in _chunks(orders, customers, chunk_size):
+                if archive:
+                    in_flight.append(pool.submit(_render_chunk, chunk))
+                else:
+                    in_flight.append(pool.submit(_write_chunk, chunk, target))
+                if len(in_flight) >= workers * 2:
+                    count += drain_one()
+            while in_flight:
+                count += drain_one()
+    finally:
+        if zip_file is not None:
+            zip_file.close()
+
+    elapsed = time.perf_counter() - start
+    return {'invoices': count, 'seconds': elapsed,
+            'per_second': count / elapsed if elapsed else 0.0}
+
+
+def main(argv=None):
+    from datetime import datetime
+    from kabraji_engine import DAY_FORMAT, ShopEngine
+
+    parser = argparse.ArgumentParser(description="Batch export KABRAJI invoices")
+    parser.add_argument('--from', dest='date_from', help="first day, DD/MM/YYYY")
+    parser.add_argument('--to', dest='date_to', help="last day, DD/MM/YYYY")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--zip', help="write all invoices into this zip archive")
+    target.add_argument('--dir', help="write one invoice file per order into this directory")
+    parser.add_argument('--workers', type=int, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    date_from = datetime.strptime(args.date_from, DAY_FORMAT).date() if args.date_from else None
+    date_to = datetime.strptime(args.date_to, DAY_FORMAT).date() if args.date_to else None
+
+    engine = ShopEngine()
+    engine.load_data()
+    stats = engine.export_invoices(args.zip or args.dir, date_from, date_to,
+                                   archive=bool(args.zip), workers=args.workers)
+    engine.close()
+    print(f"Exported {stats['invoices']} invoices in {stats['seconds']:.2f}s "
+          f"({stats['per_second']:.0f} invoices/s)")
+
+
+if __name__ == "__main__":
+    main()
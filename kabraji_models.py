@@ -0,0 +1,231 @@
+"""Slotted models for products, customers, orders and cart items.
+
+The engine keeps these in memory instead of dicts. Each model converts to
+and from the plain dict record that is persisted (JSON snapshot/journal or
+SQLite rows), so the stored format is unchanged. Fields a model does not
+know about are kept in `extra` and written back out untouched.
+"""
+
+
+class Model:
+    __slots__ = ('extra',)
+
+    FIELDS = frozenset()
+
+    @classmethod
+    def _extra(cls, record):
+        if cls.FIELDS.issuperset(record):
+            return None
+        return {k: v for k, v in record.items() if k not in cls.FIELDS}
+
+    def _with_extra(self, record):
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.to_record() == other.to_record()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_record()!r})"
+
+    def copy(self):
+        """An independent copy, e.g. to hand to another thread"""
+        return self.from_record(self.to_record())
+
+
+class Product(Model):
+    __slots__ = ('name', 'category', 'price', 'stock', 'unit', 'reorder_level')
+
+    FIELDS = frozenset(__slots__)
+
+    def __init__(self, name, category, price, stock, unit, reorder_level=None, extra=None):
+        self.name = name
+        self.category = category
+        self.price = price
+        self.stock = stock
+        self.unit = unit
+        self.reorder_level = reorder_level  # None: the shop-wide default
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['name'], record['category'], record['price'], record['stock'],
+                   record['unit'], record.get('reorder_level'), cls._extra(record))
+
+    def to_record(self):
+        record = {
+            'name': self.name,
+            'category': self.category,
+            'price': self.price,
+            'stock': self.stock,
+            'unit': self.unit
+        }
+        if self.reorder_level is not None:
+            record['reorder_level'] = self.reorder_level
+        return self._with_extra(record)
+
+
+class Customer(Model):
+    __slots__ = ('name', 'phone', 'email', 'address')
+
+    FIELDS = frozenset(__slots__)
+
+    def __init__(self, name, phone, email='', address='', extra=None):
+        self.name = name
+        self.phone = phone
+        self.email = email
+        self.address = address
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['name'], record['phone'], record.get('email', ''),
+                   record.get('address', ''), cls._extra(record))
+
+    def to_record(self):
+        return self._with_extra({
+            'name': self.name,
+            'phone': self.phone,
+            'email': self.email,
+            'address': self.address
+        })
+
+
+class CartItem(Model):
+    """One line of the cart, and later of the order it is checked out into"""
+
+    __slots__ = ('prod_id', 'name', 'category', 'qty', 'price', 'discount', 'total',
+                 'gst_rate', 'tax')
+
+    FIELDS = frozenset(__slots__)
+
+    def __init__(self, prod_id, name, category, qty, price, discount, total,
+                 gst_rate=None, tax=None, extra=None):
+        self.prod_id = prod_id
+        self.name = name
+        self.category = category
+        self.qty = qty
+        self.price = price
+        self.discount = discount
+        self.total = total  # after discount, before GST
+        self.gst_rate = gst_rate  # percent; None on items sold at the old flat rate
+        self.tax = tax
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, record):
+        # Items saved before categories or per-item GST were recorded have none
+        return cls(record['prod_id'], record['name'], record.get('category'), record['qty'],
+                   record['price'], record['discount'], record['total'], record.get('gst_rate'),
+                   record.get('tax'), cls._extra(record))
+
+    def to_record(self):
+        record = {
+            'prod_id': self.prod_id,
+            'name': self.name,
+            'qty': self.qty,
+            'price': self.price,
+            'discount': self.discount,
+            'total': self.total
+        }
+        if self.category is not None:
+            record['category'] = self.category
+        if self.gst_rate is not None:
+            record['gst_rate'] = self.gst_rate
+            record['tax'] = self.tax
+        return self._with_extra(record)
+
+
+class Order(Model):
+    __slots__ = ('order_id', 'customer_id', 'customer_name', 'date', 'items',
+                 'subtotal', 'discount', 'tax', 'total', 'status', 'returns')
+
+    FIELDS = frozenset(__slots__)
+
+    def __init__(self, order_id, customer_id, customer_name, date, items,
+                 subtotal, discount, tax, total, status, returns=None, extra=None):
+        self.order_id = order_id
+        self.customer_id = customer_id
+        self.customer_name = customer_name
+        self.date = date
+        self.items = items
+        self.subtotal = subtotal
+        self.discount = discount
+        self.tax = tax
+        self.total = total
+        self.status = status
+        # Partial returns, oldest first: {'date', 'items': [{'line', 'qty', 'amount', 'tax'}], 'tax', 'total'}
+        self.returns = returns or []
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record['order_id'], record['customer_id'], record['customer_name'],
+                   record['date'], [CartItem.from_record(item) for item in record['items']],
+                   record['subtotal'], record['discount'], record['tax'], record['total'],
+                   record['status'], record.get('returns'), cls._extra(record))
+
+    def copy(self):
+        # Items never change once checked out and returns are only appended,
+        # so fresh lists make a copy the engine can no longer reach into
+        return Order(self.order_id, self.customer_id, self.customer_name, self.date,
+                     list(self.items), self.subtotal, self.discount, self.tax, self.total,
+                     self.status, list(self.returns), self.extra)
+
+    @property
+    def restocked(self):
+        """True while a cancellation has given back this order's stock and sale.
+
+        Kept in extra; orders cancelled before cancellations were reversed
+        do not have it, and kept their stock and sale.
+        """
+        return bool(self.extra and self.extra.get('restocked'))
+
+    @restocked.setter
+    def restocked(self, value):
+        # A new dict, as copies share extra
+        self.extra = {**(self.extra or {}), 'restocked': value}
+
+    @property
+    def net_total(self):
+        """Total less everything refunded for returns"""
+        if not self.returns:
+            return self.total
+        # Amounts are whole paise; rounding drops the float error of the subtraction
+        return round(self.total - sum(ret['total'] for ret in self.returns), 2)
+
+    def net_items(self):
+        """(item, qty, total) per line, less what has been returned"""
+        if not self.returns:
+            return [(item, item.qty, item.total) for item in self.items]
+        net = [[item, item.qty, item.total] for item in self.items]
+        for ret in self.returns:
+            for line in ret['items']:
+                net[line['line']][1] -= line['qty']
+                net[line['line']][2] -= line['amount']
+        return [(item, qty, round(total, 2)) for item, qty, total in net]
+
+    def to_record(self):
+        record = {
+            'order_id': self.order_id,
+            'customer_id': self.customer_id,
+            'customer_name': self.customer_name,
+            'date': self.date,
+            'items': [item.to_record() for item in self.items],
+            'subtotal': self.subtotal,
+            'discount': self.discount,
+            'tax': self.tax,
+            'total': self.total,
+            'status': self.status
+        }
+        if self.returns:
+            record['returns'] = self.returns
+        return self._with_extra(record)
+
+
+def records(models):
+    """Mapping of key -> model as key -> record, for snapshots"""
+    return {key: model.to_record() for key, model in models.items()}
@@ -0,0 +1,84 @@
+"""Exact money arithmetic for carts, orders and running totals.
+
+Amounts are worked in integer paise. Decimal is only used where a price is
+multiplied by a quantity or a percentage and has to be rounded, half up as
+on a printed bill. Records keep storing rupees as floats, but every amount
+written is a whole number of paise, so reading it back is exact.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+
+# GST percent per product category; categories not listed use the default
+DEFAULT_GST_RATE = 18.0
+GST_SLABS = {
+    "Paints": 18.0,
+    "Sanitary": 18.0,
+    "Building Materials": 18.0,
+}
+
+
+def gst_rate(category):
+    """GST percent charged on products of a category"""
+    return GST_SLABS.get(category, DEFAULT_GST_RATE)
+
+
+def _round(amount):
+    return int(amount.to_integral_value(ROUND_HALF_UP))
+
+
+def to_paise(rupees):
+    """Whole paise in a stored rupee amount"""
+    # Stored amounts are already whole paise, so plain rounding is exact and fast
+    return round(rupees * 100)
+
+
+def to_rupees(paise):
+    return paise / 100
+
+
+def share(paise, part, whole):
+    """`part` of `whole` of an amount, e.g. the refund for 2 of 5 items"""
+    return _round(Decimal(paise) * Decimal(str(part)) / Decimal(str(whole)))
+
+
+def line_amounts(qty, price, discount, rate):
+    """(gross, discount, tax) in paise of `qty` at `price` less `discount` percent plus `rate` percent GST"""
+    gross = _round(Decimal(str(qty)) * Decimal(str(price)) * 100)
+    off = _round(gross * Decimal(str(discount)) / 100)
+    tax = _round((gross - off) * Decimal(str(rate)) / 100)
+    return gross, off, tax
+
+
+def item_amounts(item):
+    """line_amounts() of a cart item, exactly as they were when it was added"""
+    return line_amounts(item.qty, item.price, item.discount, item.gst_rate)
+
+
+class CartTotals:
+    """Running subtotal, discount and GST of a cart in paise.
+
+    Lines are added and taken off as they go in and out of the cart, so the
+    summary is read in constant time and is the same set of figures that
+    ends up on the order.
+    """
+
+    __slots__ = ('subtotal', 'discount', 'tax')
+
+    def __init__(self):
+        self.subtotal = 0
+        self.discount = 0
+        self.tax = 0
+
+    def add(self, amounts, sign=1):
+        gross, off, tax = amounts
+        self.subtotal += sign * gross
+        self.discount += sign * off
+        self.tax += sign * tax
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount + self.tax
+
+    def summary(self):
+        """The totals in rupees, as shown and as stored on the order"""
+        return {'subtotal': to_rupees(self.subtotal), 'discount': to_rupees(self.discount),
+                'tax': to_rupees(self.tax), 'total': to_rupees(self.total)}
@@ -0,0 +1,347 @@
+"""Local shop server so several billing terminals can sell from one inventory.
+
+Usage:
+    KABRAJI_SERVE=127.0.0.1:8765 python kabraji.py    # the shop's own app, serving terminals
+    KABRAJI_SERVER=127.0.0.1:8765 python kabraji.py   # run the app as a terminal
+    python kabraji_server.py                      # serve on 127.0.0.1:8765 without a window
+
+The serving process owns the data files and the only ShopEngine that writes
+them. Terminals talk to it over a small JSON HTTP API: each terminal has
+its own cart, stock is reserved as items go into it, and checkout commits
+the order and the stock changes in one step. Requests are handled one at a
+time, so two terminals can never sell the same stock. Hosted in the Tk
+app, they run on the app's own thread between its other changes, so
+products, customers and order statuses are edited in that app as usual.
+"""
+import argparse
+import json
+import math
+import os
+import queue
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import kabraji_models as models
+from kabraji_engine import ShopEngine, ShopError
+from kabraji_storage import Job
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Set to host:port to run the Tk app as a terminal of a shop server
+SERVER_ENV = 'KABRAJI_SERVER'
+
+# Set to host:port to have the Tk app serve terminals from its own engine
+SERVE_ENV = 'KABRAJI_SERVE'
+
+# Carts untouched for this long give their reserved stock back
+CART_TTL = 30 * 60
+
+# Seconds a terminal waits for the server
+CLIENT_TIMEOUT = 10
+
+
+def parse_address(address):
+    """(host, port) from 'host:port' or just 'port'"""
+    host, _, port = address.rpartition(':')
+    try:
+        return host or DEFAULT_HOST, int(port)
+    except ValueError:
+        raise ShopError(f"Invalid server address {address!r}, expected host:port")
+
+
+class ShopServer(ThreadingHTTPServer):
+    """HTTP front end for a ShopEngine; requests run one at a time.
+
+    By default each request runs on its handler thread under one lock. With
+    polled=True requests are queued instead and run by poll(), which the
+    thread owning the engine (the Tk app's) calls, so the engine is never
+    changed from two threads at once.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, engine, host=DEFAULT_HOST, port=DEFAULT_PORT, cart_ttl=CART_TTL,
+                 polled=False):
+        super().__init__((host, port), _Handler)
+        self.engine = engine
+        self.cart_ttl = cart_ttl
+        self.lock = threading.Lock()
+        self.requests = queue.Queue() if polled else None
+        self.last_seen = {}  # terminal -> time of its last cart request
+
+    def start(self):
+        """Serve on a background thread, e.g. next to a Tk mainloop"""
+        threading.Thread(target=self.serve_forever, name='kabraji-server', daemon=True).start()
+
+    def run(self, func, *args):
+        """Run func(*args) where the engine may be changed and return its result"""
+        with self.lock:
+            if self.requests is None:
+                return func(*args)
+            job = Job(func, args, None)
+            self.requests.put(job)
+            return job.wait()
+
+    def poll(self):
+        """Run queued requests in the calling thread"""
+        while True:
+            try:
+                job = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                job.result = job.func(*job.args)
+            except Exception as e:
+                job.error = e
+            job.finished.set()
+
+    def touch(self, terminal):
+        """Note a terminal's activity and release carts that have gone idle"""
+        now = time.monotonic()
+        self.last_seen[terminal] = now
+        for other, seen in list(self.last_seen.items()):
+            if now - seen > self.cart_ttl:
+                self.engine.clear_cart(other)
+                del self.last_seen[other]
+
+
+def _cart_state(engine, terminal):
+    return {'items': [item.to_record() for item in engine.carts.get(terminal, [])],
+            'summary': engine.cart_summary(terminal)}
+
+
+class _Checkout:
+    """on_committed for a terminal's checkout; wait() returns once the order is on disk"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.record = None
+        self.error = None
+
+    def __call__(self, order, error):
+        if error is not None:
+            self.error = ShopError(f"Order {order.order_id} could not be saved and was not placed: {error}")
+        else:
+            self.record = order.to_record()
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.record
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routes:
+
+    GET    /data/catalog                  products, customers, sequences
+    GET    /data/orders                   orders, sales history, stock movements
+    GET    /cart/<terminal>               cart items and summary
+    POST   /cart/<terminal>/items         {prod_id, qty, discount}
+    DELETE /cart/<terminal>/items/<n>
+    DELETE /cart/<terminal>
+    POST   /cart/<terminal>/checkout      {customer_id} -> order
+    """
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        parts = [p for p in self.path.split('/') if p]
+        try:
+            body = self._read_body()
+            result = self.server.run(self._route, method, parts, body)
+            if isinstance(result, _Checkout):
+                # Outside run(), so the engine's thread is free to confirm the write
+                result = result.wait()
+        except ShopError as e:
+            self._reply(409, {'error': str(e)})
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': f"Bad request: {e}"})
+        else:
+            if result is None:
+                self._reply(404, {'error': f"Unknown request: {method} {self.path}"})
+            else:
+                self._reply(200, result)
+
+    def _route(self, method, parts, body):
+        engine = self.server.engine
+        if not engine.loaded:
+            raise ShopError("Shop data is still loading, please try again in a moment!")
+        if method == 'GET' and parts == ['data', 'catalog']:
+            return {'products': models.records(engine.products),
+                    'customers': models.records(engine.customers),
+                    'sequences': {'orders': engine.order_seq}}
+        if method == 'GET' and parts == ['data', 'orders']:
+            return {'orders': [order.to_record() for order in engine.orders],
+                    'sales_history': list(engine.sales_history),
+                    'stock_moves': list(engine.stock_moves)}
+        if len(parts) < 2 or parts[0] != 'cart':
+            return None
+
+        terminal, rest = parts[1], parts[2:]
+        self.server.touch(terminal)
+        if method == 'GET' and not rest:
+            return _cart_state(engine, terminal)
+        if method == 'DELETE' and not rest:
+            engine.clear_cart(terminal)
+            return _cart_state(engine, terminal)
+        if method == 'POST' and rest == ['items']:
+            engine.add_to_cart(body['prod_id'], body['qty'], body.get('discount', 0), terminal=terminal)
+            return _cart_state(engine, terminal)
+        if method == 'DELETE' and len(rest) == 2 and rest[0] == 'items':
+            engine.remove_from_cart(int(rest[1]), terminal=terminal)
+            return _cart_state(engine, terminal)
+        if method == 'POST' and rest == ['checkout']:
+            # Replied to once the order is on disk, also when the engine writes on a worker
+            checkout = _Checkout()
+            engine.checkout(body.get('customer_id'), on_committed=checkout, terminal=terminal)
+            return checkout
+        return None
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        if not isinstance(body, dict):
+            raise ValueError("expected a JSON object")
+        return body
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class ShopClient:
+    """A terminal's connection to a ShopServer.
+
+    Offers the engine's cart methods for this terminal, and serves as a
+    read-only storage backend so a local ShopEngine can mirror the server's
+    products, customers and orders for display.
+    """
+
+    read_only = True
+
+    def __init__(self, address, terminal=None):
+        self.base_url = f"http://{address}"
+        self.terminal = terminal or f"{socket.gethostname()}-{os.getpid()}"
+        self.problems = []
+        self.cart_items = []
+        self.summary = {'subtotal': 0.0, 'discount': 0.0, 'tax': 0.0, 'total': 0.0}
+
+    def _request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=CLIENT_TIMEOUT) as response:
+                return json.load(response)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e)['error']
+            except (ValueError, KeyError):
+                message = f"Shop server error {e.code}"
+            raise ShopError(message)
+        except (urllib.error.URLError, OSError) as e:
+            raise ShopError(f"Shop server is not reachable: {e}")
+
+    def _cart_request(self, method, path='', body=None):
+        state = self._request(method, f"/cart/{self.terminal}{path}", body)
+        self.cart_items = [models.CartItem.from_record(item) for item in state['items']]
+        self.summary = state['summary']
+        return self.cart_items
+
+    # Cart, mirroring ShopEngine's
+    def add_to_cart(self, prod_id, qty, discount=0):
+        try:
+            qty = float(qty)
+            discount = float(discount)
+        except (TypeError, ValueError):
+            raise ShopError("Invalid quantity or discount!")
+        if not math.isfinite(qty) or qty <= 0:
+            raise ShopError("Quantity must be more than zero!")
+        return self._cart_request('POST', '/items',
+                                  {'prod_id': prod_id, 'qty': qty, 'discount': discount})[-1]
+
+    def remove_from_cart(self, index):
+        item = self.cart_items[index]
+        self._cart_request('DELETE', f"/items/{index}")
+        return item
+
+    def clear_cart(self):
+        self._cart_request('DELETE')
+
+    def cart_summary(self):
+        return self.summary
+
+    def checkout(self, cust_id, on_committed=None):
+        """Check the cart out on the server; the order is durable once this returns"""
+        order = models.Order.from_record(
+            self._request('POST', f"/cart/{self.terminal}/checkout", {'customer_id': cust_id}))
+        self.cart_items = []
+        self.summary = {key: 0.0 for key in self.summary}
+        if on_committed is not None:
+            on_committed(order, None)
+        return order
+
+    # Read-only storage backend
+    def load(self):
+        state = self.load_catalog()
+        state.update(self.load_orders())
+        return state
+
+    def load_catalog(self):
+        return self._request('GET', '/data/catalog')
+
+    def load_orders(self):
+        return self._request('GET', '/data/orders')
+
+    def commit(self, ops):
+        raise ShopError("This terminal cannot change shop data, please use the shop server!")
+
+    write_snapshot = commit
+
+    def close(self):
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve one KABRAJI inventory to several terminals")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="address to listen on (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args(argv)
+
+    engine = ShopEngine()
+    engine.start()
+    server = ShopServer(engine, args.host, args.port)
+    print(f"KABRAJI shop server on {args.host}:{args.port} "
+          f"({len(engine.products)} products, {len(engine.orders)} orders)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()
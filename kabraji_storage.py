@@ -0,0 +1,803 @@
+import copy
+import json
+import mmap
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+
+DATA_FILE = 'kabraji_data.json'
+JOURNAL_FILE = 'kabraji_journal.jsonl'
+DB_FILE = 'kabraji.db'
+
+# Backend used by open_storage() unless one is passed explicitly: 'json' or 'sqlite'
+STORAGE_ENV = 'KABRAJI_STORAGE'
+
+# Number of journal records after which the journal is folded into the snapshot
+COMPACT_EVERY = 500
+
+# Writes that may be queued for the I/O worker before callers block
+IO_QUEUE_SIZE = 256
+
+# Snapshot layout: a header line, then one [collection, key, record] line per
+# record, catalog collections first so they can be read without the orders
+SNAPSHOT_FORMAT = 'kabraji-lines-1'
+CATALOG_COLLECTIONS = ('sequences', 'products', 'customers')
+ORDER_COLLECTIONS = ('orders', 'sales_history', 'stock_moves')
+_decode_line = json.JSONDecoder().decode
+
+
+class CorruptDataError(ValueError):
+    """A data file cannot be read at all; the message says where it is damaged"""
+
+
+# Journal operations
+def put(coll, key, value):
+    """Insert or replace the record `key` in a keyed collection"""
+    return {'op': 'put', 'coll': coll, 'key': key, 'value': value}
+
+
+def delete(coll, key):
+    """Remove the record `key` from a keyed collection"""
+    return {'op': 'del', 'coll': coll, 'key': key}
+
+
+def append(coll, value):
+    """Append a record to a list collection (orders, sales_history)"""
+    return {'op': 'append', 'coll': coll, 'value': value}
+
+
+def update(coll, key, **fields):
+    """Set individual fields on an existing record"""
+    return {'op': 'update', 'coll': coll, 'key': key, 'fields': fields}
+
+
+def empty_state():
+    # sequences holds monotonic counters (e.g. the last order number issued)
+    return {'products': {}, 'customers': {}, 'orders': [], 'sales_history': [], 'stock_moves': [],
+            'sequences': {}}
+
+
+class _Replayer:
+    """Applies journal operations to an in-memory state dict"""
+
+    def __init__(self, state):
+        self.state = state
+        self.order_index = {o['order_id']: o for o in state.get('orders', [])}
+
+    def apply(self, op):
+        # A partial state (catalog or orders only) ignores the other collections
+        coll = self.state.get(op['coll'])
+        if coll is None:
+            return
+        kind = op['op']
+        if kind == 'put':
+            coll[op['key']] = op['value']
+        elif kind == 'del':
+            coll.pop(op['key'], None)
+        elif kind == 'append':
+            coll.append(op['value'])
+            if op['coll'] == 'orders':
+                self.order_index[op['value']['order_id']] = op['value']
+        elif kind == 'update':
+            if op['coll'] == 'orders':
+                record = self.order_index.get(op['key'])
+            else:
+                record = coll.get(op['key'])
+            if record is not None:
+                record.update(op['fields'])
+        else:
+            raise ValueError(f"Unknown journal operation: {kind}")
+
+
+class JournalStorage:
+    """Snapshot file plus an append-only, fsynced journal of mutations.
+
+    Every commit is one compact JSON line holding a sequence number and the
+    list of operations it applies, so a torn final line drops the whole commit.
+    Once enough records pile up the journal is rotated and a background thread
+    folds it into a new snapshot.
+    """
+
+    def __init__(self, data_file=DATA_FILE, journal_file=JOURNAL_FILE,
+                 compact_every=COMPACT_EVERY):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.segment_file = journal_file + '.compacting'
+        self.compact_every = compact_every
+        self.seq = 0
+        self.snapshot_seq = 0
+        self.pending = 0
+        self.problems = []
+        self._orders_at = None
+        self._legacy = None
+        self._copies = None
+        self._lock = threading.Lock()
+        self._journal = None
+        self._compactor = None
+
+    def load(self):
+        """Return the state from the snapshot with the journal tail replayed"""
+        state = self.load_catalog()
+        state.update(self.load_orders())
+        return state
+
+    def load_catalog(self):
+        """Products, customers and sequences, stopping before the orders in the snapshot.
+
+        Damaged snapshot lines or journal commits are skipped and described
+        in self.problems; a file that cannot be read at all raises
+        CorruptDataError.
+        """
+        self.problems = []
+        # A leftover segment means a compaction was interrupted; finish it first
+        if os.path.exists(self.segment_file):
+            self._compact_segment()
+        self._drop_torn_tail(self.journal_file)
+
+        state, self._orders_at = self._read_snapshot(CATALOG_COLLECTIONS)
+        self._replay(state, report=True)
+        return state
+
+    def load_orders(self):
+        """Orders and sales history, read from where load_catalog() stopped"""
+        self.problems = []
+        state, _ = self._read_snapshot(ORDER_COLLECTIONS, self._orders_at)
+        self._replay(state)
+        self._legacy = None
+        return state
+
+    def keep_copy(self):
+        """Copy the data files aside before damaged records get dropped; returns the copies"""
+        if self._copies is None:
+            stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            self._copies = []
+            for path in (self.data_file, self.segment_file, self.journal_file):
+                if os.path.exists(path):
+                    shutil.copy2(path, f"{path}.corrupt-{stamp}")
+                    self._copies.append(f"{path}.corrupt-{stamp}")
+        return self._copies
+
+    def commit(self, ops):
+        """Durably append one commit made of one or more operations"""
+        if not ops:
+            return
+        with self._lock:
+            self.seq += 1
+            line = json.dumps({'seq': self.seq, 'ops': ops}, separators=(',', ':'))
+            journal = self._open_journal()
+            journal.write(line + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+            self.pending += 1
+            if self.pending >= self.compact_every:
+                self._start_compaction()
+
+    def write_snapshot(self, state):
+        """Write a full snapshot and discard the journal it supersedes"""
+        with self._lock:
+            self.wait_for_compaction()
+            self._write_snapshot_file(state, self.seq)
+            self._close_journal()
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+            self.pending = 0
+
+    def wait_for_compaction(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    def close(self):
+        self.wait_for_compaction()
+        with self._lock:
+            self._close_journal()
+
+    # Internals
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+        return self._journal
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _start_compaction(self):
+        # Called with the lock held
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        if os.path.exists(self.segment_file):
+            return
+        self._close_journal()
+        os.replace(self.journal_file, self.segment_file)
+        self.pending = 0
+        self._compactor = threading.Thread(target=self._compact_segment,
+                                           name='kabraji-compactor')
+        self._compactor.start()
+
+    def _compact_segment(self):
+        known = len(self.problems)
+        state, _ = self._read_snapshot(CATALOG_COLLECTIONS + ORDER_COLLECTIONS)
+        if len(self.problems) > known:
+            # The new snapshot will not have the damaged lines
+            self.keep_copy()
+        replayer = _Replayer(state)
+        last_seq = self.snapshot_seq
+        for record in self._read_journal(self.segment_file):
+            if record['seq'] <= self.snapshot_seq:
+                continue
+            for op in record['ops']:
+                replayer.apply(op)
+            last_seq = record['seq']
+        self._write_snapshot_file(state, last_seq)
+        os.remove(self.segment_file)
+
+    def _replay(self, state, report=False):
+        """Apply journal commits newer than the snapshot to a (partial) state"""
+        replayer = _Replayer(state)
+        self.seq = self.snapshot_seq
+        self.pending = 0
+        for path in (self.segment_file, self.journal_file):
+            for record in self._read_journal(path, self.problems if report else None):
+                if record['seq'] <= self.snapshot_seq:
+                    continue
+                for op in record['ops']:
+                    replayer.apply(op)
+                self.seq = record['seq']
+                self.pending += 1
+
+    def _read_snapshot(self, collections, resume=None):
+        """Read the given collections; returns the state and where the next section starts.
+
+        The snapshot is memory-mapped and decoded a line at a time, so only
+        the records asked for are ever materialized. resume is a position
+        returned by an earlier call, to skip the sections already read.
+        """
+        state = {coll: empty_state()[coll] for coll in collections}
+        if not os.path.exists(self.data_file) or os.path.getsize(self.data_file) == 0:
+            self.snapshot_seq = 0
+            return state, None
+
+        with open(self.data_file, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if resume is None:
+                end = data.find(b'\n')
+                header = self._decode_header(data[:end if end >= 0 else len(data)])
+                if header is None:
+                    return self._read_legacy_snapshot(data, collections), None
+                self.snapshot_seq = header.get('journal_seq', 0)
+                resume = (end + 1, 2)
+
+            pos, line_no = resume
+            while pos < len(data):
+                end = data.find(b'\n', pos)
+                if end < 0:
+                    end = len(data)
+                try:
+                    # Lines are ASCII (json.dumps escapes the rest)
+                    coll, key, value = _decode_line(data[pos:end].decode('ascii'))
+                except (ValueError, TypeError) as e:
+                    # UnicodeDecodeError is a ValueError too
+                    self.problems.append(f"{self.data_file} line {line_no} (byte {pos}): {e}")
+                else:
+                    if coll not in collections:
+                        # Sections are in order, so this is where the next read resumes
+                        return state, (pos, line_no)
+                    target = state[coll]
+                    if isinstance(target, list):
+                        target.append(value)
+                    else:
+                        target[key] = value
+                pos, line_no = end + 1, line_no + 1
+        return state, None
+
+    def _decode_header(self, line):
+        try:
+            header = json.loads(line)
+        except ValueError:
+            header = None
+        if isinstance(header, dict) and header.get('format') == SNAPSHOT_FORMAT:
+            return header
+        return None
+
+    def _read_legacy_snapshot(self, data, collections):
+        # Snapshots written before the line format are one JSON document;
+        # the next snapshot is written in the line format
+        if self._legacy is None:
+            try:
+                self._legacy = json.loads(data[:])
+            except ValueError as e:
+                raise CorruptDataError(f"{self.data_file} cannot be read: {e}")
+        self.snapshot_seq = self._legacy.get('journal_seq', 0)
+        return {coll: self._legacy.get(coll, empty_state()[coll]) for coll in collections}
+
+    def _read_journal(self, path, problems=None):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.endswith('\n'):
+                    # Torn write from a crash mid-commit; the commit never happened
+                    break
+                try:
+                    record = json.loads(line)
+                    record['seq'], record['ops']
+                except (ValueError, TypeError, KeyError) as e:
+                    if problems is not None:
+                        problems.append(f"{path} line {line_no}: commit skipped ({e!r})")
+                    continue
+                yield record
+
+    def _drop_torn_tail(self, path):
+        # Cut a partial last line so new commits start on a clean line
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+
+    def _write_snapshot_file(self, state, seq):
+        tmp_file = self.data_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'format': SNAPSHOT_FORMAT, 'journal_seq': seq}) + '\n')
+            for coll in CATALOG_COLLECTIONS + ORDER_COLLECTIONS:
+                records = state.get(coll, ())
+                pairs = records.items() if isinstance(records, dict) else ((None, r) for r in records)
+                for key, value in pairs:
+                    f.write(json.dumps([coll, key, value], separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.data_file)
+        self.snapshot_seq = seq
+        self._orders_at = None
+
+
+# SQLite backend
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    prod_id TEXT PRIMARY KEY,
+    name TEXT, category TEXT, price REAL, stock NUMERIC, unit TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS customers (
+    cust_id TEXT PRIMARY KEY,
+    name TEXT, phone TEXT, email TEXT, address TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS orders (
+    order_id TEXT PRIMARY KEY,
+    customer_id TEXT, customer_name TEXT, date TEXT, ts TEXT,
+    subtotal REAL, discount REAL, tax REAL, total REAL, status TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS order_items (
+    order_id TEXT NOT NULL REFERENCES orders(order_id) ON DELETE CASCADE,
+    line_no INTEGER NOT NULL,
+    prod_id TEXT, name TEXT, qty NUMERIC, price REAL, discount REAL, total REAL,
+    extra TEXT,
+    PRIMARY KEY (order_id, line_no)
+);
+CREATE TABLE IF NOT EXISTS sales_history (
+    order_id TEXT, date TEXT, day TEXT, customer TEXT, total REAL,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS stock_moves (
+    prod_id TEXT, date TEXT, ts TEXT, qty NUMERIC, kind TEXT, ref TEXT,
+    extra TEXT
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders(customer_id);
+CREATE INDEX IF NOT EXISTS idx_orders_ts ON orders(ts);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status);
+CREATE INDEX IF NOT EXISTS idx_order_items_prod ON order_items(prod_id);
+CREATE INDEX IF NOT EXISTS idx_sales_day ON sales_history(day);
+CREATE INDEX IF NOT EXISTS idx_sales_order ON sales_history(order_id);
+CREATE INDEX IF NOT EXISTS idx_stock_moves_prod ON stock_moves(prod_id, ts);
+"""
+
+# Columns stored natively per collection; any other field goes into `extra`
+_KEYED_TABLES = {
+    'products': ('prod_id', ('name', 'category', 'price', 'stock', 'unit')),
+    'customers': ('cust_id', ('name', 'phone', 'email', 'address')),
+}
+_ORDER_COLS = ('customer_id', 'customer_name', 'date', 'subtotal', 'discount',
+               'tax', 'total', 'status')
+_ITEM_COLS = ('prod_id', 'name', 'qty', 'price', 'discount', 'total')
+_SALE_COLS = ('order_id', 'date', 'customer', 'total')
+_MOVE_COLS = ('prod_id', 'date', 'qty', 'kind', 'ref')
+
+
+def iso_date(date_str):
+    """Convert a '%d/%m/%Y[ %H:%M:%S]' date into a sortable ISO string"""
+    for fmt in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(date_str, fmt).isoformat(sep=' ')
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def _split(record, cols):
+    values = [record.get(c) for c in cols]
+    extra = {k: v for k, v in record.items() if k not in cols}
+    return values, (json.dumps(extra, separators=(',', ':')) if extra else None)
+
+
+def _join(row, cols):
+    record = dict(zip(cols, row))
+    extra = row[len(cols)]
+    if extra:
+        record.update(json.loads(extra))
+    return record
+
+
+class SQLiteStorage:
+    """SQLite backend with indexed tables for products, customers and orders.
+
+    Implements the same load/commit/write_snapshot/close interface as
+    JournalStorage, plus indexed point and range queries over order history.
+    On first use an existing JSON snapshot and journal are migrated in.
+    """
+
+    def __init__(self, db_file=DB_FILE, migrate_from=None):
+        self.db_file = db_file
+        self.migrate_from = migrate_from
+        # Rows are validated by their schema; only model-level problems are found later
+        self.problems = []
+        self._copies = None
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(_SCHEMA)
+
+    def load(self):
+        state = self.load_catalog()
+        state.update(self.load_orders())
+        return state
+
+    def load_catalog(self):
+        """Products, customers and sequences"""
+        if self.migrate_from is not None and self._is_empty():
+            migrate_json_to_sqlite(self.migrate_from, self)
+
+        state = {coll: {} for coll in _KEYED_TABLES}
+        for coll, (key_col, cols) in _KEYED_TABLES.items():
+            rows = self.conn.execute(
+                f"SELECT {key_col}, {', '.join(cols)}, extra FROM {coll} ORDER BY rowid")
+            for row in rows:
+                state[coll][row[0]] = _join(row[1:], cols)
+        state['sequences'] = dict(self.conn.execute("SELECT name, value FROM sequences"))
+        return state
+
+    def load_orders(self):
+        """Orders and sales history"""
+        state = {'orders': []}
+        items = {}
+        rows = self.conn.execute(
+            f"SELECT order_id, {', '.join(_ITEM_COLS)}, extra FROM order_items "
+            "ORDER BY order_id, line_no")
+        for row in rows:
+            items.setdefault(row[0], []).append(_join(row[1:], _ITEM_COLS))
+
+        rows = self.conn.execute(
+            f"SELECT order_id, {', '.join(_ORDER_COLS)}, extra FROM orders ORDER BY rowid")
+        for row in rows:
+            state['orders'].append(self._order_from_row(row, items.get(row[0], [])))
+
+        rows = self.conn.execute(
+            f"SELECT {', '.join(_SALE_COLS)}, extra FROM sales_history ORDER BY rowid")
+        state['sales_history'] = [_join(row, _SALE_COLS) for row in rows]
+
+        rows = self.conn.execute(
+            f"SELECT {', '.join(_MOVE_COLS)}, extra FROM stock_moves ORDER BY rowid")
+        state['stock_moves'] = [_join(row, _MOVE_COLS) for row in rows]
+        return state
+
+    def keep_copy(self):
+        """Back up the database before damaged records get dropped; returns the copy"""
+        if self._copies is None:
+            target = f"{self.db_file}.corrupt-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            copy_conn = sqlite3.connect(target)
+            try:
+                with self._lock:
+                    self.conn.backup(copy_conn)
+            finally:
+                copy_conn.close()
+            self._copies = [target]
+        return self._copies
+
+    def commit(self, ops):
+        """Apply one commit's operations in a single transaction"""
+        if not ops:
+            return
+        with self._lock, self.conn:
+            for op in ops:
+                self._apply(op)
+
+    def write_snapshot(self, state):
+        """Replace the stored data with `state`"""
+        with self._lock, self.conn:
+            for table in ('order_items', 'orders', 'sales_history', 'stock_moves', 'products',
+                          'customers', 'sequences'):
+                self.conn.execute(f"DELETE FROM {table}")
+            for coll in _KEYED_TABLES:
+                for key, record in state[coll].items():
+                    self._put(coll, key, record)
+            for order in state['orders']:
+                self._put_order(order)
+            for sale in state['sales_history']:
+                self._append_sale(sale)
+            for move in state.get('stock_moves', []):
+                self._append_move(move)
+            for name, value in state.get('sequences', {}).items():
+                self._put_sequence(name, value)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    # Indexed queries
+    def get_order(self, order_id):
+        row = self.conn.execute(
+            f"SELECT order_id, {', '.join(_ORDER_COLS)}, extra FROM orders WHERE order_id = ?",
+            (order_id,)).fetchone()
+        if row is None:
+            return None
+        return self._order_from_row(row, self._order_items(order_id))
+
+    def orders_between(self, start, end):
+        """Orders with start <= date <= end, oldest first (datetimes or ISO strings)"""
+        if isinstance(start, datetime):
+            start = start.isoformat(sep=' ')
+        if isinstance(end, datetime):
+            end = end.isoformat(sep=' ')
+        rows = self.conn.execute(
+            f"SELECT order_id, {', '.join(_ORDER_COLS)}, extra FROM orders "
+            "WHERE ts BETWEEN ? AND ? ORDER BY ts", (start, end)).fetchall()
+        return [self._order_from_row(row, self._order_items(row[0])) for row in rows]
+
+    def orders_for_customer(self, customer_id):
+        rows = self.conn.execute(
+            f"SELECT order_id, {', '.join(_ORDER_COLS)}, extra FROM orders "
+            "WHERE customer_id = ? ORDER BY ts", (customer_id,)).fetchall()
+        return [self._order_from_row(row, self._order_items(row[0])) for row in rows]
+
+    def product_sales(self, prod_id):
+        """Total quantity and revenue for a product across all orders"""
+        qty, revenue = self.conn.execute(
+            "SELECT COALESCE(SUM(qty), 0), COALESCE(SUM(total), 0) FROM order_items "
+            "WHERE prod_id = ?", (prod_id,)).fetchone()
+        return {'qty': qty, 'revenue': revenue}
+
+    # Internals
+    def _is_empty(self):
+        for table in ('products', 'customers', 'orders'):
+            if self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                return False
+        return True
+
+    def _order_from_row(self, row, items):
+        order = {'order_id': row[0]}
+        order.update(_join(row[1:], _ORDER_COLS))
+        order['items'] = items
+        return order
+
+    def _order_items(self, order_id):
+        rows = self.conn.execute(
+            f"SELECT {', '.join(_ITEM_COLS)}, extra FROM order_items "
+            "WHERE order_id = ? ORDER BY line_no", (order_id,))
+        return [_join(row, _ITEM_COLS) for row in rows]
+
+    def _apply(self, op):
+        coll, kind = op['coll'], op['op']
+        if kind == 'put' and coll in _KEYED_TABLES:
+            self._put(coll, op['key'], op['value'])
+        elif kind == 'del' and coll in _KEYED_TABLES:
+            key_col = _KEYED_TABLES[coll][0]
+            self.conn.execute(f"DELETE FROM {coll} WHERE {key_col} = ?", (op['key'],))
+        elif kind == 'append' and coll == 'orders':
+            self._put_order(op['value'])
+        elif kind == 'append' and coll == 'sales_history':
+            self._append_sale(op['value'])
+        elif kind == 'append' and coll == 'stock_moves':
+            self._append_move(op['value'])
+        elif kind == 'put' and coll == 'sequences':
+            self._put_sequence(op['key'], op['value'])
+        elif kind == 'update' and coll in _KEYED_TABLES:
+            key_col, cols = _KEYED_TABLES[coll]
+            row = self.conn.execute(
+                f"SELECT {', '.join(cols)}, extra FROM {coll} WHERE {key_col} = ?",
+                (op['key'],)).fetchone()
+            if row is not None:
+                record = _join(row, cols)
+                record.update(op['fields'])
+                self._put(coll, op['key'], record)
+        elif kind == 'update' and coll == 'orders':
+            order = self.get_order(op['key'])
+            if order is not None:
+                order.update(op['fields'])
+                self._write_order_row(order)
+        else:
+            raise ValueError(f"Unsupported journal operation: {kind} on {coll}")
+
+    def _put(self, coll, key, record):
+        key_col, cols = _KEYED_TABLES[coll]
+        values, extra = _split(record, cols)
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO {coll} ({key_col}, {', '.join(cols)}, extra) "
+            f"VALUES ({', '.join('?' * (len(cols) + 2))})",
+            [key] + values + [extra])
+
+    def _put_sequence(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO sequences (name, value) VALUES (?, ?)", (name, value))
+
+    def _write_order_row(self, order):
+        values, extra = _split({k: v for k, v in order.items()
+                                if k not in ('order_id', 'items')}, _ORDER_COLS)
+        self.conn.execute(
+            f"INSERT INTO orders (order_id, {', '.join(_ORDER_COLS)}, ts, extra) "
+            f"VALUES ({', '.join('?' * (len(_ORDER_COLS) + 3))}) "
+            "ON CONFLICT(order_id) DO UPDATE SET "
+            + ', '.join(f"{c} = excluded.{c}" for c in _ORDER_COLS + ('ts', 'extra')),
+            [order['order_id']] + values + [iso_date(order.get('date')), extra])
+
+    def _put_order(self, order):
+        self._write_order_row(order)
+        self.conn.execute("DELETE FROM order_items WHERE order_id = ?", (order['order_id'],))
+        self.conn.executemany(
+            f"INSERT INTO order_items (order_id, line_no, {', '.join(_ITEM_COLS)}, extra) "
+            f"VALUES ({', '.join('?' * (len(_ITEM_COLS) + 3))})",
+            [[order['order_id'], line_no] + values + [extra]
+             for line_no, (values, extra) in enumerate(
+                 _split(item, _ITEM_COLS) for item in order.get('items', []))])
+
+    def _append_sale(self, sale):
+        values, extra = _split(sale, _SALE_COLS)
+        self.conn.execute(
+            f"INSERT INTO sales_history ({', '.join(_SALE_COLS)}, day, extra) "
+            f"VALUES ({', '.join('?' * (len(_SALE_COLS) + 2))})",
+            values + [(iso_date(sale.get('date')) or '')[:10] or None, extra])
+
+    def _append_move(self, move):
+        values, extra = _split(move, _MOVE_COLS)
+        self.conn.execute(
+            f"INSERT INTO stock_moves ({', '.join(_MOVE_COLS)}, ts, extra) "
+            f"VALUES ({', '.join('?' * (len(_MOVE_COLS) + 2))})",
+            values + [iso_date(move.get('date')), extra])
+
+
+# Background writes
+class Job:
+    """A unit of work for the IOWorker; wait() is the durability barrier"""
+
+    def __init__(self, func, args, callback):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block until the job has run; re-raise its error if it failed"""
+        self.finished.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class IOWorker:
+    """Single background thread that runs persistence and file writes in order.
+
+    The queue is bounded so a burst of writes slows the caller down instead
+    of growing without limit. Finished jobs are handed back through poll(),
+    which the UI calls from its own thread (via root.after), so callbacks
+    never touch widgets from the worker thread.
+    """
+
+    def __init__(self, maxsize=IO_QUEUE_SIZE):
+        self.jobs = queue.Queue(maxsize)
+        self.completed = queue.Queue()
+        self.on_error = None
+        self.thread = threading.Thread(target=self._run, name='kabraji-io', daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, callback=None):
+        """Queue func(*args); callback(job) runs from poll() once it is done"""
+        job = Job(func, args, callback)
+        self.jobs.put(job)
+        return job
+
+    def poll(self):
+        """Run callbacks for finished jobs in the calling thread"""
+        while True:
+            try:
+                job = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            if job.callback is not None:
+                job.callback(job)
+            elif job.error is not None and self.on_error is not None:
+                self.on_error(job.error)
+
+    def flush(self):
+        """Wait until every queued job has been written"""
+        self.jobs.join()
+
+    def stop(self):
+        self.jobs.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            try:
+                job.result = job.func(*job.args)
+            except Exception as e:
+                job.error = e
+            job.finished.set()
+            self.completed.put(job)
+            self.jobs.task_done()
+
+
+class AsyncStorage:
+    """Wraps a storage backend so its commits run on an IOWorker.
+
+    commit() returns the worker Job for the write; the records are copied
+    first so later in-memory edits cannot leak into a queued commit.
+    """
+
+    def __init__(self, backend, worker):
+        self.backend = backend
+        self.worker = worker
+
+    def load(self):
+        return self.backend.load()
+
+    def commit(self, ops, callback=None):
+        if not ops:
+            return None
+        return self.worker.submit(self.backend.commit, copy.deepcopy(ops), callback=callback)
+
+    def write_snapshot(self, state):
+        self.worker.submit(self.backend.write_snapshot, state).wait()
+
+    def close(self):
+        self.worker.flush()
+        self.backend.close()
+
+    def __getattr__(self, name):
+        # Read-side queries (e.g. SQLiteStorage.get_order) go straight to the backend
+        return getattr(self.backend, name)
+
+
+def migrate_json_to_sqlite(json_storage, sqlite_storage):
+    """One-time copy of a JSON snapshot (plus journal) into SQLite"""
+    state = json_storage.load()
+    json_storage.close()
+    sqlite_storage.write_snapshot(state)
+    return state
+
+
+def open_storage(backend=None):
+    """Create the configured storage backend ('json' by default)"""
+    backend = backend or os.environ.get(STORAGE_ENV, 'json')
+    if backend == 'json':
+        return JournalStorage()
+    if backend == 'sqlite':
+        migrate_from = JournalStorage() if os.path.exists(DATA_FILE) else None
+        return SQLiteStorage(migrate_from=migrate_from)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,136 @@
+"""Returns, cancellations and reopened orders in ShopEngine, and the running
+totals, rollups, stock ledger and customer history they leave after a
+reload.
+
+Run with `python -m pytest -q` (or `python -m unittest discover tests`)
+from the project directory.
+"""
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import kabraji_storage as storage
+from kabraji_engine import ShopEngine, ShopError
+
+
+def figures(engine, order_id):
+    """Everything a sale, return or cancellation should keep consistent"""
+    today = datetime.now().date()
+    return {
+        'revenue': engine.metrics.revenue_paise,
+        'all_time': engine.rollup.totals(),
+        'today': engine.line_items.totals(today, today),
+        'stock': {prod_id: engine.products[prod_id].stock for prod_id in ('PROD0001', 'PROD0002')},
+        'stock_now': engine.stock_as_of(datetime.now(), 'PROD0001'),
+        'moves': [(move['kind'], move['qty'], move['balance']) for move in engine.stock_movements('PROD0001')],
+        'summary': engine.customer_summary('CUST001'),
+        'restocked': engine.get_order(order_id).restocked,
+    }
+
+
+class EngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def open_storage(self):
+        return storage.JournalStorage(os.path.join(self.tmp.name, 'data.json'),
+                                      os.path.join(self.tmp.name, 'journal.jsonl'))
+
+    def open(self):
+        engine = ShopEngine(self.open_storage())
+        self.addCleanup(engine.close)
+        engine.start()
+        return engine
+
+    def sell(self, engine):
+        engine.add_customer('CUST001', 'Asha', '9876543210')
+        engine.add_to_cart('PROD0001', 4)
+        engine.add_to_cart('PROD0002', 2, discount=10)
+        return engine.checkout('CUST001')
+
+
+class ReturnAndCancelTest(EngineTestCase):
+
+    def test_partial_return_cancel_and_reopen_survive_a_reload(self):
+        engine = self.open()
+        order = self.sell(engine)
+        ret = engine.return_items(order.order_id, {0: 1})
+        self.assertEqual(ret['items'][0]['qty'], 1)
+        self.assertAlmostEqual(order.net_total, order.total - ret['total'])
+
+        engine.update_order_status(order.order_id, 'Cancelled')
+        cancelled = figures(engine, order.order_id)
+        self.assertEqual(cancelled['revenue'], 0)
+        self.assertEqual(cancelled['stock'], {'PROD0001': 50, 'PROD0002': 40})
+        self.assertEqual(cancelled['all_time'], ({}, {}))
+        self.assertTrue(cancelled['restocked'])
+
+        engine.update_order_status(order.order_id, 'Completed')
+        reopened = figures(engine, order.order_id)
+        net_items = order.net_items()
+        self.assertEqual(reopened['revenue'], round(order.net_total * 100))
+        self.assertEqual(reopened['stock'], {'PROD0001': 47, 'PROD0002': 38})
+        self.assertEqual(reopened['stock_now'], 47)
+        self.assertEqual([kind for kind, _, _ in reopened['moves']],
+                         ['sale', 'return', 'cancellation', 'sale'])
+        self.assertEqual(reopened['moves'][-1], ('sale', -3, 47))
+        self.assertFalse(reopened['restocked'])
+
+        categories, products = reopened['all_time']
+        self.assertEqual(products['Asian Paints Royale']['qty'], 3)
+        self.assertAlmostEqual(products['Asian Paints Royale']['revenue'], net_items[0][2])
+        self.assertAlmostEqual(categories['Paints'], net_items[0][2] + net_items[1][2])
+        self.assertEqual(reopened['today'], reopened['all_time'])
+
+        summary = reopened['summary']
+        self.assertEqual(summary['orders'], 1)
+        self.assertAlmostEqual(summary['spend'], order.net_total)
+        self.assertEqual(summary['top_items'][0][:2], ('Asian Paints Royale', 3))
+
+        engine.close()
+        self.assertEqual(figures(self.open(), order.order_id), reopened)
+
+    def test_cancellation_is_reopened_after_a_reload(self):
+        engine = self.open()
+        order = self.sell(engine)
+        engine.update_order_status(order.order_id, 'Cancelled')
+        engine.close()
+
+        engine = self.open()
+        self.assertTrue(engine.get_order(order.order_id).restocked)
+        engine.update_order_status(order.order_id, 'Pending')
+        reopened = figures(engine, order.order_id)
+        self.assertEqual(reopened['stock'], {'PROD0001': 46, 'PROD0002': 38})
+        self.assertEqual(reopened['revenue'], round(order.total * 100))
+        engine.close()
+        self.assertEqual(figures(self.open(), order.order_id), reopened)
+
+    def test_invalid_return_quantities_are_refused(self):
+        engine = self.open()
+        order = self.sell(engine)
+        before = figures(engine, order.order_id)
+        for quantities in ({0: 'nan'}, {0: 'inf'}, {0: -1}, {0: 5}, {0: 'two'}, {7: 1}, {}):
+            with self.subTest(quantities=quantities):
+                with self.assertRaises(ShopError):
+                    engine.return_items(order.order_id, quantities)
+        self.assertEqual(figures(engine, order.order_id), before)
+
+    def test_a_cancelled_order_cannot_be_returned(self):
+        engine = self.open()
+        order = self.sell(engine)
+        engine.update_order_status(order.order_id, 'Cancelled')
+        with self.assertRaises(ShopError):
+            engine.return_items(order.order_id, {0: 1})
+
+
+class SQLiteReturnAndCancelTest(ReturnAndCancelTest):
+
+    def open_storage(self):
+        return storage.SQLiteStorage(os.path.join(self.tmp.name, 'kabraji.db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+"""Journal replay, torn-tail handling and compaction of JournalStorage,
+and the indexed order queries of SQLiteStorage.
+
+Run with `python -m pytest -q` (or `python -m unittest discover tests`)
+from the project directory.
+"""
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import kabraji_storage as storage
+
+
+def product(name, stock):
+    return {'name': name, 'category': 'Paints', 'price': 100.0, 'stock': stock, 'unit': 'Liter'}
+
+
+def order(order_id, status='Pending', customer_id='CUST001', date='01/02/2024 10:00:00', items=()):
+    return {'order_id': order_id, 'customer_id': customer_id, 'customer_name': 'Asha',
+            'date': date, 'items': list(items), 'subtotal': 100.0, 'discount': 0.0,
+            'tax': 18.0, 'total': 118.0, 'status': status}
+
+
+def item(prod_id, qty, total):
+    return {'prod_id': prod_id, 'name': prod_id, 'qty': qty, 'price': total / qty,
+            'discount': 0.0, 'total': total}
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.data_file = os.path.join(self.tmp.name, 'data.json')
+        self.journal_file = os.path.join(self.tmp.name, 'journal.jsonl')
+
+    def open(self, compact_every=storage.COMPACT_EVERY):
+        store = storage.JournalStorage(self.data_file, self.journal_file, compact_every)
+        self.addCleanup(store.close)
+        return store
+
+    def reload(self):
+        store = self.open()
+        return store, store.load()
+
+    def journal_lines(self):
+        with open(self.journal_file, encoding='utf-8') as f:
+            return f.read().splitlines()
+
+
+class ReplayTest(JournalTestCase):
+
+    def test_commits_replay_over_the_snapshot(self):
+        store = self.open()
+        state = storage.empty_state()
+        state['products'] = {'P1': product('Primer', 10), 'P2': product('Putty', 5)}
+        store.write_snapshot(state)
+
+        store.commit([storage.put('products', 'P3', product('Enamel', 7)),
+                      storage.update('products', 'P1', stock=8)])
+        store.commit([storage.delete('products', 'P2')])
+        store.commit([storage.append('orders', order('ORD00001')),
+                      storage.put('sequences', 'orders', 1)])
+        store.commit([storage.update('orders', 'ORD00001', status='Completed')])
+        store.close()
+
+        store, state = self.reload()
+        self.assertEqual(set(state['products']), {'P1', 'P3'})
+        self.assertEqual(state['products']['P1']['stock'], 8)
+        self.assertEqual([o['status'] for o in state['orders']], ['Completed'])
+        self.assertEqual(state['sequences'], {'orders': 1})
+        self.assertEqual(store.seq, 4)
+        self.assertEqual(store.problems, [])
+
+    def test_commits_in_the_snapshot_are_not_applied_twice(self):
+        store = self.open()
+        store.commit([storage.append('sales_history', {'order_id': 'ORD00001', 'total': 118.0})])
+        state = store.load()
+        store.write_snapshot(state)
+        store.commit([storage.append('sales_history', {'order_id': 'ORD00002', 'total': 50.0})])
+        store.close()
+
+        store, state = self.reload()
+        self.assertEqual([s['order_id'] for s in state['sales_history']], ['ORD00001', 'ORD00002'])
+        self.assertEqual(store.seq, 2)
+
+    def test_catalog_loads_without_the_orders(self):
+        store = self.open()
+        store.commit([storage.put('products', 'P1', product('Primer', 10)),
+                      storage.append('orders', order('ORD00001'))])
+        store.close()
+
+        store = self.open()
+        catalog = store.load_catalog()
+        self.assertNotIn('orders', catalog)
+        self.assertEqual(set(catalog['products']), {'P1'})
+        self.assertEqual(len(store.load_orders()['orders']), 1)
+
+    def test_damaged_commit_is_skipped_and_reported(self):
+        store = self.open()
+        store.commit([storage.put('products', 'P1', product('Primer', 10))])
+        store.close()
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write('{"seq": 2, "ops": [\n')
+        store, _ = self.reload()
+        store.commit([storage.put('products', 'P2', product('Putty', 5))])
+        store.close()
+
+        store = self.open()
+        catalog = store.load_catalog()
+        self.assertEqual(set(catalog['products']), {'P1', 'P2'})
+        self.assertEqual(len(store.problems), 1)
+        self.assertIn('line 2', store.problems[0])
+
+
+class TornTailTest(JournalTestCase):
+
+    def write_torn_commit(self):
+        store = self.open()
+        store.commit([storage.put('products', 'P1', product('Primer', 10))])
+        store.close()
+        # A crash mid-write leaves a commit without its newline
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'seq': 2, 'ops': [storage.delete('products', 'P1')]})[:-5])
+
+    def test_torn_commit_is_dropped(self):
+        self.write_torn_commit()
+        store, state = self.reload()
+        self.assertEqual(set(state['products']), {'P1'})
+        self.assertEqual(store.seq, 1)
+        self.assertEqual(store.problems, [])
+
+    def test_torn_tail_is_cut_before_new_commits(self):
+        self.write_torn_commit()
+        store, state = self.reload()
+        self.assertEqual(len(self.journal_lines()), 1)
+
+        store.commit([storage.put('products', 'P2', product('Putty', 5))])
+        store.close()
+        self.assertEqual(len(self.journal_lines()), 2)
+        store, state = self.reload()
+        self.assertEqual(set(state['products']), {'P1', 'P2'})
+        self.assertEqual(store.seq, 2)
+
+
+class CompactionTest(JournalTestCase):
+
+    def commit_stock(self, store, *levels):
+        for stock in levels:
+            store.commit([storage.put('products', 'P1', product('Primer', stock)),
+                          storage.append('stock_moves', {'prod_id': 'P1', 'qty': stock})])
+
+    def test_full_journal_is_folded_into_the_snapshot(self):
+        store = self.open(compact_every=3)
+        self.commit_stock(store, 1, 2, 3, 4)
+        store.wait_for_compaction()
+        store.close()
+
+        self.assertFalse(os.path.exists(store.segment_file))
+        # The first three commits are in the snapshot, the fourth is still journaled
+        self.assertEqual([json.loads(line)['seq'] for line in self.journal_lines()], [4])
+        snapshot = self.open()
+        snapshot.load_catalog()
+        self.assertEqual(snapshot.snapshot_seq, 3)
+
+        store, state = self.reload()
+        self.assertEqual(state['products']['P1']['stock'], 4)
+        self.assertEqual([m['qty'] for m in state['stock_moves']], [1, 2, 3, 4])
+        self.assertEqual(store.seq, 4)
+
+    def test_repeated_compactions_keep_every_commit(self):
+        store = self.open(compact_every=2)
+        for stock in range(1, 8):
+            self.commit_stock(store, stock)
+            store.wait_for_compaction()
+        store.close()
+
+        store, state = self.reload()
+        self.assertEqual(state['products']['P1']['stock'], 7)
+        self.assertEqual([m['qty'] for m in state['stock_moves']], list(range(1, 8)))
+
+    def test_interrupted_compaction_is_finished_on_load(self):
+        store = self.open()
+        self.commit_stock(store, 1, 2)
+        store.close()
+        # As if the process died right after rotating the journal
+        os.replace(self.journal_file, store.segment_file)
+        store, _ = self.reload()
+        self.assertFalse(os.path.exists(store.segment_file))
+        self.commit_stock(store, 3)
+        store.close()
+
+        store, state = self.reload()
+        self.assertEqual(store.snapshot_seq, 2)
+        self.assertEqual([m['qty'] for m in state['stock_moves']], [1, 2, 3])
+        self.assertEqual(state['products']['P1']['stock'], 3)
+
+
+class SQLiteQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = storage.SQLiteStorage(os.path.join(tmp.name, 'kabraji.db'))
+        self.addCleanup(self.store.close)
+        self.store.load()
+        self.store.commit([
+            storage.append('orders', order('ORD00001', date='01/02/2024 10:00:00',
+                                            items=[item('P1', 2, 200.0)])),
+            storage.append('orders', order('ORD00002', customer_id='CUST002', date='03/02/2024 09:30:00',
+                                            items=[item('P1', 1, 100.0), item('P2', 4, 80.0)])),
+            storage.append('orders', order('ORD00003', date='05/02/2024 18:00:00')),
+        ])
+
+    def test_orders_between_uses_the_date_index(self):
+        found = self.store.orders_between(datetime(2024, 2, 1, 12), datetime(2024, 2, 5, 18))
+        self.assertEqual([o['order_id'] for o in found], ['ORD00002', 'ORD00003'])
+        self.assertEqual(len(found[0]['items']), 2)
+        plan = self.store.conn.execute(
+            "EXPLAIN QUERY PLAN SELECT order_id FROM orders WHERE ts BETWEEN ? AND ?", ('a', 'b')).fetchall()
+        self.assertIn('idx_orders_ts', str(plan))
+
+    def test_point_queries(self):
+        self.assertEqual([o['order_id'] for o in self.store.orders_for_customer('CUST001')],
+                         ['ORD00001', 'ORD00003'])
+        self.assertEqual(self.store.get_order('ORD00002')['customer_id'], 'CUST002')
+        self.assertIsNone(self.store.get_order('ORD09999'))
+        self.assertEqual(self.store.product_sales('P1'), {'qty': 3, 'revenue': 300.0})
+        self.assertEqual(self.store.product_sales('P9'), {'qty': 0, 'revenue': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()